@@ -17,28 +17,41 @@
 #
 
 from array import array
-from canon.util import _normalize_to_string, ARRAY_FORMAT
+from canon.util import ARRAY_FORMAT
 import struct
 import inspect
 
+# struct items to read flags of odd lengths with, largest first
+_ITEMS = ((8, 'Q'), (4, 'I'), (2, 'H'), (1, 'B'))
+
+def _split(length):
+    """Return the sizes of the struct items covering ``length`` bytes."""
+    parts = []
+    for size, _ in _ITEMS:
+        while length >= size:
+            parts.append(size)
+            length -= size
+    return parts
+
 class _BoundFlag(object):
     """An instance binging a ``Flag`` to a ``Bitfield``.
+
+    These are made whenever a flag is accessed on a bitfield and hold
+    nothing but the two.
     """
+    __slots__ = ('_bitfield', '_flag')
+
     def __init__(self, bitfield, flag):
         self._bitfield = bitfield
         self._flag = flag
-        for attr_name in ('_fmt', '_fmt_size', '_start', '_end', '_length',
-                          'name'):
-            setattr(self, attr_name, getattr(flag, attr_name))
 
     def set_(self, value):
         """Store integer value in this bitfield.
         """
-        data = self._pack(value)
-        self._store(data)
+        self._flag._write(self._bitfield, value)
 
     def __int__(self):
-        return self._unpack(self._extract())
+        return self._flag._read(self._bitfield)
 
     def __hex__(self):
         """hex() needs a push."""
@@ -68,54 +81,6 @@ class _BoundFlag(object):
 
         return int(self) == all_
 
-    def _extract(self):
-        """return a self._length-long array from bitfield
-        """
-        return self._bitfield[self._start:self._end]
-
-    def _store(self, data):
-        """set the bytes of length self._length in the bitfield
-        """
-        if not isinstance(data, array):
-            data = array('B', data)
-        assert len(data) == self._length
-        self._bitfield[self._start:self._end] = data
-
-    def _pad(self, data):
-        if self._length == self._fmt_size:
-            return data
-        # must add padding bytes for struct.unpack
-        pad = '\x00' * (self._fmt_size - self._length)
-        if '<' in self._fmt:
-            data = data + pad
-        else:
-            data = pad + data
-        return data
-
-    def _unpad(self, data):
-        if self._length == self._fmt_size:
-            return data
-        # must remove padding bytes for struct.pack
-        offset = self._fmt_size - self._length
-        if '<' in self._fmt:
-            return data[:-offset]
-        else:
-            return data[offset:]
-
-    def _unpack(self, data):
-        """Return the data array as number.
-        """
-        data = _normalize_to_string(data)
-        assert len(data) == self._length
-        data = self._pad(data)
-        return struct.unpack(self._fmt, data)[0]
-
-    def _pack(self, value):
-        """Return value as array('B') of length self._length.
-        """
-        data = struct.pack(self._fmt, int(value))
-        return self._unpad(data)
-
     def __getattr__(self, name):
         return getattr(self._flag, name)
 
@@ -147,7 +112,6 @@ class Flag(object):
             contains a map of human-readable labels of different values.
 
         """
-        self._bound = {}
         self._choices = {}
         self._start = int(offset)
         self._length = 1
@@ -163,9 +127,53 @@ class Flag(object):
             self._fmt = fmt
 
         self._fmt_size = struct.calcsize(self._fmt)
+        self._compile()
         if choices:
             self._choices = dict([(k.lower(), v) for (k, v) in choices.iteritems()])
 
+    def _compile(self):
+        """Prepare a ``struct.Struct`` reading the flag in one go.
+
+        Flags of 3, 5, 6 or 7 bytes are read as several items, e.g. a
+        short and a byte, which are shifted together.
+
+        """
+        if self._length == self._fmt_size:
+            self._struct = struct.Struct(self._fmt)
+            self._shifts = None
+            return
+        little = '<' in self._fmt
+        parts = _split(self._length)
+        codes = dict(_ITEMS)
+        self._struct = struct.Struct(('<' if little else '>') +
+                                     ''.join(codes[p] for p in parts))
+        shifts = []
+        for i, size in enumerate(parts):
+            below = parts[:i] if little else parts[i+1:]
+            shifts.append((8 * sum(below), (1 << (8 * size)) - 1))
+        self._shifts = tuple(shifts)
+
+    def _read(self, bitfield):
+        values = self._struct.unpack_from(bitfield, self._start)
+        if self._shifts is None:
+            return values[0]
+        value = 0
+        for v, (shift, _) in zip(values, self._shifts):
+            value |= v << shift
+        return value
+
+    def _write(self, bitfield, value):
+        value = int(value)
+        if self._shifts is None:
+            self._struct.pack_into(bitfield, self._start, value)
+            return
+        if value >> (8 * self._length):
+            raise struct.error("0x{:x} doesn't fit in {} bytes"
+                               .format(value, self._length))
+        self._struct.pack_into(bitfield, self._start,
+                               *[(value >> shift) & mask
+                                 for shift, mask in self._shifts])
+
     def __getattr__(self, name):
         name = name.lower()
         if name in self._choices:
@@ -178,30 +186,20 @@ class Flag(object):
                 return k
         return '<unknown 0x{:x}>'.format(value)
 
-    @classmethod
-    def _get_bound_instance(cls, self, bitfield):
-        return cls._bound_class(bitfield, self)
-
-    def _get_bound(self, bitfield):
-        h = hash(bitfield)
-        if h not in self._bound:
-            self._bound[h] = self._get_bound_instance(self, bitfield)
-        return self._bound[h]
-
     def __get__(self, bitfield, owner):
         if bitfield is None:
             return self
-        return self._get_bound(bitfield)
+        return self._bound_class(bitfield, self)
 
     def __set__(self, bitfield, value):
         if bitfield is None:
             return
-        b = self._get_bound(bitfield)
-        b.set_(value)
+        self._bound_class(bitfield, self).set_(value)
 
 class BooleanFlag(Flag):
     _size = 1
     class _bound_class(_BoundFlag):
+        __slots__ = ()
         def __nonzero__(self):
             if int(self) == self._choices['true']:
                 return True
@@ -211,8 +209,7 @@ class BooleanFlag(Flag):
                 value = (self._choices['true']
                          if value
                          else self._choices['false'])
-            data = self._pack(value)
-            self._store(data)
+            self._flag._write(self._bitfield, value)
 
     def __init__(self, offset=0, length=None, fmt=None, true=0x01, false=0x00):
         choices = dict(true=true, on=true, y=true, yes=true,
@@ -223,6 +220,22 @@ class BooleanFlag(Flag):
         super(BooleanFlag, self).__init__(offset, length, fmt, **choices)
         self._mask = true ^ false
 
+class BitfieldMeta(type):
+    """Collect the flags of a bitfield class once, when it's defined.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(BitfieldMeta, cls).__init__(name, bases, attrs)
+        cls.flags = {}
+        covered = set()
+        for flag_name, flag in inspect.getmembers(
+                          cls, lambda f: isinstance(f, Flag)):
+            flag.name = flag_name
+            cls.flags[flag_name] = flag
+            covered.update(xrange(flag._start, flag._end))
+        # bytes no flag knows about
+        cls._unflagged = tuple(i for i in xrange(cls._size or 0)
+                               if i not in covered)
+
 class Bitfield(array):
     """Packs an array('B', ...) as a set of flags
 
@@ -238,6 +251,7 @@ class Bitfield(array):
     necessary.
 
     """
+    __metaclass__ = BitfieldMeta
     _size = None
     def __new__(cls, data=None):
         if cls._size is None:
@@ -247,17 +261,34 @@ class Bitfield(array):
         elif len(data) != cls._size:
             raise RuntimeError("Unexpected data length for {}, got {}"
                                .format(cls, len(data)))
-        bf = array.__new__(cls, 'B', data)
-        bf.flags = {}
-        for flag_name, flag in inspect.getmembers(
-                          cls, lambda f: isinstance(f, Flag)):
-            flag.name = flag_name
-            bf.flags[flag_name] = flag
-        return bf
+        return array.__new__(cls, 'B', data)
+
+    def diff(self, other):
+        """Return what differs from ``other``, another bitfield or data of
+        the same length, as ``{name: (other's value, own value)}``.
+
+        Bytes not covered by any flag are listed by their offset.
+
+        """
+        if len(other) != len(self):
+            raise ValueError("can't diff {} bytes against {}"
+                             .format(len(self), len(other)))
+        if not isinstance(other, array):
+            # compare bytes with bytes, not with the characters of a str
+            other = array('B', other)
+        changes = {}
+        for name, flag in self.flags.iteritems():
+            mine, theirs = flag._read(self), flag._read(other)
+            if mine != theirs:
+                changes[name] = (theirs, mine)
+        for i in self._unflagged:
+            if self[i] != other[i]:
+                changes[i] = (other[i], self[i])
+        return changes
 
     def __repr__(self):
         bounds = []
-        for name in self.flags:
+        for name in sorted(self.flags):
             bounds.append(getattr(self, name))
         return "<{} at 0x{:x} {}>".format(
                       self.__class__.__name__, hash(self),
@@ -22,7 +22,7 @@ import usb.core
 import usb.util
 from usb.core import USBError
 
-from canon import CanonError, protocol, commands
+from canon import CanonError, protocol, commands, tuning
 from canon.capture import CanonCapture
 from canon.storage import CanonStorage
 
@@ -47,6 +47,20 @@ def find(idVendor=VENDORID, idProduct=PRODUCTID):
     _log.info("Found a Canon G3 on bus %s address %s", dev.bus, dev.address)
     return Camera(dev)
 
+def find_all(idVendor=VENDORID, idProduct=PRODUCTID, **kwargs):
+    """Return a :class:`Camera` for every matching device on the host.
+
+    ``kwargs`` are passed on to each :class:`Camera`.
+
+    """
+    cameras = []
+    for dev in usb.core.find(find_all=True, idVendor=idVendor,
+                             idProduct=idProduct):
+        _log.info("Found a Canon G3 on bus %s address %s",
+                  dev.bus, dev.address)
+        cameras.append(Camera(dev, **kwargs))
+    return cameras
+
 class Camera(object):
     """
     Camera objects are the intended API endpoint. Cameras have two
@@ -60,13 +74,32 @@ class Camera(object):
     :attr:`camera_time`.
     """
 
-    def __init__(self, device):
+    def __init__(self, device, chunk_size_store=None,
+                 transport=protocol.CanonUSB, thumbnail_cache=None):
         """Connect to a :class:`usb.core.Device`.
+
+        ``chunk_size_store`` is a :class:`canon.tuning.ChunkSizeStore`
+        to take the transfer chunk size from, the default one is used if
+        not given.
+
+        ``transport`` is the :class:`canon.protocol.CanonUSB` class to
+        talk through, e.g. :class:`canon.transport.AsyncCanonUSB`.
+
+        ``thumbnail_cache`` is a :class:`canon.thumbnails.ThumbnailCache`
+        for :meth:`CanonStorage.get_thumbnail`.
+
         """
+        if chunk_size_store is None:
+            chunk_size_store = tuning.ChunkSizeStore()
+        self._chunk_size_store = chunk_size_store
         self._device = device
-        self._usb = protocol.CanonUSB(device)
-        self._storage = CanonStorage(self._usb)
-        self._capture = CanonCapture(self._usb)
+        # where it's plugged in, tells cameras of the same model apart
+        self.bus = device.bus
+        self.address = device.address
+        self._usb = transport(device)
+        self._storage = CanonStorage(self._usb,
+                                     thumbnail_cache=thumbnail_cache)
+        self._capture = CanonCapture(self._usb, self._storage)
         self._abilities =None
         self._model = None
         self._owner = None
@@ -114,6 +147,8 @@ class Camera(object):
 
         # while polling, with a gracious timeout, do the dance
         with self._usb.poller_ctx() as p, self._usb.timeout_ctx(2000):
+            # a poller already running may have read plenty before
+            mark = p.mark()
             camstat = self._usb.control_read(0x55, 1).tostring()
             if camstat not in ('A', 'C'):
                 raise CanonError('Some kind of init error, camstat: %s', camstat)
@@ -132,14 +167,11 @@ class Camera(object):
             self._usb.control_write(0x11, msg)
             self._usb.bulk_read(0x44)
 
-            started = time.time()
-            while len(p.received) < 0x10:
-                time.sleep(0.2)
-                if time.time() - started > 3.0: # maybe too long
-                    # when this happens we're usually ok to proceed ...
-                    #raise CanonError("Waited for interrupt in data for too long!")
-                    _log.error("Waited for interrupt data for too long!")
-                    break
+            # maybe too long
+            if p.wait_for(size=0x10, timeout=3.0, since=mark) is None:
+                # when this happens we're usually ok to proceed ...
+                #raise CanonError("Waited for interrupt in data for too long!")
+                _log.error("Waited for interrupt data for too long!")
 
         for _ in range(3):
             try:
@@ -150,6 +182,11 @@ class Camera(object):
         if not self.ready:
             raise CanonError("identify_camera failed too many times")
 
+        stored = self._chunk_size_store.get(self.model, self.firmware_version)
+        if stored:
+            _log.info("using stored chunk size 0x{:x}".format(stored))
+            self._usb.max_chunk_size = stored
+
         commands.GenericLockKeysCmd().execute(self._usb)
         self._storage.initialize()
         self._capture.initialize()
@@ -228,6 +265,55 @@ class Camera(object):
         """
         return commands.CheckACPowerCmd().execute(self._usb)
 
+    @property
+    def metrics(self):
+        """Latency and throughput per command so far.
+
+        See :class:`canon.metrics.MetricsRegistry`.
+
+        """
+        return self._usb.metrics
+
+    @property
+    def chunk_size(self):
+        """Transfer chunk size for file downloads, writable.
+        """
+        return self._usb.max_chunk_size
+
+    @chunk_size.setter
+    def chunk_size(self, size):
+        self._usb.max_chunk_size = size
+
+    def tune_chunk_size(self, path=None,
+                        candidates=tuning.CANDIDATE_CHUNK_SIZES,
+                        rounds=1, save=True, max_bytes=tuning.TRIAL_BYTES):
+        """Find the fastest chunk size by downloading ``path`` repeatedly.
+
+        The largest file on the camera of at most ``max_bytes`` is used if
+        ``path`` is not given.
+        The winner is applied to this session and, with ``save``, stored
+        for this model and firmware. Returns the measured
+        ``{chunk_size: bytes_per_second}``.
+
+        """
+        if path is None:
+            files = [e for e in self.storage.ls()
+                     if e.is_file and e.size <= max_bytes]
+            if not files:
+                raise CanonError("no files of at most 0x{:x} bytes on the "
+                                 "camera to tune with".format(max_bytes))
+            path = max(files, key=lambda e: e.size)
+        results = tuning.measure_chunk_sizes(self._usb, self.storage, path,
+                                             candidates, rounds, max_bytes)
+        if not results:
+            raise CanonError("no usable chunk size among the candidates")
+        best = max(results, key=results.get)
+        self.chunk_size = best
+        if save:
+            self._chunk_size_store.set(self.model, self.firmware_version,
+                                       best)
+        return results
+
     @property
     def abilities(self):
         """Camera "abilities" -- supported image sizes and compressions.
@@ -253,6 +339,7 @@ class Camera(object):
         if not self._device:
             return
         _log.info("Camera {} being cleaned up".format(self))
+        self._storage.stop_prefetch()
         usb.util.dispose_resources(self._device)
         self._device = None
         try:
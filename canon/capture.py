@@ -17,17 +17,71 @@
 
 import time
 import logging
+import threading
+from Queue import Queue, Empty
 from array import array
 
 import usb.core
 
-from canon import commands, CanonError
+from canon import commands, protocol, CanonError
 from canon.bitfield import Bitfield, Flag, BooleanFlag
-from canon.util import itole32a
+from canon.util import itole32a, le32toi, CoalescingWriter
 from functools import wraps
+from contextlib import contextmanager
 
 _log = logging.getLogger(__name__)
 
+# interrupt messages, byte 4 is the type
+INT_SHUTTER_RELEASED = 0x0a
+INT_THUMBNAIL_SIZE = 0x08
+INT_FULL_IMAGE_SIZE = 0x0c
+INT_CAPTURE_COMPLETE = 0x0e
+
+class CaptureEvent(object):
+    """A decoded interrupt message.
+
+    ``kind`` is the message type, one of the ``INT_*`` constants, ``key``
+    the handle of the picture it's about and ``size`` the byte count of
+    the thumbnail or full image which is ready. ``timestamp`` is when the
+    message was read.
+
+    """
+    _names = {
+        INT_SHUTTER_RELEASED: 'shutter released',
+        INT_THUMBNAIL_SIZE: 'thumbnail ready',
+        INT_FULL_IMAGE_SIZE: 'full image ready',
+        INT_CAPTURE_COMPLETE: 'capture complete',
+    }
+
+    def __init__(self, kind, key=None, size=None, timestamp=None, raw=None):
+        self.kind = kind
+        self.key = key
+        self.size = size
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.raw = raw
+
+    @classmethod
+    def parse(cls, data, timestamp=None):
+        """Return the event in an interrupt message, ``None`` if too short.
+        """
+        if len(data) < 0x10:
+            return None
+        size = None
+        if data[4] in (INT_THUMBNAIL_SIZE, INT_FULL_IMAGE_SIZE):
+            if len(data) >= 0x15:
+                size = le32toi(data, 0x11)
+        return cls(data[4], le32toi(data, 0x0c), size, timestamp,
+                   array('B', data))
+
+    @property
+    def name(self):
+        return self._names.get(self.kind, 'unknown 0x{:02x}'.format(self.kind))
+
+    def __repr__(self):
+        size = '' if self.size is None else ' 0x{:x} b'.format(self.size)
+        return '<CaptureEvent {} key 0x{:x}{}>'.format(self.name, self.key,
+                                                      size)
+
 class TransferMode(Bitfield):
     THUMB_TO_PC    = 0x01
     FULL_TO_PC     = 0x02
@@ -295,6 +349,74 @@ class ShutterReleaseCmd(RemoteControlCommand):
 #    def __init__(self, full_image=None, thumbnail=None):
 #        super(ShutterReleaseCmd, self).__init__()
 
+class ViewfinderStartCmd(RemoteControlCommand):
+    subcmd = 0x02
+    subcmd_resplen = 0x1c
+
+class ViewfinderStopCmd(RemoteControlCommand):
+    subcmd = 0x03
+    subcmd_resplen = 0x1c
+
+class RetrieveCaptureCmd(commands.VariableResponseCommand):
+    """Download a picture sent to the PC, by the key of its interrupts.
+
+    Without a ``target`` the image is returned as a string, else it's
+    written to ``target`` as it arrives.
+
+    """
+    cmd1 = 0x17
+    cmd2 = 0x12
+    THUMBNAIL = 0x01
+    FULL_IMAGE = 0x02
+    def __init__(self, key, target=None, thumbnail=False, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = protocol.MAX_CHUNK_SIZE
+        payload = itole32a(0x00)
+        payload.extend(itole32a(chunk_size))
+        payload.extend(itole32a(self.THUMBNAIL if thumbnail
+                                else self.FULL_IMAGE))
+        payload.extend(itole32a(key))
+        self._target = target
+        self.transfer_chunk_size = chunk_size
+        super(RetrieveCaptureCmd, self).__init__(payload)
+
+    def _parse_response(self, data):
+        return data.tostring()
+
+    def execute(self, usb):
+        if self._target is None:
+            return super(RetrieveCaptureCmd, self).execute(usb)
+        with usb.command_ctx(self.name):
+            out = CoalescingWriter(self._target)
+            for chunk in self._send(usb):
+                out.write(chunk)
+            out.flush()
+
+class RetrievePreviewCmd(RetrieveCaptureCmd):
+    """Get the current viewfinder image as a JPEG, while the viewfinder is
+    on. Asked for like a captured full image without a key.
+    """
+    cmd1 = 0x18
+    cmd2 = 0x12
+    def __init__(self, target=None, chunk_size=None):
+        super(RetrievePreviewCmd, self).__init__(0x00, target, False,
+                                                 chunk_size)
+
+class SettingsStats(object):
+    """Capture settings traffic, ``skipped`` writes were no-ops which
+    weren't sent, saving ``round_trips_avoided`` commands.
+    """
+    def __init__(self):
+        self.writes = 0
+        self.reads = 0
+        self.skipped = 0
+        self.round_trips_avoided = 0
+
+    def __repr__(self):
+        return ('<SettingsStats {0.writes} writes, {0.reads} reads, '
+                '{0.skipped} skipped, {0.round_trips_avoided} round trips '
+                'avoided>'.format(self))
+
 class CanonCapture(object):
     """Manage taking pictures via USB. The whole point.
 
@@ -310,10 +432,77 @@ class CanonCapture(object):
     Drive Mode
     Owner's Name
     """
-    def __init__(self, usb):
+    def __init__(self, usb, storage=None):
         self._usb = usb
+        self._storage = storage
         self._settings = None
+        # a copy of what the camera has, as far as we know
+        self._camera_settings = None
+        self._batching = False
+        self.settings_stats = SettingsStats()
         self._in_rc = False
+        # what we last set, the camera doesn't tell
+        self._transfer_mode = None
+        self._event_lock = threading.Lock()
+        self._event_listeners = []
+        self._event_queues = []
+        usb.add_interrupt_listener(self._interrupt_received)
+
+    def _interrupt_received(self, data):
+        event = CaptureEvent.parse(data)
+        if event is None:
+            return
+        _log.info("capture event: {}".format(event))
+        with self._event_lock:
+            listeners = list(self._event_listeners)
+            for queue in self._event_queues:
+                queue.put(event)
+        for fn in listeners:
+            try:
+                fn(event)
+            except Exception:
+                # keep the poller alive for everyone else
+                _log.exception("capture event listener {!r} failed on {}"
+                               .format(fn, event))
+
+    def add_event_listener(self, fn):
+        """Call ``fn(event)`` with every :class:`CaptureEvent`.
+
+        Events come from the interrupt pipe while it's polled, i.e. during
+        a capture or with ``usb.start_poller()``. Listeners run on the
+        polling thread and should be quick, exceptions from them are
+        logged and otherwise ignored.
+
+        """
+        with self._event_lock:
+            self._event_listeners.append(fn)
+
+    def remove_event_listener(self, fn):
+        with self._event_lock:
+            self._event_listeners.remove(fn)
+
+    def events(self, timeout=None):
+        """Return an iterator over :class:`CaptureEvent` objects.
+
+        Every event from this call on is yielded, the iteration ends when
+        none came for ``timeout`` seconds.
+
+        """
+        queue = Queue()
+        with self._event_lock:
+            self._event_queues.append(queue)
+        return self._iter_events(queue, timeout)
+
+    def _iter_events(self, queue, timeout):
+        try:
+            while True:
+                try:
+                    yield queue.get(timeout=timeout)
+                except Empty:
+                    return
+        finally:
+            with self._event_lock:
+                self._event_queues.remove(queue)
 
     def initialize(self, force=False):
         self.stop()
@@ -342,7 +531,7 @@ class CanonCapture(object):
             self._in_rc = True
 
         # initially set the transfermode to something known
-        self.transfermode = TransferMode.FULL_TO_DRIVE
+        self.transfer_mode = TransferMode.FULL_TO_DRIVE
 
         # wtf is that?
         SetZoomPositionCmd(array('B', [0x04] + [0x00] * 7))
@@ -351,6 +540,8 @@ class CanonCapture(object):
         with self._usb.timeout_ctx(1000):
             ExitRemoteControlCmd().execute(self._usb)
             self._in_rc = False
+            self._transfer_mode = None
+            self._camera_settings = None
 
     @property
     def active(self):
@@ -358,6 +549,8 @@ class CanonCapture(object):
 
     def get_capture_settings(self):
         self._settings = GetCaptureSettingsCmd().execute(self._usb)
+        self._camera_settings = CaptureSettings(self._settings)
+        self.settings_stats.reads += 1
         _log.info("capture settings from camera: {}".format(self._settings))
         return self._settings
 
@@ -380,6 +573,7 @@ class CanonCapture(object):
     @require_active_capture
     def transfer_mode(self, flags):
         SetTransferModeCmd(flags).execute(self._usb)
+        self._transfer_mode = int(flags)
 
     @property
     @require_active_capture
@@ -437,27 +631,152 @@ class CanonCapture(object):
         enabled = bool(enabled)
         self.settings.macro = enabled
         self._set_capture_settings(self.settings)
-        self.get_capture_settings()
 
     @require_active_capture
     def __call__(self):
-        """
+        """Take a picture, return the capture complete
+        :class:`CaptureEvent` or ``None`` if it took too long.
         """
         with self._usb.poller_ctx() as p:
+            mark = p.mark()
             ShutterReleaseCmd().execute(self._usb)
-            now = time.time()
-            while (len(p.received) < 2*0x10):
-                if time.time() - now > 10:
-                    _log.warn("Capture is taking longer than 10 seconds ...")
-                    return
-                time.sleep(1)
+            message = p.wait_for(message_type=INT_CAPTURE_COMPLETE,
+                                 timeout=10, since=mark)
+            if message is None:
+                _log.warn("Capture is taking longer than 10 seconds ...")
+                return
             _log.info("Capture completed")
+            return CaptureEvent.parse(message)
 
-    def _set_capture_settings(self, settings):
-        payload = array('B')
-        payload.extend(itole32a(0x30))
-        payload.extend(settings)
+    @require_active_capture
+    def capture_to_host(self, target=None, thumbnail=False, timeout=10):
+        """Take a picture and download it straight from the camera.
+
+        The transfer mode is switched to send the full image, or only the
+        thumbnail with ``thumbnail``, to the PC, so nothing is written to
+        the card, and back again when done. Returns the image as a string,
+        or writes it to ``target``, a file-like object or file name, and
+        returns the number of bytes.
+
+        """
+        mode = (TransferMode.THUMB_TO_PC if thumbnail
+                else TransferMode.FULL_TO_PC)
+        previous = self._transfer_mode
+        if previous is None:
+            previous = TransferMode.FULL_TO_DRIVE
+        if previous != mode:
+            self.transfer_mode = mode
+        try:
+            return self._capture_to_host(target, thumbnail, timeout)
+        finally:
+            if previous != mode:
+                self.transfer_mode = previous
+
+    def _capture_to_host(self, target, thumbnail, timeout):
+        ready = INT_THUMBNAIL_SIZE if thumbnail else INT_FULL_IMAGE_SIZE
+        with self._usb.poller_ctx() as p:
+            # a running poller holds the messages of earlier shots too
+            mark = p.mark()
+            ShutterReleaseCmd().execute(self._usb)
+            message = p.wait_for(message_type=ready, timeout=timeout,
+                                 since=mark)
+            if message is None:
+                raise CanonError("no image after {} s".format(timeout))
+            event = CaptureEvent.parse(message)
+            if p.wait_for(message_type=INT_CAPTURE_COMPLETE,
+                          timeout=timeout, since=mark) is None:
+                raise CanonError("capture not complete after {} s"
+                                 .format(timeout))
+        _log.info("capture ready on the camera: {}".format(event))
+        if target is None:
+            return RetrieveCaptureCmd(event.key, None, thumbnail,
+                                      self._usb.max_chunk_size
+                                      ).execute(self._usb)
+        close = not hasattr(target, 'write')
+        if close:
+            target = open(target, 'wb')
+        try:
+            cmd = RetrieveCaptureCmd(event.key, target, thumbnail,
+                                     self._usb.max_chunk_size)
+            cmd.execute(self._usb)
+        finally:
+            if close:
+                target.close()
+        return cmd.response_length
+
+    @require_active_capture
+    def timelapse(self, interval, frames=None, duration=None,
+                  target_dir=None, missed=None, on_frame=None):
+        """Take a picture every ``interval`` seconds, see
+        :class:`canon.timelapse.Timelapse`. Returns its stats.
+        """
+        from canon.timelapse import Timelapse, MISSED_SKIP
+        tl = Timelapse(self, interval, frames=frames, duration=duration,
+                       storage=self._storage, target_dir=target_dir,
+                       missed=missed or MISSED_SKIP, on_frame=on_frame)
+        return tl.run()
+
+    @require_active_capture
+    def viewfinder(self, max_fps=None):
+        """Return a :class:`canon.viewfinder.Viewfinder` streaming preview
+        frames, iterate over it or use it as a context manager.
+        """
+        from canon.viewfinder import Viewfinder
+        return Viewfinder(self._usb, max_fps=max_fps)
+
+    @contextmanager
+    @require_active_capture
+    def settings_batch(self, verify=True):
+        """Collect settings changes and send them to the camera at once.
+
+        Within the block changes go to the cached :attr:`settings` only,
+        whether through properties like :attr:`macro` or directly on the
+        yielded :class:`CaptureSettings`. On the way out they are set with
+        a single command if anything changed, and read back once with
+        ``verify``. An exception drops the changes. Batches can be nested,
+        the outermost one sends.
+
+        """
+        settings = self.settings
+        outermost = not self._batching
+        self._batching = True
+        try:
+            yield settings
+        except:
+            if outermost:
+                _log.info("settings batch failed, dropping the changes")
+                self._batching = False
+                self._settings = (CaptureSettings(self._camera_settings)
+                                  if self._camera_settings else None)
+            raise
+        if not outermost:
+            return
+        self._batching = False
+        self._set_capture_settings(self._settings, verify)
+
+    def _set_capture_settings(self, settings, verify=True):
+        if self._batching:
+            # sent at the end of the batch
+            return
+        stats = self.settings_stats
+        if self._camera_settings is not None:
+            changes = settings.diff(self._camera_settings)
+            if not changes:
+                _log.info("capture settings unchanged, not sending them")
+                stats.skipped += 1
+                stats.round_trips_avoided += 2 if verify else 1
+                return
+            _log.info("capture settings changed: {}".format(
+                ', '.join(str(name) for name in sorted(changes))))
         SetCaptureSettingsCmd(settings).execute(self._usb)
-        self.get_capture_settings()
+        stats.writes += 1
+        if not verify:
+            self._settings = settings
+            self._camera_settings = CaptureSettings(settings)
+            return
+        sent = array('B', settings)
+        if array('B', self.get_capture_settings()) != sent:
+            _log.warn("camera did not take all capture settings, asked "
+                      "for {} got {}".format(settings, self._settings))
 
     capture = __call__
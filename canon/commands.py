@@ -109,7 +109,7 @@ class GetPicAbilitiesCmd(FixedResponseCommand):
     resplen = 0x354
     def _parse_response(self, data):
         struct_size = le16toi(data, 0x14)
-        model_id = le32toi(data[0x16:0x1a])
+        model_id = le32toi(data, 0x16)
         camera_name = extract_string(data, 0x1a)
         num_entries = le32toi(data, 0x3a)
         _log.info("abilities of {} (0x{:x}): 0x{:x} long, n={}"
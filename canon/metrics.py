@@ -0,0 +1,245 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Count what the commands cost.
+
+Every :class:`canon.protocol.CanonUSB` keeps a :class:`MetricsRegistry`
+which each command reports to with its latency, the bytes it sent and
+received, the bulk chunks it took and whether it failed::
+
+    cam.storage.sync('photos')
+    for name, m in cam.metrics.commands():
+        print name, m.calls, m.latency.sum
+    open('canon.prom', 'w').write(cam.metrics.to_prometheus())
+
+"""
+
+import json
+import time
+import errno
+import bisect
+import threading
+
+# upper bounds in seconds, Prometheus style
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+class Histogram(object):
+    """Observations counted into buckets of upper ``bounds``.
+    """
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = tuple(bounds)
+        # the last one is +Inf
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Yield ``(bound, observations <= bound)``, ending with +Inf."""
+        total = 0
+        for bound, n in zip(self.bounds + (float('inf'),), self.counts):
+            total += n
+            yield bound, total
+
+    def as_dict(self):
+        return {'buckets': [[b, n] for b, n in self.cumulative()][:-1],
+                'sum': self.sum,
+                'count': self.count}
+
+class CommandMetrics(object):
+    """What one command class did so far."""
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.chunks = 0
+        self.latency = Histogram(bounds)
+
+    def as_dict(self):
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'timeouts': self.timeouts,
+                'bytes_out': self.bytes_out,
+                'bytes_in': self.bytes_in,
+                'chunks': self.chunks,
+                'latency': self.latency.as_dict()}
+
+class LinkMetrics(object):
+    """Running totals of the USB link, counted by :class:`CanonUSB`."""
+    def __init__(self):
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.bulk_reads = 0
+        self.bulk_time = 0.0
+
+    def sent(self, nbytes):
+        self.bytes_out += nbytes
+
+    def received(self, nbytes, seconds=None):
+        """Count ``nbytes`` in, a bulk read if it took ``seconds``."""
+        self.bytes_in += nbytes
+        if seconds is not None:
+            self.bulk_reads += 1
+            self.bulk_time += seconds
+
+    def as_dict(self):
+        return {'bytes_out': self.bytes_out,
+                'bytes_in': self.bytes_in,
+                'bulk_reads': self.bulk_reads,
+                'bulk_time': self.bulk_time}
+
+def _is_timeout(exc):
+    return getattr(exc, 'errno', None) == errno.ETIMEDOUT
+
+class Measurement(object):
+    """One command being timed, see :meth:`MetricsRegistry.measure`.
+
+    Works as a context manager or with an explicit :meth:`finish`, for
+    commands which outlive a ``with`` block.
+
+    """
+    def __init__(self, registry, name):
+        self._registry = registry
+        self.name = name
+        link = registry.link
+        self._out = link.bytes_out
+        self._in = link.bytes_in
+        self._reads = link.bulk_reads
+        self._started = time.time()
+        self._finished = False
+
+    def finish(self, exc=None):
+        if self._finished:
+            return
+        self._finished = True
+        link = self._registry.link
+        self._registry.observe(self.name, time.time() - self._started,
+                               bytes_out=link.bytes_out - self._out,
+                               bytes_in=link.bytes_in - self._in,
+                               chunks=link.bulk_reads - self._reads,
+                               error=exc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(exc)
+
+class MetricsRegistry(object):
+    """Per command class latency histograms and counters.
+
+    Byte and chunk counts of a command are taken from :attr:`link` while
+    the command runs, which is right as long as commands don't overlap;
+    :class:`CanonUSB` makes sure they don't.
+
+    """
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.link = LinkMetrics()
+        self.started = time.time()
+        self._commands = {}
+        self._lock = threading.Lock()
+
+    def command(self, name):
+        """The :class:`CommandMetrics` for ``name``, created if needed."""
+        m = self._commands.get(name)
+        if m is None:
+            with self._lock:
+                m = self._commands.setdefault(name,
+                                              CommandMetrics(self.bounds))
+        return m
+
+    def commands(self):
+        """Return ``(name, CommandMetrics)`` pairs, by name."""
+        with self._lock:
+            return sorted(self._commands.items())
+
+    def measure(self, name):
+        return Measurement(self, name)
+
+    def observe(self, name, seconds, bytes_out=0, bytes_in=0, chunks=0,
+                error=None):
+        m = self.command(name)
+        with self._lock:
+            m.calls += 1
+            m.bytes_out += bytes_out
+            m.bytes_in += bytes_in
+            m.chunks += chunks
+            m.latency.observe(seconds)
+            if error is not None:
+                m.errors += 1
+                if _is_timeout(error):
+                    m.timeouts += 1
+
+    def reset(self):
+        """Forget the commands, :attr:`link` totals keep counting."""
+        with self._lock:
+            self._commands.clear()
+
+    def as_dict(self):
+        with self._lock:
+            return {'uptime': time.time() - self.started,
+                    'link': self.link.as_dict(),
+                    'commands': dict((name, m.as_dict())
+                                     for name, m in self._commands.items())}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), sort_keys=True, **kwargs)
+
+    def to_prometheus(self, prefix='canon'):
+        """Return everything in the Prometheus text exposition format."""
+        lines = []
+        def metric(name, kind, helptext):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, helptext))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+        def sample(name, value, labels=''):
+            lines.append('{}_{}{} {!r}'.format(prefix, name, labels, value))
+
+        commands = self.commands()
+        metric('command_seconds', 'histogram', "Command latency.")
+        for name, m in commands:
+            for bound, n in m.latency.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                sample('command_seconds_bucket', n,
+                       '{{command="{}",le="{}"}}'.format(name, le))
+            label = '{{command="{}"}}'.format(name)
+            sample('command_seconds_sum', m.latency.sum, label)
+            sample('command_seconds_count', m.latency.count, label)
+        for attr, helptext in (('calls', "Commands executed."),
+                               ('errors', "Commands which failed."),
+                               ('timeouts', "Commands which timed out."),
+                               ('bytes_out', "Bytes sent with commands."),
+                               ('bytes_in', "Bytes received for commands."),
+                               ('chunks', "Bulk reads for commands.")):
+            metric('command_{}_total'.format(attr), 'counter', helptext)
+            for name, m in commands:
+                sample('command_{}_total'.format(attr), getattr(m, attr),
+                       '{{command="{}"}}'.format(name))
+        link = self.link
+        for attr, helptext in (('bytes_out', "Bytes sent to the camera."),
+                               ('bytes_in', "Bytes read from the camera."),
+                               ('bulk_reads', "Bulk-in transfers."),
+                               ('bulk_time', "Seconds spent in bulk reads.")):
+            metric('usb_{}_total'.format(attr), 'counter', helptext)
+            sample('usb_{}_total'.format(attr), getattr(link, attr))
+        return '\n'.join(lines) + '\n'
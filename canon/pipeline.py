@@ -0,0 +1,255 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Write downloads to disk while the camera keeps sending.
+
+Without a pipeline every ``write()`` to the target happens between two
+bulk reads, so a slow disk or an fsync holds up the USB pipe. A
+:class:`DownloadPipeline` hands the data to a writer thread through a
+bounded queue, hashing it and fsyncing every so often on the way::
+
+    pipeline = DownloadPipeline(max_queued=16, hash_name='sha1',
+                                fsync_bytes=8 << 20)
+    jobs = [camera.storage.get_file(path, local, pipeline=pipeline)
+            for path, local in todo]
+    for job in jobs:
+        print job.wait().hexdigest
+    pipeline.close()
+    print pipeline.stats
+
+"""
+
+import os
+import sys
+import time
+import hashlib
+import logging
+import threading
+from Queue import Queue
+
+from canon import CanonError
+
+_log = logging.getLogger(__name__)
+
+class PipelineStats(object):
+    """Where the time of a pipeline went, in seconds.
+
+    ``usb`` is time the producer spent between writes, i.e. reading from
+    the camera, ``stalled`` the time it waited for room in the queue.
+    ``write``, ``hash`` and ``fsync`` are spent on the writer thread.
+
+    """
+    def __init__(self):
+        self.usb = 0.0
+        self.stalled = 0.0
+        self.write = 0.0
+        self.hash = 0.0
+        self.fsync = 0.0
+        self.bytes = 0
+        self.chunks = 0
+
+    def __repr__(self):
+        return ("<PipelineStats {0.bytes} b in {0.chunks} chunks: usb "
+                "{0.usb:.3f}s stalled {0.stalled:.3f}s write {0.write:.3f}s "
+                "hash {0.hash:.3f}s fsync {0.fsync:.3f}s>".format(self))
+
+class DownloadJob(object):
+    """One file going through a :class:`DownloadPipeline`.
+
+    Behaves like a file to write to, :meth:`close` queues the end of the
+    file and returns right away, :meth:`wait` blocks until it's on disk.
+
+    """
+    def __init__(self, pipeline, target, close_target=False, on_done=None):
+        self._pipeline = pipeline
+        self.target = target
+        self._close_target = close_target
+        self._on_done = on_done
+        self._hash = (hashlib.new(pipeline.hash_name)
+                      if pipeline.hash_name else None)
+        self._done = threading.Event()
+        self._exc_info = None
+        self._last_write = None
+        self._unsynced = 0
+        self.bytes = 0
+        self.hexdigest = None
+
+    def write(self, data):
+        # the data is usually a reused buffer, the writer gets a copy
+        now = time.time()
+        if self._last_write is not None:
+            self._pipeline.stats.usb += now - self._last_write
+        self._pipeline._put((self, str(data)))
+        self._last_write = time.time()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._pipeline._put((self, None))
+
+    def wait(self, timeout=None):
+        """Wait for the file to be written, return the job.
+
+        Errors from the writer thread are raised here.
+
+        """
+        if not self._done.wait(timeout):
+            raise CanonError("download not written after {} s"
+                             .format(timeout))
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self
+
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def error(self):
+        """What went wrong writing the file, ``None`` if nothing did."""
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    # on the writer thread
+
+    def _write(self, data):
+        stats = self._pipeline.stats
+        started = time.time()
+        self.target.write(data)
+        written = time.time()
+        stats.write += written - started
+        if self._hash is not None:
+            self._hash.update(data)
+            stats.hash += time.time() - written
+        self.bytes += len(data)
+        stats.bytes += len(data)
+        stats.chunks += 1
+        self._unsynced += len(data)
+        fsync_bytes = self._pipeline.fsync_bytes
+        if fsync_bytes and self._unsynced >= fsync_bytes:
+            self._fsync()
+
+    def _fsync(self):
+        started = time.time()
+        self.target.flush()
+        if hasattr(self.target, 'fileno'):
+            os.fsync(self.target.fileno())
+        self._pipeline.stats.fsync += time.time() - started
+        self._unsynced = 0
+
+    def _finish(self):
+        try:
+            if (self._exc_info is None and self._pipeline.fsync_bytes
+                    and self._unsynced):
+                self._fsync()
+        except:
+            self._fail(sys.exc_info())
+        try:
+            if self._close_target:
+                self.target.close()
+        except:
+            self._fail(sys.exc_info())
+        if self._exc_info is None and self._hash is not None:
+            self.hexdigest = self._hash.hexdigest()
+        if self._on_done is not None:
+            try:
+                self._on_done(self, self.error)
+            except:
+                self._fail(sys.exc_info())
+        self._done.set()
+
+    def _fail(self, exc_info):
+        if self._exc_info is None:
+            self._exc_info = exc_info
+
+class DownloadPipeline(object):
+    """A writer thread fed through a queue of at most ``max_queued`` chunks.
+
+    ``hash_name`` is any :mod:`hashlib` algorithm to digest every file
+    with, with ``fsync_bytes`` files are fsynced each time that much was
+    written and when done.
+
+    """
+    def __init__(self, max_queued=16, hash_name=None, fsync_bytes=None):
+        if max_queued < 1:
+            raise ValueError("max_queued must be at least 1")
+        self.max_queued = max_queued
+        self.hash_name = hash_name
+        self.fsync_bytes = fsync_bytes
+        self.stats = PipelineStats()
+        self._queue = Queue(max_queued)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def open(self, target, close_target=False, on_done=None):
+        """Return a :class:`DownloadJob` writing to ``target``.
+
+        ``on_done(job, error)`` is called on the writer thread once the
+        file is done with, ``error`` is the exception writing it failed
+        with or ``None`` if it's all on disk. An exception from
+        ``on_done`` fails the job too.
+
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='canon-pipeline')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        if self.hash_name:
+            # fail here rather than on the writer thread
+            hashlib.new(self.hash_name)
+        return DownloadJob(self, target, close_target, on_done)
+
+    def _put(self, item):
+        if self._queue.full():
+            started = time.time()
+            self._queue.put(item)
+            self.stats.stalled += time.time() - started
+        else:
+            self._queue.put(item)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            job, data = item
+            if data is None:
+                job._finish()
+                continue
+            if job._exc_info is not None:
+                # failed already, drop the rest of the file
+                continue
+            try:
+                job._write(data)
+            except:
+                job._fail(sys.exc_info())
+
+    def close(self):
+        """Let queued writes finish and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+        _log.info("download pipeline: {}".format(self.stats))
+        return self.stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
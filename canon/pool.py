@@ -0,0 +1,164 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Several cameras on one host.
+
+A :class:`CameraPool` gives every camera an :class:`AsyncCamera`, i.e.
+a worker thread of its own, so they all work at the same time. Cameras
+are known by ``'bus-address'`` keys, operations on all of them return a
+:class:`PoolResults` with one :class:`canon.worker.Future` per camera::
+
+    with CameraPool.discover() as pool:
+        pool.initialize().wait()
+        pool.start_capture().wait()
+        shots = pool.capture_all().wait()
+        for key, exc in shots.errors().items():
+            print key, 'failed:', exc
+        pool.sync_all('photos').wait()
+        pool['1-5'].ls().result()
+
+"""
+
+import os
+import logging
+from collections import OrderedDict
+
+from canon import CanonError
+from canon.worker import AsyncCamera
+
+_log = logging.getLogger(__name__)
+
+def camera_key(camera):
+    return '{}-{}'.format(camera.bus, camera.address)
+
+class PoolResults(OrderedDict):
+    """A :class:`canon.worker.Future` per camera key.
+    """
+    def wait(self, timeout=None):
+        """Wait for every camera to finish, return the results.
+
+        Failures are kept in their future, not raised, see :meth:`errors`.
+
+        """
+        for future in self.itervalues():
+            future.exception(timeout)
+        return self
+
+    def results(self):
+        """Return ``{key: result}`` of the cameras which succeeded."""
+        return OrderedDict((key, future.result())
+                           for key, future in self.iteritems()
+                           if future.done() and future.exception() is None)
+
+    def errors(self):
+        """Return ``{key: exception}`` of the cameras which failed."""
+        return OrderedDict((key, future.exception())
+                           for key, future in self.iteritems()
+                           if future.done() and future.exception() is not None)
+
+class CameraPool(object):
+    """:class:`canon.camera.Camera` objects, each on its own worker.
+
+    ``pool[key]`` is the :class:`AsyncCamera` to send calls for one
+    camera to, ``pool.camera(key)`` the camera itself.
+
+    """
+    def __init__(self, cameras):
+        self._cameras = OrderedDict()
+        for camera in cameras:
+            key = camera_key(camera)
+            if key in self._cameras:
+                raise CanonError("two cameras at {}".format(key))
+            self._cameras[key] = AsyncCamera(camera)
+
+    @classmethod
+    def discover(cls, *args, **kwargs):
+        """Make a pool of every camera :func:`canon.camera.find_all`
+        finds, the arguments are passed on."""
+        from canon.camera import find_all
+        cameras = find_all(*args, **kwargs)
+        _log.info("camera pool of {} cameras".format(len(cameras)))
+        return cls(cameras)
+
+    def __getitem__(self, key):
+        return self._cameras[key]
+
+    def __contains__(self, key):
+        return key in self._cameras
+
+    def __iter__(self):
+        return iter(self._cameras)
+
+    def __len__(self):
+        return len(self._cameras)
+
+    def keys(self):
+        return self._cameras.keys()
+
+    def camera(self, key):
+        return self._cameras[key].camera
+
+    def submit(self, key, fn, *args, **kw):
+        """Run ``fn(*args, **kw)`` on the worker of camera ``key``."""
+        return self._cameras[key].submit(fn, *args, **kw)
+
+    def each(self, fn, *args, **kw):
+        """Run ``fn(camera, *args, **kw)`` for every camera at once.
+        """
+        return PoolResults((key, acam.submit(fn, acam.camera, *args, **kw))
+                           for key, acam in self._cameras.iteritems())
+
+    def initialize(self):
+        return self.each(lambda camera: camera.initialize())
+
+    def identify(self):
+        return self.each(lambda camera: camera.identify())
+
+    def start_capture(self):
+        return self.each(lambda camera: camera.capture.start())
+
+    def stop_capture(self):
+        return self.each(lambda camera: camera.capture.stop())
+
+    def capture_all(self):
+        """Release every shutter, results are the capture events."""
+        return self.each(lambda camera: camera.capture())
+
+    def sync_all(self, local_dir, **kwargs):
+        """Sync every card to ``local_dir/<key>``, results are the
+        :class:`canon.storage.SyncReport` objects.
+
+        ``kwargs`` go to :meth:`canon.storage.CanonStorage.sync`.
+
+        """
+        def sync(camera):
+            target = os.path.join(local_dir, camera_key(camera))
+            return camera.storage.sync(target, **kwargs)
+        return self.each(sync)
+
+    def close(self, cleanup=True):
+        """Let queued calls finish and stop the workers, with ``cleanup``
+        the cameras are cleaned up first."""
+        if cleanup:
+            self.each(lambda camera: camera.cleanup()).wait()
+        for acam in self._cameras.itervalues():
+            acam.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -29,23 +29,57 @@ wLength is simply the length of data.
 """
 
 import time
+import struct
 import threading
 import logging
 from array import array
+from itertools import islice
 from contextlib import contextmanager
 
 import usb.util
 from usb.core import USBError
 
 from canon import CanonError
-from canon.util import le32toi, hexdump, itole32a
+from canon.util import le32toi, hexdump, BufferPool, LE32
+from canon.trace import WireTracer, TRACE_IN, TRACE_OUT
+from canon.metrics import MetricsRegistry
 
 _log = logging.getLogger(__name__)
 
 MAX_CHUNK_SIZE = 0x1400
 
+# bounds for CanonUSB.max_chunk_size, chunks must be a multiple of 0x40
+MIN_CHUNK_SIZE = 0x40
+CHUNK_SIZE_LIMIT = 0x100000
+
 COMMANDS = []
 
+# request size and serial at 0x48 in the command header
+_HEADER_TAIL = struct.Struct('<II')
+
+def command_header_template(cmd1, cmd2, cmd3):
+    """Return the parts of a command header which never change.
+
+    The structure is described here
+    http://www.graphics.cornell.edu/~westin/canon/ch03s02.html
+
+    """
+    # we dump a 0x50 (80) byte command block
+    # the first 0x40 of which are some kind of standard header
+    # the next 0x10 seem to be the header for the next layer
+    # but it's all the same for us
+    packet = array('B', '\x00' * 0x50)
+
+    # 0x02 just works, gphoto2 does magic for other camera classes
+    packet[0x40] = 0x02
+
+    packet[0x44] = cmd1
+    # must do this for newer cameras, just a note
+    #packet[0x46] = 0x10 if cmd3 == 0x201 else 0x20
+    packet[0x47] = cmd2
+    LE32.pack_into(packet, 4, cmd3)
+    return packet
+
 class CommandMeta(type):
     def __new__(cls, name, bases, attrs):
         super_new = super(CommandMeta, cls).__new__
@@ -54,6 +88,9 @@ class CommandMeta(type):
             return super_new(cls, name, bases, attrs)
 
         new_class = super_new(cls, name, bases, attrs)
+        if None not in (new_class.cmd1, new_class.cmd2, new_class.cmd3):
+            new_class._header_template = command_header_template(
+                        new_class.cmd1, new_class.cmd2, new_class.cmd3)
         if new_class.is_complete_command():
             COMMANDS.append(new_class)
         return new_class
@@ -87,6 +124,13 @@ class Command(object):
 
     _cmd_serial = 0
 
+    # set by CommandMeta for classes with all of cmd1, cmd2 and cmd3
+    _header_template = None
+
+    # the chunk size the camera was told to send the response in, only
+    # commands which pass one in their payload set it
+    transfer_chunk_size = None
+
     _required_props = ['cmd1', 'cmd2', 'cmd3']
 
     @classmethod
@@ -194,57 +238,42 @@ class Command(object):
     def _construct_command_header(self, payload_length):
         """Return the 0x50 bytes to send down the control pipe.
 
-        The structure is described here
-        http://www.graphics.cornell.edu/~westin/canon/ch03s02.html
+        A copy of the class' header template with the request size and
+        serial filled in, see :func:`command_header_template`.
 
         """
-        request_size = itole32a(payload_length + 0x10)
-
-        # we dump a 0x50 (80) byte command block
-        # the first 0x40 of which are some kind of standard header
-        # the next 0x10 seem to be the header for the next layer
-        # but it's all the same for us
-        packet = array('B', [0] * 0x50)
-
+        packet = self._header_template[:]
         # request size is the total transmitted size - the first 0x40 bytes
-        packet[0:4] = request_size
-
-        # 0x02 just works, gphoto2 does magic for other camera classes
-        packet[0x40] = 0x02
-
-        packet[0x44] = self.cmd1
-        # must do this for newer cameras, just a note
-        #packet[0x46] = 0x10 if self.cmd3 == 0x201 else 0x20
-        packet[0x47] = self.cmd2
-        packet[4:8] = itole32a(self.cmd3)
-        packet[0x48:0x48+4] = request_size # yes, again
-
-        # this must be matched in the response
-        packet[0x4c:0x4c+4] = itole32a(self.serial)
-
+        request_size = payload_length + 0x10
+        LE32.pack_into(packet, 0, request_size)
+        # request size again, then the serial which must be matched
+        # in the response
+        _HEADER_TAIL.pack_into(packet, 0x48, request_size, self.serial)
         return packet
 
     @classmethod
-    def next_chunk_size(cls, remaining):
+    def next_chunk_size(cls, remaining, max_chunk=None):
         """Calculate the size of the next chunk to read.
 
-        See
+        ``max_chunk`` defaults to ``MAX_CHUNK_SIZE``, see
         http://www.graphics.cornell.edu/~westin/canon/ch03s02.html#par.VarXfers
 
         """
-        if remaining > cls.MAX_CHUNK_SIZE:
-            return cls.MAX_CHUNK_SIZE
+        if max_chunk is None:
+            max_chunk = cls.MAX_CHUNK_SIZE
+        if remaining > max_chunk:
+            return max_chunk
         elif remaining > 0x40:
             return (remaining // 0x40) * 0x40
         else:
             return remaining
 
     @classmethod
-    def chunk_sizes(cls, bytes_to_read):
+    def chunk_sizes(cls, bytes_to_read, max_chunk=None):
         """Yield chunk sizes to read.
         """
         while bytes_to_read:
-            chunk = cls.next_chunk_size(bytes_to_read)
+            chunk = cls.next_chunk_size(bytes_to_read, max_chunk)
             bytes_to_read -= chunk
             yield chunk
 
@@ -271,16 +300,30 @@ class Command(object):
         return self._reader(usb, data[0x40:])
 
     def _reader(self, usb, first_chunk):
+        """Yield the response payload in chunks.
+
+        Chunks may be pooled buffers which are reused as soon as the
+        next one is requested, copy them if you need them for longer.
+
+        """
         raise NotImplementedError()
 
     def _parse_response(self, data):
         return data
 
     def execute(self, usb):
-        reader = self._send(usb)
-        data = array('B')
-        for chunk in reader:
-            data.extend(chunk)
+        with usb.command_ctx(self.name):
+            reader = self._send(usb)
+            # the response length is known once the header is in, so
+            # fill one preallocated array instead of growing one chunk
+            # at a time
+            data = array('B', '\x00') * self.response_length
+            pos = 0
+            for chunk in reader:
+                end = pos + len(chunk)
+                data[pos:end] = chunk
+                pos = end
+            del data[pos:]
         return self._parse_response(data)
 
     def __repr__(self):
@@ -297,6 +340,7 @@ class GenericCommand(Command):
         self.cmd1 = cmd1
         self.cmd2 = cmd2
         self.cmd3 = cmd3
+        self._header_template = command_header_template(cmd1, cmd2, cmd3)
         super(GenericCommand, self).__init__(payload, serial)
 
 
@@ -324,8 +368,9 @@ class VariableResponseCommand(Command):
             yield first_chunk
 
         remaining = self.response_length - len(first_chunk)
-        for chunk_size in self.chunk_sizes(remaining):
-            yield usb.bulk_read(chunk_size)
+        sizes = self.chunk_sizes(remaining, self.transfer_chunk_size)
+        for chunk in usb.read_chunks(sizes):
+            yield chunk
 
 class FixedResponseCommand(Command):
     cmd3 = 0x201
@@ -375,33 +420,54 @@ class FixedResponseCommand(Command):
 
         yield first_chunk
 
-        for chunk_size in self.chunk_sizes(remaining):
-            yield usb.bulk_read(chunk_size)
+        sizes = self.chunk_sizes(remaining, self.transfer_chunk_size)
+        for chunk in usb.read_chunks(sizes):
+            yield chunk
 
 
 class InterruptPoller(threading.Thread):
     """Poll the interrupt pipe on a CanonUSB.
 
+    Everything read is appended to :attr:`received`, each read is also
+    kept as one message in :attr:`messages`. Use :meth:`wait_for` to
+    block until something arrives, with a :meth:`mark` taken before
+    whatever should make the camera send it.
+
     This should not be instantiated directly, but via CanonUSB.poller
     """
-    def __init__(self, usb, size=None, chunk=0x10, timeout=None):
+    # messages with a size in them are 0x17 bytes, reads end short
+    def __init__(self, usb, size=None, chunk=0x40, timeout=None):
         threading.Thread.__init__(self)
         self.usb = usb
         self.should_stop = False
         self.size = size
         self.chunk = chunk
         self.received = array('B')
+        self.messages = []
         self.timeout = int(timeout) if timeout is not None else 150
+        self._cond = threading.Condition()
         self.setDaemon(True)
 
     def run(self):
+        try:
+            self._poll()
+        finally:
+            # nothing more is coming, wake up whoever waits
+            with self._cond:
+                self._cond.notify_all()
+
+    def _poll(self):
         errors = 0
         while errors < 10:
             if self.should_stop: return
             try:
+                # blocks for up to self.timeout, no need to sleep
                 chunk = self.usb.interrupt_read(self.chunk, self.timeout)
                 if chunk:
-                    self.received.extend(chunk)
+                    with self._cond:
+                        self.received.extend(chunk)
+                        self.messages.append(chunk)
+                        self._cond.notify_all()
                 if (self.size is not None
                         and len(self.received) >= self.size):
                     _log.info("poller got 0x{:x} bytes, needed 0x{:x}"
@@ -411,7 +477,6 @@ class InterruptPoller(threading.Thread):
                 if self.should_stop:
                     _log.info("poller stop requested, exiting")
                     return
-                time.sleep(0.1)
             except (USBError, ) as e:
                 if e.errno == 110: # timeout, ignore
                     continue
@@ -422,6 +487,54 @@ class InterruptPoller(threading.Thread):
                 errors += 1
         _log.info("poller got too many errors, exiting")
 
+    def mark(self):
+        """Return how much came in so far, for :meth:`wait_for`."""
+        with self._cond:
+            return (len(self.messages), len(self.received))
+
+    def _find(self, size, message_type, since):
+        messages, received = since
+        if size is not None and len(self.received) - received >= size:
+            return self.received[received:]
+        if message_type is not None:
+            for message in islice(self.messages, messages, None):
+                if len(message) > 4 and message[4] == message_type:
+                    return message
+        return None
+
+    def wait_for(self, size=None, message_type=None, timeout=None,
+                 since=None):
+        """Block until ``size`` bytes or a ``message_type`` message came in.
+
+        Only what came in after ``since``, a :meth:`mark`, counts, by
+        default what comes in after this call. A poller may have been
+        running for a while, so take the mark before the command which
+        makes the camera send what's waited for, or it may be missed.
+
+        The message type is byte 4 of an interrupt message. Returns the
+        bytes received since the mark or the message, whatever was waited
+        for, or ``None`` if ``timeout`` seconds passed or the poller
+        stopped first.
+
+        """
+        if size is None and message_type is None:
+            raise ValueError("wait for a size or a message type")
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            if since is None:
+                since = (len(self.messages), len(self.received))
+            while True:
+                found = self._find(size, message_type, since)
+                if found is not None or not self.isAlive():
+                    return found
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                left = deadline - time.time()
+                if left <= 0:
+                    return None
+                self._cond.wait(left)
+
     def stop(self):
         self.should_stop = True
         self.join()
@@ -430,7 +543,7 @@ class CanonUSB(object):
     """USB Link to the camera.
     """
     def __init__(self, device):
-        self.max_chunk_size = MAX_CHUNK_SIZE
+        self._max_chunk_size = MAX_CHUNK_SIZE
         self.device = device
         self.device.default_timeout = 500
         self.iface = iface = device[0][0,0]
@@ -441,6 +554,101 @@ class CanonUSB(object):
         self.ep_int = usb.util.find_descriptor(iface, bEndpointAddress=0x83)
         self._cmd_serial = 0
         self._poller = None
+        self.tracer = None
+        self.buffer_pool = BufferPool()
+        self._interrupt_listeners = []
+        # Held for a whole command, so threads can take turns, and by
+        # whoever wants a few commands in a row. It's re-entrant for
+        # that, but a command must not start while another one's
+        # response is still being read on the same thread, e.g. from the
+        # target of a download -- command_ctx() refuses that, as well as
+        # any command while a streamed response is open.
+        self.lock = threading.RLock()
+        # the command being run and the id and repr of what reads a
+        # streamed response, only changed with the lock held; the reader
+        # itself isn't kept, dropping it must close it
+        self._command = None
+        self._stream = None
+        # when the last command was sent or finished
+        self.last_used = 0.0
+        self.metrics = MetricsRegistry()
+
+    @property
+    def max_chunk_size(self):
+        """Chunk size requested from the camera for file downloads and
+        captured pictures, writable.
+
+        Only commands which tell the camera the chunk size are read in
+        chunks this large, everything else sticks to ``MAX_CHUNK_SIZE``.
+
+        """
+        return self._max_chunk_size
+
+    @max_chunk_size.setter
+    def max_chunk_size(self, size):
+        size = int(size)
+        if (size % 0x40 or size < MIN_CHUNK_SIZE
+                or size > CHUNK_SIZE_LIMIT):
+            raise ValueError("chunk size must be a multiple of 0x40 between "
+                             "0x{:x} and 0x{:x}, not 0x{:x}"
+                             .format(MIN_CHUNK_SIZE, CHUNK_SIZE_LIMIT, size))
+        self._max_chunk_size = size
+
+    def _check_idle(self, name):
+        if self._stream is not None:
+            raise CanonError("{} can't run while {} is open, close it "
+                             "first".format(name, self._stream[1]))
+        if self._command is not None:
+            raise CanonError("{} can't run while the response to {} is "
+                             "being read".format(name, self._command))
+
+    @contextmanager
+    def command_ctx(self, name):
+        """Run the command ``name`` on the link, timed in :attr:`metrics`.
+
+        Waits for other threads to be done, raises :class:`CanonError`
+        if the link is busy with a response on this thread.
+
+        """
+        with self.lock:
+            self._check_idle(name)
+            self._command = name
+            try:
+                with self.metrics.measure(name):
+                    yield
+            finally:
+                self._command = None
+                self.last_used = time.time()
+
+    @property
+    def streaming(self):
+        """Whether a streamed response is open, see :meth:`begin_stream`.
+        """
+        return self._stream is not None
+
+    def begin_stream(self, owner, name):
+        """Reserve the link for ``owner`` to read the response of the
+        command ``name`` at its own pace.
+
+        Every command is refused until :meth:`end_stream` is called with
+        ``owner``, from any thread. Hold :attr:`lock` while sending the
+        command.
+
+        """
+        with self.lock:
+            self._check_idle(name)
+            self._stream = (id(owner), repr(owner))
+
+    def end_stream(self, owner):
+        """Give the link back after a streamed response was read.
+
+        Safe from any thread and more than once.
+
+        """
+        with self.lock:
+            if self._stream is not None and self._stream[0] == id(owner):
+                self._stream = None
+                self.last_used = time.time()
 
     @contextmanager
     def timeout_ctx(self, new):
@@ -492,6 +700,41 @@ class CanonUSB(object):
             _log.info("poller_ctx: <- back in {:.3} ms"
                       .format((time.time() - started) * 1000))
 
+    def add_interrupt_listener(self, fn):
+        """Call ``fn(data)`` with everything read from the interrupt pipe.
+
+        Listeners run on the reading thread, usually the poller's, and
+        exceptions from them are logged and otherwise ignored.
+
+        """
+        self._interrupt_listeners.append(fn)
+
+    def remove_interrupt_listener(self, fn):
+        self._interrupt_listeners.remove(fn)
+
+    def start_trace(self, slots=4096, snaplen=0x200):
+        """Record every transfer in a :class:`canon.trace.WireTracer`.
+        """
+        if self.tracer is not None:
+            raise CanonError("Tracer already started.")
+        self.tracer = WireTracer(slots, snaplen)
+        return self.tracer
+
+    def stop_trace(self):
+        """Stop recording, return the tracer holding what was recorded.
+        """
+        if self.tracer is None:
+            raise CanonError("There's no tracer to stop.")
+        tracer, self.tracer = self.tracer, None
+        return tracer
+
+    def dump_trace(self, target):
+        """Write the active trace to ``target``, see :meth:`WireTracer.dump`.
+        """
+        if self.tracer is None:
+            raise CanonError("Tracing is not enabled.")
+        return self.tracer.dump(target)
+
     def control_read(self, wValue, data_length=0, timeout=None):
         """Read from the control pipe.
 
@@ -501,26 +744,37 @@ class CanonUSB(object):
         """
         #
         bRequest = 0x04 if data_length > 1 else 0x0c
-        _log.info("control_read (req: 0x{:x} wValue: 0x{:x}) reading 0x{:x} bytes"
-                   .format(bRequest, wValue, data_length))
+        if _log.isEnabledFor(logging.INFO):
+            _log.info("control_read (req: 0x{:x} wValue: 0x{:x}) reading "
+                      "0x{:x} bytes".format(bRequest, wValue, data_length))
 
         response = self.device.ctrl_transfer(
                                  0xc0, bRequest, wValue=wValue, wIndex=0,
                                  data_or_wLength=data_length, timeout=timeout)
+        if self.tracer is not None:
+            self.tracer.record(TRACE_IN, 0x00, wValue, response)
+        self.metrics.link.received(len(response))
         if len(response) != data_length:
             raise CanonError("incorrect response length form camera")
-        _log.debug('\n' + hexdump(response))
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('\n' + hexdump(response))
         return response
 
     def control_write(self, wValue, data='', timeout=None):
         # bRequest is 0x4 if length of data is >1, 0x0c otherwise (length >1 ? 0x04 : 0x0C)
         bRequest = 0x04 if len(data) > 1 else 0x0c
-        _log.info("control_write (rt: 0x{:x}, req: 0x{:x}, wValue: 0x{:x}) 0x{:x} bytes"
-                  .format(0x40, bRequest, wValue, len(data)))
-        _log.debug("\n" + hexdump(data))
+        if _log.isEnabledFor(logging.INFO):
+            _log.info("control_write (rt: 0x{:x}, req: 0x{:x}, wValue: 0x{:x}) "
+                      "0x{:x} bytes".format(0x40, bRequest, wValue, len(data)))
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("\n" + hexdump(data))
+        if self.tracer is not None:
+            self.tracer.record(TRACE_OUT, 0x00, wValue, data)
+        self.last_used = time.time()
         # bmRequestType is 0xC0 during read and 0x40 during write.
         i = self.device.ctrl_transfer(0x40, bRequest, wValue=wValue, wIndex=0,
                                       data_or_wLength=data, timeout=timeout)
+        self.metrics.link.sent(i)
         if i != len(data):
             raise CanonError("control write was incomplete")
         return i
@@ -529,18 +783,63 @@ class CanonUSB(object):
         start = time.time()
         data = self.ep_in.read(size, timeout)
         end = time.time()
+        if self.tracer is not None:
+            self.tracer.record(TRACE_IN, 0x81, 0x00, data)
         data_size = len(data)
+        self.metrics.link.received(data_size, end - start)
         if not data_size == size:
             _log.warn("bulk_read: WRONG SIZE: 0x{:x} bytes instead of 0x{:x}"
                       .format(data_size, size))
             _log.debug('\n' + hexdump(data))
             raise CanonError("unexpected data length ({} instead of {})"
                           .format(len(data), size))
-        _log.info("bulk_read got {} (0x{:x}) b in {:.6f} sec"
-                  .format(len(data), len(data), end-start))
-        _log.debug("\n" + hexdump(data))
+        if _log.isEnabledFor(logging.INFO):
+            _log.info("bulk_read got {} (0x{:x}) b in {:.6f} sec"
+                      .format(len(data), len(data), end-start))
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("\n" + hexdump(data))
         return data
 
+    def bulk_read_into(self, buf, timeout=None):
+        """Fill the ``array('B')`` ``buf`` from the bulk-in pipe.
+
+        Exactly ``len(buf)`` bytes are expected, no new buffer is allocated.
+
+        """
+        size = len(buf)
+        start = time.time()
+        data_size = self.ep_in.read(buf, timeout)
+        end = time.time()
+        if self.tracer is not None:
+            self.tracer.record(TRACE_IN, 0x81, 0x00, buffer(buf, 0, data_size))
+        self.metrics.link.received(data_size, end - start)
+        if not data_size == size:
+            _log.warn("bulk_read_into: WRONG SIZE: 0x{:x} bytes instead of "
+                      "0x{:x}".format(data_size, size))
+            raise CanonError("unexpected data length ({} instead of {})"
+                          .format(data_size, size))
+        if _log.isEnabledFor(logging.INFO):
+            _log.info("bulk_read_into got {} (0x{:x}) b in {:.6f} sec"
+                      .format(size, size, end-start))
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("\n" + hexdump(buf))
+        return buf
+
+    def read_chunks(self, sizes, timeout=None):
+        """Read consecutive chunks of the given sizes from the bulk-in pipe.
+
+        Yields buffers from :attr:`buffer_pool`, each one is only valid
+        until the next one is requested.
+
+        """
+        pool = self.buffer_pool
+        for size in sizes:
+            buf = pool.acquire(size)
+            try:
+                yield self.bulk_read_into(buf, timeout)
+            finally:
+                pool.release(buf)
+
     def interrupt_read(self, size, timeout=100, ignore_timeouts=False):
         try:
             data = self.ep_int.read(size, timeout)
@@ -549,9 +848,19 @@ class CanonUSB(object):
                 return array('B')
             raise
         if data is not None and len(data):
-            dlen = len(data)
-            _log.info("interrupt_read: got 0x{:x} bytes".format(dlen))
-            _log.debug("\n" + hexdump(data))
+            if self.tracer is not None:
+                self.tracer.record(TRACE_IN, 0x83, 0x00, data)
+            if _log.isEnabledFor(logging.INFO):
+                _log.info("interrupt_read: got 0x{:x} bytes".format(len(data)))
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug("\n" + hexdump(data))
+            for fn in list(self._interrupt_listeners):
+                try:
+                    fn(data)
+                except Exception:
+                    # the poller must keep going for everyone else
+                    _log.exception("interrupt listener {!r} failed"
+                                   .format(fn))
             return data
         return array('B')
 
@@ -0,0 +1,350 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Replay recorded USB sessions.
+
+A :class:`ReplayDevice` answers the commands sent to it with the responses
+recorded in a usbmon capture (as saved by wireshark or tcpdump) or in a
+:mod:`canon.trace` dump, so the real command classes and
+:class:`canon.camera.Camera` can be run against a session of real hardware
+over and over::
+
+    dev = ReplayDevice.from_pcap('g3_download.pcap')
+    cam = Camera(dev)
+    cam.initialize()
+    cam.storage.get_file('D:\\\\DCIM\\\\100CANON\\\\IMG_0001.JPG', target)
+
+By default responses are served as fast as the host can take them, with
+``realtime=True`` the recorded pacing is kept, scaled by ``speed``.
+
+"""
+
+import time
+import struct
+import logging
+import threading
+from array import array
+
+from canon import CanonError
+from canon.simulator import FakeDevice
+from canon.trace import TraceRecord, TRACE_IN, TRACE_OUT, read_trace
+
+_log = logging.getLogger(__name__)
+
+_PCAP_HEADER = struct.Struct('<IHHiIII')
+_PCAP_RECORD = struct.Struct('<IIII')
+_PCAP_MAGIC = 0xa1b2c3d4
+_PCAP_MAGIC_NSEC = 0xa1b23c4d
+
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+
+# urb id, type, transfer type, endpoint, device, bus, setup flag, data flag,
+# seconds, microseconds, status, length, captured length, setup packet
+_USBMON_HEADER = struct.Struct('<QcBBBHccqiiII8s')
+_USBMON_HEADER_SIZE = {LINKTYPE_USB_LINUX: 48,
+                       LINKTYPE_USB_LINUX_MMAPPED: 64}
+
+_URB_INTERRUPT = 1
+_URB_CONTROL = 2
+_URB_BULK = 3
+
+def _pcap_packets(f):
+    """Yield ``(linktype, timestamp, data)`` for the packets in a pcap file.
+    """
+    header = f.read(_PCAP_HEADER.size)
+    if len(header) != _PCAP_HEADER.size:
+        raise CanonError("not a pcap file")
+    for order in '<>':
+        magic = struct.unpack(order + 'I', header[:4])[0]
+        if magic in (_PCAP_MAGIC, _PCAP_MAGIC_NSEC):
+            break
+    else:
+        raise CanonError("not a pcap file (pcap-ng is not supported)")
+    ts_scale = 1e-9 if magic == _PCAP_MAGIC_NSEC else 1e-6
+    linktype = struct.unpack(order + 'I', header[20:24])[0]
+    record = struct.Struct(order + 'IIII')
+    while True:
+        raw = f.read(record.size)
+        if len(raw) != record.size:
+            return
+        sec, frac, caplen, _ = record.unpack(raw)
+        data = f.read(caplen)
+        if len(data) != caplen:
+            raise CanonError("truncated pcap file")
+        yield linktype, sec + frac * ts_scale, data
+
+def _is_command(urb_type, xfer_type, setup):
+    return (urb_type == 'S' and xfer_type == _URB_CONTROL
+            and setup[0] == '\x40'
+            and struct.unpack_from('<H', setup, 2)[0] == 0x10)
+
+def _camera_device(filename):
+    """Return the number of the first device which got a camera command."""
+    with open(filename, 'rb') as f:
+        for linktype, _, packet in _pcap_packets(f):
+            if linktype not in _USBMON_HEADER_SIZE:
+                raise CanonError("not a usbmon capture (link type {})"
+                                 .format(linktype))
+            header = _USBMON_HEADER.unpack_from(packet)
+            if _is_command(header[1], header[2], header[-1]):
+                return header[4]
+    raise CanonError("no camera traffic in {}".format(filename))
+
+def read_pcap(filename, device=None):
+    """Return the traffic of one device in a usbmon capture.
+
+    The result is a list of :class:`canon.trace.TraceRecord` tuples, just
+    like :func:`canon.trace.read_trace` would give. ``device`` is the
+    device number on the bus, by default the first device which got a
+    camera command is picked.
+
+    """
+    if device is None:
+        device = _camera_device(filename)
+    records = []
+    submits = {}
+    with open(filename, 'rb') as f:
+        for linktype, _, packet in _pcap_packets(f):
+            (urb_id, urb_type, xfer_type, epnum, devnum, _, _, _, ts_sec,
+                ts_usec, _, length, _, setup) = _USBMON_HEADER.unpack_from(
+                                                                    packet)
+            data = packet[_USBMON_HEADER_SIZE[linktype]:]
+            ts = ts_sec + ts_usec * 1e-6
+            if devnum != device:
+                continue
+            if xfer_type == _URB_CONTROL:
+                if urb_type == 'S':
+                    wValue = struct.unpack_from('<H', setup, 2)[0]
+                    if ord(setup[0]) & 0x80:
+                        submits[urb_id] = wValue
+                    elif setup[0] == '\x40':
+                        records.append(TraceRecord(ts, TRACE_OUT, 0x00,
+                                                   wValue, length, data))
+                elif urb_id in submits:
+                    records.append(TraceRecord(ts, TRACE_IN, 0x00,
+                                               submits.pop(urb_id),
+                                               length, data))
+            elif (urb_type == 'C' and epnum & 0x80 and length
+                    and xfer_type in (_URB_BULK, _URB_INTERRUPT)):
+                records.append(TraceRecord(ts, TRACE_IN, epnum, 0x00,
+                                           length, data))
+    return records
+
+def write_pcap(records, target, device=1, bus=1):
+    """Write trace records to ``target`` as a usbmon capture.
+
+    Good for looking at a :mod:`canon.trace` dump with wireshark, and the
+    result can be read back with :func:`read_pcap`.
+
+    """
+    target.write(_PCAP_HEADER.pack(_PCAP_MAGIC, 2, 4, 0, 0, 0xffff,
+                                   LINKTYPE_USB_LINUX_MMAPPED))
+    hdr_size = _USBMON_HEADER_SIZE[LINKTYPE_USB_LINUX_MMAPPED]
+    padding = '\x00' * (hdr_size - _USBMON_HEADER.size)
+
+    def packet(urb_id, urb_type, xfer_type, epnum, ts, length, setup, data):
+        sec = int(ts)
+        usec = int(round((ts - sec) * 1e6))
+        header = _USBMON_HEADER.pack(urb_id, urb_type, xfer_type, epnum,
+                    device, bus, '\x00' if setup else '-',
+                    '\x00' if data else '<', sec, usec, 0, length, len(data),
+                    setup or '\x00' * 8)
+        target.write(_PCAP_RECORD.pack(sec, usec, hdr_size + len(data),
+                                       hdr_size + len(data)))
+        target.write(header + padding + data)
+
+    for urb_id, rec in enumerate(records, 1):
+        data = str(bytearray(rec.data))
+        if rec.endpoint == 0x00:
+            bmRequestType = 0xc0 if rec.direction == TRACE_IN else 0x40
+            bRequest = 0x04 if rec.length > 1 else 0x0c
+            setup = struct.pack('<BBHHH', bmRequestType, bRequest, rec.value,
+                                0, rec.length)
+            if rec.direction == TRACE_IN:
+                packet(urb_id, 'S', _URB_CONTROL, 0x80, rec.timestamp,
+                       rec.length, setup, '')
+                packet(urb_id, 'C', _URB_CONTROL, 0x80, rec.timestamp,
+                       rec.length, None, data)
+            else:
+                packet(urb_id, 'S', _URB_CONTROL, 0x00, rec.timestamp,
+                       rec.length, setup, data)
+                packet(urb_id, 'C', _URB_CONTROL, 0x00, rec.timestamp,
+                       rec.length, None, '')
+        else:
+            xfer_type = _URB_INTERRUPT if rec.endpoint == 0x83 else _URB_BULK
+            packet(urb_id, 'S', xfer_type, rec.endpoint, rec.timestamp,
+                   rec.length, None, '')
+            packet(urb_id, 'C', xfer_type, rec.endpoint, rec.timestamp,
+                   rec.length, None, data)
+
+def _command_key(data):
+    """What a camera command is matched on when its payload differs."""
+    cmd3 = struct.unpack_from('<I', data, 4)[0]
+    key = (ord(data[0x44]), ord(data[0x47]), cmd3)
+    if cmd3 == 0x201:
+        # remote control commands differ in the subcommand only
+        key += (data[0x50:0x54],)
+    return key
+
+def _strip_serial(data):
+    return data[:0x4c] + data[0x50:]
+
+class _Exchange(object):
+    """A control transfer and the bulk and interrupt data that followed it.
+    """
+    def __init__(self, record):
+        self.record = record
+        self.bulk = []
+        self.interrupts = []
+
+def _full_data(record):
+    """The data of ``record`` as a string, zero-padded if it was cut."""
+    data = str(bytearray(record.data))
+    if len(data) < record.length:
+        data += '\x00' * (record.length - len(data))
+    return data
+
+class ReplayDevice(FakeDevice):
+    """A fake G3 answering with the responses of a recorded session.
+
+    Control reads are matched by ``wValue``, camera commands by their
+    payload or, failing that, by command id. The search starts after the
+    last match and wraps around, so a recorded session can be replayed any
+    number of times. Commands without a recorded response raise
+    :class:`canon.CanonError`.
+
+    """
+    def __init__(self, records, realtime=False, speed=1.0, bus=1, address=1):
+        super(ReplayDevice, self).__init__(bus, address)
+        self.realtime = realtime
+        self.speed = speed
+        self._exchanges = []
+        self._cursor = 0
+        self._schedule = []
+        self._served = 0
+        self._started = None
+        self.misses = 0
+        truncated = 0
+        exchange = None
+        for rec in records:
+            if rec.length > len(rec.data):
+                truncated += 1
+            rec = rec._replace(data=_full_data(rec))
+            if rec.endpoint == 0x00:
+                exchange = _Exchange(rec)
+                self._exchanges.append(exchange)
+            elif exchange is None:
+                continue
+            elif rec.endpoint == 0x83:
+                exchange.interrupts.append(rec)
+            else:
+                exchange.bulk.append(rec)
+        if not self._exchanges:
+            raise CanonError("nothing to replay")
+        if truncated:
+            _log.warn("{} records were cut short when recorded, they are "
+                      "padded with zeroes".format(truncated))
+
+    @classmethod
+    def from_pcap(cls, filename, device=None, **kw):
+        return cls(read_pcap(filename, device), **kw)
+
+    @classmethod
+    def from_trace(cls, source, **kw):
+        """Replay a dumped trace, a file name or a file-like object."""
+        if isinstance(source, basestring):
+            with open(source, 'rb') as f:
+                return cls(list(read_trace(f)), **kw)
+        return cls(list(read_trace(source)), **kw)
+
+    def _find(self, match):
+        count = len(self._exchanges)
+        for i in xrange(count):
+            index = (self._cursor + i) % count
+            if match(self._exchanges[index]):
+                self._cursor = index + 1
+                return self._exchanges[index]
+        return None
+
+    def _find_out(self, wValue, data):
+        def is_out(ex):
+            return (ex.record.direction == TRACE_OUT
+                    and ex.record.value == wValue)
+        if wValue != 0x10 or len(data) < 0x50:
+            return self._find(is_out)
+        payload = _strip_serial(data)
+        exchange = self._find(lambda ex: is_out(ex) and
+                              _strip_serial(ex.record.data) == payload)
+        if exchange is None:
+            key = _command_key(data)
+            exchange = self._find(lambda ex: is_out(ex) and
+                               _command_key(ex.record.data) == key)
+            if exchange is not None:
+                self.misses += 1
+        return exchange
+
+    def _play(self, exchange):
+        """Queue what the camera sent after ``exchange``."""
+        start = exchange.record.timestamp
+        self._started = time.time()
+        self._served = 0
+        self._schedule = []
+        end = 0
+        for rec in exchange.bulk:
+            end += len(rec.data)
+            self._schedule.append((end, (rec.timestamp - start) / self.speed))
+        self._queue_bulk(''.join(rec.data for rec in exchange.bulk))
+        for rec in exchange.interrupts:
+            delay = (rec.timestamp - start) / self.speed
+            if self.realtime and delay > 0:
+                t = threading.Timer(delay, self._interrupt, (rec.data,))
+                t.setDaemon(True)
+                t.start()
+            else:
+                self._interrupt(rec.data)
+
+    def _control_in(self, wValue, length):
+        exchange = self._find(lambda ex: ex.record.direction == TRACE_IN
+                                         and ex.record.value == wValue)
+        if exchange is None:
+            raise CanonError("no recorded control read of 0x{:x}"
+                             .format(wValue))
+        self._play(exchange)
+        return array('B', exchange.record.data)
+
+    def _control_out(self, wValue, data):
+        data = data.tostring()
+        exchange = self._find_out(wValue, data)
+        if exchange is None:
+            if wValue == 0x10 and len(data) >= 0x50:
+                raise CanonError("no recorded response to command "
+                                 "0x{:x} 0x{:x} 0x{:x}"
+                                 .format(*_command_key(data)[:3]))
+            raise CanonError("no recorded control write to 0x{:x}"
+                             .format(wValue))
+        self._play(exchange)
+
+    def _bulk_sent(self, nbytes):
+        if not self.realtime:
+            return
+        self._served += nbytes
+        for end, delay in self._schedule:
+            if end >= self._served:
+                left = self._started + delay - time.time()
+                if left > 0:
+                    time.sleep(left)
+                return
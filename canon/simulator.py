@@ -0,0 +1,565 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A PowerShot G3 that lives in memory.
+
+:class:`SimulatedG3` quacks like a :class:`usb.core.Device` closely enough
+for :class:`canon.camera.Camera` to talk normal mode to it: the init
+handshake, fixed and variable length responses, a flash card with a
+directory tree, remote capture and the interrupt messages that go with it.
+Use it to test and benchmark everything above :class:`CanonUSB` without a
+camera::
+
+    sim = SimulatedG3(bandwidth=1000000)
+    sim.add_file('D:\\\\DCIM\\\\100CANON\\\\IMG_0042.JPG', size=0x200000)
+    cam = Camera(sim)
+    cam.initialize()
+
+The responses are modelled after what a G3 sends, as far as
+canon-remote and gphoto2 know.
+
+"""
+
+import time
+import errno
+import struct
+import logging
+import threading
+from array import array
+
+from usb.core import USBError
+
+from canon import commands
+from canon.capture import (INT_SHUTTER_RELEASED, INT_THUMBNAIL_SIZE,
+                           INT_FULL_IMAGE_SIZE, INT_CAPTURE_COMPLETE)
+
+_log = logging.getLogger(__name__)
+
+G3_VENDORID = 0x04a9
+G3_PRODUCTID = 0x306e
+
+# the release parameters of an idle G3
+DEFAULT_SETTINGS = array('B', [32, 3, 1, 0, 100, 0, 0, 0, 1, 255, 0, 0, 3, 1,
+                               3, 48, 0, 255, 0, 255, 0, 0, 0, 127, 255, 255,
+                               64, 0, 40, 0, 112, 0, 24, 24, 255, 255, 24, 0,
+                               56, 0, 230, 0, 154, 3, 230, 0, 32]).tostring()
+
+ATTR_DIR = 0x10
+ATTR_DOWNLOADED = 0x20
+
+TRANSFER_THUMB_TO_PC = 0x01
+TRANSFER_FULL_TO_PC = 0x02
+TRANSFER_FULL_TO_DRIVE = 0x08
+
+def _le32(i):
+    return struct.pack('<I', i)
+
+def fake_jpeg(size, seed=0):
+    """Return ``size`` bytes that start and end like a JPEG."""
+    if size < 4:
+        return '\x00' * size
+    pattern = ''.join(chr((seed + i) & 0xff) for i in xrange(0x100))
+    body = (pattern * (size // 0x100 + 1))[:size - 4]
+    return '\xff\xd8' + body + '\xff\xd9'
+
+class SimulatedFile(object):
+    def __init__(self, name, data='', timestamp=None, attributes=0x00,
+                 thumbnail=None):
+        self.name = name
+        self.data = data
+        self.timestamp = int(time.time() if timestamp is None else timestamp)
+        self.attributes = attributes
+        self.thumbnail = thumbnail
+        self.children = None
+
+    @property
+    def is_dir(self):
+        return self.children is not None
+
+    @property
+    def size(self):
+        return 0 if self.is_dir else len(self.data)
+
+class SimulatedDirectory(SimulatedFile):
+    def __init__(self, name, timestamp=None):
+        super(SimulatedDirectory, self).__init__(name, timestamp=timestamp,
+                                                 attributes=ATTR_DIR)
+        self.children = []
+
+    def child(self, name):
+        for c in self.children:
+            if c.name.upper() == name.upper():
+                return c
+        return None
+
+class _Endpoint(object):
+    def __init__(self, address, attributes, read):
+        self.bEndpointAddress = address
+        self.bmAttributes = attributes
+        self._read = read
+
+    def read(self, size_or_buffer, timeout=None):
+        return self._read(size_or_buffer, timeout)
+
+class _Interface(object):
+    bInterfaceNumber = 0
+    bAlternateSetting = 0
+    def __init__(self, endpoints):
+        self._endpoints = endpoints
+    def __iter__(self):
+        return iter(self._endpoints)
+
+class _Configuration(object):
+    bConfigurationValue = 1
+    def __init__(self, interface):
+        self._interface = interface
+    def __getitem__(self, index):
+        return self._interface
+
+class _Context(object):
+    """What ``usb.util.dispose_resources()`` needs."""
+    def dispose(self, device, close_handle=True):
+        pass
+
+class FakeDevice(object):
+    """The parts of :class:`usb.core.Device` that :class:`CanonUSB` uses.
+
+    Subclasses answer control transfers in ``_control_in()`` and
+    ``_control_out()``, queueing bulk-in data with ``_queue_bulk()`` and
+    interrupt messages with ``_interrupt()``.
+
+    """
+    def __init__(self, bus=1, address=1):
+        self.idVendor = G3_VENDORID
+        self.idProduct = G3_PRODUCTID
+        self.bus = bus
+        self.address = address
+        self.default_timeout = 1000
+
+        self._ctx = _Context()
+        self._configured = False
+        self._lock = threading.Lock()
+        self._bulk = ''
+        self._bulk_pos = 0
+        self._interrupts = []
+        self._interrupt_cond = threading.Condition()
+
+        self.ep_in = _Endpoint(0x81, 0x02, self._bulk_read)
+        self.ep_out = _Endpoint(0x02, 0x02, None)
+        self.ep_int = _Endpoint(0x83, 0x03, self._interrupt_read)
+        self._config = _Configuration(
+                            _Interface([self.ep_in, self.ep_out, self.ep_int]))
+
+    def __getitem__(self, index):
+        return self._config
+
+    def get_active_configuration(self):
+        if not self._configured:
+            raise USBError('Configuration not set', errno=errno.EIO)
+        return self._config
+
+    def set_configuration(self, configuration=None):
+        self._configured = True
+
+    def set_interface_altsetting(self, interface=None, alternate_setting=None):
+        pass
+
+    def clear_halt(self, ep):
+        pass
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0,
+                      data_or_wLength=None, timeout=None):
+        if bmRequestType == 0xc0:
+            return self._control_in(wValue, data_or_wLength)
+        if bmRequestType == 0x40:
+            data = data_or_wLength
+            if not isinstance(data, array):
+                data = array('B', data)
+            self._control_out(wValue, data)
+            return len(data)
+        return 0
+
+    def _control_in(self, wValue, length):
+        raise NotImplementedError()
+
+    def _control_out(self, wValue, data):
+        raise NotImplementedError()
+
+    def _queue_bulk(self, data):
+        with self._lock:
+            self._bulk = self._bulk[self._bulk_pos:] + data
+            self._bulk_pos = 0
+
+    def _bulk_sent(self, nbytes):
+        """Called after ``nbytes`` were read from the bulk-in pipe."""
+        pass
+
+    def _bulk_read(self, size_or_buffer, timeout=None):
+        into = isinstance(size_or_buffer, array)
+        size = len(size_or_buffer) if into else size_or_buffer
+        with self._lock:
+            available = len(self._bulk) - self._bulk_pos
+            if not available:
+                raise USBError('Operation timed out', errno=errno.ETIMEDOUT)
+            data = self._bulk[self._bulk_pos:self._bulk_pos+size]
+            self._bulk_pos += len(data)
+        self._bulk_sent(len(data))
+        if into:
+            size_or_buffer[:len(data)] = array('B', data)
+            return len(data)
+        return array('B', data)
+
+    def _interrupt(self, message):
+        with self._interrupt_cond:
+            self._interrupts.append(message)
+            self._interrupt_cond.notify_all()
+
+    def _interrupt_read(self, size_or_buffer, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        deadline = time.time() + timeout / 1000.0
+        with self._interrupt_cond:
+            while not self._interrupts:
+                left = deadline - time.time()
+                if left <= 0:
+                    raise USBError('Operation timed out',
+                                   errno=errno.ETIMEDOUT)
+                self._interrupt_cond.wait(left)
+            message = self._interrupts[0]
+            if len(message) > size_or_buffer:
+                raise USBError('Overflow', errno=errno.EOVERFLOW)
+            self._interrupts.pop(0)
+        return array('B', message)
+
+class SimulatedG3(FakeDevice):
+    """An in-process stand-in for a USB-attached PowerShot G3.
+
+    ``latency`` is added to every command, in seconds, ``bandwidth`` caps
+    bulk-in throughput in bytes per second, ``capture_delay`` is the time
+    between shutter release and the capture interrupts.
+
+    """
+    model = 'Canon PowerShot G3'
+    firmware_version = (1, 0, 2, 0)
+    drive = 'D:'
+
+    def __init__(self, latency=0.0, bandwidth=None, capture_delay=0.05,
+                 owner='', bus=1, address=1, populate=True):
+        super(SimulatedG3, self).__init__(bus, address)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.capture_delay = capture_delay
+        self.owner = owner
+        self.camera_time = int(time.time())
+        self.settings = DEFAULT_SETTINGS
+        # nowhere until the host sets one, so a host relying on a default
+        # doesn't get away with it
+        self.transfer_mode = 0x00
+        self.awake = False
+        self.in_rc = False
+        self.last_capture = None
+        # key -> (thumbnail, image) sent to the PC
+        self._retrievable = {}
+        self.viewfinder = False
+        self._preview_counter = 0
+        self.commands = []
+        # (path, recurse) of every directory listing asked for
+        self.listings = []
+        self._image_counter = 0
+
+        self.root = SimulatedDirectory(self.drive)
+        if populate:
+            for i in xrange(1, 5):
+                self.add_file('D:\\DCIM\\100CANON\\IMG_{:04d}.JPG'.format(i),
+                              size=0x10000 + i * 0x1234)
+
+    # the filesystem
+
+    def _lookup(self, path):
+        parts = [p for p in path.split('\\') if p]
+        if not parts or parts[0].upper() != self.drive:
+            return None
+        node = self.root
+        for part in parts[1:]:
+            if not node.is_dir:
+                return None
+            node = node.child(part)
+            if node is None:
+                return None
+        return node
+
+    def mkdir(self, path):
+        """Create ``path`` and its parents, return the directory."""
+        node = self.root
+        for part in [p for p in path.split('\\') if p][1:]:
+            child = node.child(part)
+            if child is None:
+                child = SimulatedDirectory(part)
+                node.children.append(child)
+            node = child
+        return node
+
+    def add_file(self, path, data=None, size=None, timestamp=None,
+                 attributes=0x00, thumbnail=None):
+        """Put a file on the card, made up JPEG data if none given."""
+        dirname, _, name = path.rpartition('\\')
+        if data is None:
+            data = fake_jpeg(size if size is not None else 0x10000,
+                             seed=len(path))
+        if thumbnail is None:
+            thumbnail = fake_jpeg(0x1000, seed=len(name))
+        f = SimulatedFile(name, data, timestamp, attributes, thumbnail)
+        self.mkdir(dirname).children.append(f)
+        return f
+
+    def get(self, path):
+        """Return the :class:`SimulatedFile` at ``path`` or ``None``."""
+        return self._lookup(path)
+
+    # the pipes
+
+    def _control_in(self, wValue, length):
+        if wValue == 0x55:
+            data = 'A' if self.awake else 'C'
+        elif wValue == 0x01:
+            data = ''.join(chr(i & 0xff) for i in xrange(0x58))
+        else:
+            data = '\x00' * length
+        return array('B', data[:length])
+
+    def _control_out(self, wValue, data):
+        if wValue == 0x11:
+            # second half of the init handshake
+            self.awake = True
+            self._queue_bulk('\x00' * 0x44)
+            self._interrupt('\x00' * 0x10)
+        elif wValue == 0x10:
+            if self.latency:
+                time.sleep(self.latency)
+            self._command(data)
+
+    def _bulk_sent(self, nbytes):
+        if self.bandwidth:
+            time.sleep(float(nbytes) / self.bandwidth)
+
+    # commands
+
+    def _command(self, packet):
+        packet = packet.tostring()
+        cmd1 = ord(packet[0x44])
+        cmd2 = ord(packet[0x47])
+        cmd3 = struct.unpack_from('<I', packet, 4)[0]
+        serial = packet[0x4c:0x50]
+        payload = packet[0x50:]
+        self.commands.append((cmd1, cmd2, cmd3))
+        handler = self._handlers.get((cmd1, cmd2, cmd3))
+        if handler is None:
+            _log.warn("simulator: unknown command 0x{:x} 0x{:x} 0x{:x}"
+                      .format(cmd1, cmd2, cmd3))
+            handler = (SimulatedG3._fixed_status if cmd3 == 0x201
+                           else SimulatedG3._variable_empty)
+        body = handler(self, payload)
+        if cmd3 == 0x201:
+            self._queue_bulk(self._fixed_response(cmd1, cmd2, cmd3, serial,
+                                                  body))
+        else:
+            header = bytearray(0x40)
+            header[4:6] = _le32(cmd3 + 0x100)[:2]
+            header[6:10] = _le32(len(body))
+            self._queue_bulk(str(header) + body)
+
+    def _fixed_response(self, cmd1, cmd2, cmd3, serial, body):
+        """Wrap the data after the status word into a fixed response."""
+        resplen = 0x14 + len(body)
+        header = bytearray(0x54)
+        header[0:4] = _le32(resplen)
+        header[4:8] = _le32(cmd3 + 0x100)
+        header[0x40] = 0x02
+        header[0x44] = cmd1
+        header[0x47] = cmd2 + 0x10
+        header[0x48:0x4c] = _le32(resplen)
+        header[0x4c:0x50] = serial
+        # status word at 0x50 stays 0x00000000
+        return str(header) + body
+
+    def _fixed_status(self, payload):
+        return ''
+
+    def _variable_empty(self, payload):
+        return ''
+
+    def _identify_camera(self, payload):
+        body = bytearray(0x5c - 0x14)
+        body[0x04:0x08] = ''.join(chr(x) for x in
+                                  reversed(self.firmware_version))
+        body[0x08:0x08+len(self.model)] = self.model
+        body[0x28:0x28+len(self.owner)] = self.owner
+        return str(body)
+
+    def _set_owner(self, payload):
+        self.owner = payload.split('\x00')[0][:0x1f]
+        return ''
+
+    def _get_time(self, payload):
+        return _le32(self.camera_time) + '\x00' * 8
+
+    def _set_time(self, payload):
+        self.camera_time = struct.unpack_from('<I', payload)[0]
+        return ''
+
+    def _power_status(self, payload):
+        # bit 0x20 of the last byte cleared means mains power
+        return '\x06\x00\x00\x00'
+
+    def _pic_abilities(self, payload):
+        body = bytearray(0x354 - 0x14)
+        body[0:2] = _le32(0x340)[:2]
+        body[6:6+len(self.model)] = self.model
+        return str(body)
+
+    def _flash_device(self, payload):
+        return self.drive + '\x00'
+
+    def _list_directory(self, payload):
+        recurse = ord(payload[0])
+        path = payload[1:].split('\x00')[0]
+        self.listings.append((path, recurse))
+        node = self._lookup(path)
+        if node is None or not node.is_dir:
+            return ''
+        out = [self._dir_entry(node, path)]
+        self._list_children(node, 1, recurse, out)
+        out.append('\x00' * 11)
+        return ''.join(out)
+
+    def _list_children(self, node, depth, recurse, out):
+        for child in node.children:
+            if child.is_dir and depth < recurse:
+                out.append(self._dir_entry(child, '.\\' + child.name))
+                self._list_children(child, depth + 1, recurse, out)
+                out.append(self._dir_entry(child, '..'))
+            else:
+                out.append(self._dir_entry(child, child.name))
+
+    @staticmethod
+    def _dir_entry(node, name):
+        return (struct.pack('<BBII', node.attributes, 0, node.size,
+                            node.timestamp) + name + '\x00')
+
+    def _get_file(self, payload):
+        thumbnail = ord(payload[0]) == 0x01
+        path = payload[8:].split('\x00')[0]
+        node = self._lookup(path)
+        if node is None or node.is_dir:
+            return ''
+        return node.thumbnail if thumbnail else node.data
+
+    def _set_attributes(self, payload):
+        attributes = struct.unpack_from('<I', payload)[0]
+        dirname, name = payload[4:].split('\x00')[:2]
+        node = self._lookup(dirname + '\\' + name)
+        if node is not None:
+            node.attributes = attributes & 0xff
+        return ''
+
+    def _remote_control(self, payload):
+        subcmd = struct.unpack_from('<I', payload)[0]
+        resplen = 0x1c
+        for name in dir(commands):
+            rc = getattr(commands, name)
+            if (name.startswith('RC_') and isinstance(rc, dict)
+                    and rc.get('value') == subcmd and rc['return_length']):
+                resplen = rc['return_length']
+        body = bytearray(resplen - 0x14)
+        if subcmd == 0x00:
+            self.in_rc = True
+        elif subcmd == 0x01:
+            self.in_rc = False
+        elif subcmd == 0x07:
+            self.settings = payload[8:8+len(DEFAULT_SETTINGS)]
+        elif subcmd == 0x09:
+            self.transfer_mode = ord(payload[8])
+        elif subcmd == 0x0a:
+            body[0x1c-0x14:0x1c-0x14+len(self.settings)] = self.settings
+        elif subcmd == 0x02:
+            self.viewfinder = True
+        elif subcmd == 0x03:
+            self.viewfinder = False
+        elif subcmd == 0x04:
+            timer = threading.Timer(self.capture_delay, self._release)
+            timer.daemon = True
+            timer.start()
+        return str(body)
+
+    def _retrieve_capture(self, payload):
+        kind, key = struct.unpack_from('<II', payload, 8)
+        images = self._retrievable.get(key)
+        if images is None:
+            return ''
+        return images[0] if kind == 0x01 else images[1]
+
+    def _retrieve_preview(self, payload):
+        if not self.viewfinder:
+            return ''
+        self._preview_counter += 1
+        return fake_jpeg(0x2000, seed=self._preview_counter)
+
+    def _release(self):
+        """Take a picture, as far as anyone can tell."""
+        self._image_counter += 1
+        key = 0x1000 + self._image_counter
+        self._interrupt(self._int_message(INT_SHUTTER_RELEASED, 0x1c))
+        self.last_capture = fake_jpeg(0x20000, seed=self._image_counter)
+        thumbnail = fake_jpeg(0x1000, seed=self._image_counter)
+        if self.transfer_mode & (TRANSFER_THUMB_TO_PC | TRANSFER_FULL_TO_PC):
+            self._retrievable[key] = (thumbnail, self.last_capture)
+        if self.transfer_mode & TRANSFER_THUMB_TO_PC:
+            self._interrupt(self._int_message(INT_THUMBNAIL_SIZE, key,
+                                              size=len(thumbnail)))
+        if self.transfer_mode & TRANSFER_FULL_TO_PC:
+            self._interrupt(self._int_message(INT_FULL_IMAGE_SIZE, key,
+                                              size=len(self.last_capture)))
+        if self.transfer_mode & TRANSFER_FULL_TO_DRIVE:
+            folder = self.mkdir('D:\\DCIM\\100CANON')
+            name = 'IMG_{:04d}.JPG'.format(len(folder.children) + 1)
+            self.add_file('D:\\DCIM\\100CANON\\' + name,
+                          data=self.last_capture)
+        self._interrupt(self._int_message(INT_CAPTURE_COMPLETE, key))
+
+    @staticmethod
+    def _int_message(kind, key, size=None):
+        message = bytearray(0x10 if size is None else 0x17)
+        message[4] = kind
+        message[0x0c:0x10] = _le32(key)
+        if size is not None:
+            message[0x11:0x15] = _le32(size)
+        return str(message)
+
+    _handlers = {
+        (0x01, 0x12, 0x201): _identify_camera,
+        (0x05, 0x12, 0x201): _set_owner,
+        (0x03, 0x12, 0x201): _get_time,
+        (0x04, 0x12, 0x201): _set_time,
+        (0x0a, 0x12, 0x201): _power_status,
+        (0x1f, 0x12, 0x201): _pic_abilities,
+        (0x20, 0x12, 0x201): _fixed_status,
+        (0x13, 0x12, 0x201): _remote_control,
+        (0x0a, 0x11, 0x202): _flash_device,
+        (0x0b, 0x11, 0x202): _list_directory,
+        (0x01, 0x11, 0x202): _get_file,
+        (0x0e, 0x11, 0x201): _set_attributes,
+        (0x17, 0x12, 0x202): _retrieve_capture,
+        (0x18, 0x12, 0x202): _retrieve_preview,
+    }
@@ -14,16 +14,27 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import os
+import json
+import time
+import struct
 import logging
+import threading
+from StringIO import StringIO
 
-from canon import protocol, commands
-from canon.util import extract_string, le32toi, itole32a
+from canon import protocol, commands, CanonError
+from canon.capture import INT_CAPTURE_COMPLETE
+from canon.util import itole32a, CoalescingWriter
 from canon.bitfield import BooleanFlag, Bitfield
 from array import array
 import itertools
 
 _log = logging.getLogger(__name__)
 
+# attributes, unknown, size, timestamp; the NUL-terminated name follows
+_ENTRY_HEADER = struct.Struct('<BxII')
+
 class FSAttributes(Bitfield):
 
     _size = 0x01
@@ -52,12 +63,20 @@ class FSEntry(object):
         self.name = name
         self.size = size
         self.timestamp = timestamp
-        if not isinstance(attributes, FSAttributes):
+        # an int straight from a listing is only made into FSAttributes
+        # when needed, that's most of the cost of parsing a big listing
+        if not isinstance(attributes, (int, FSAttributes)):
             attributes = FSAttributes(attributes)
-        self.attr = attributes
+        self._attr = attributes
         self.children = []
         self.parent = None
 
+    @property
+    def attr(self):
+        if isinstance(self._attr, int):
+            self._attr = FSAttributes([self._attr])
+        return self._attr
+
     @property
     def full_path(self):
         if self.parent is None:
@@ -69,15 +88,18 @@ class FSEntry(object):
 
     @property
     def type_(self):
-        return 'd' if self.attr.is_dir else 'f'
+        return 'd' if self.is_dir else 'f'
 
     @property
     def is_dir(self):
-        return self.attr.is_dir
+        if isinstance(self._attr, int):
+            return self._attr in (FSAttributes.RECURSE_DIR,
+                                  FSAttributes.NONRECURSE_DIR)
+        return self._attr.is_dir
 
     @property
     def is_file(self):
-        return not self.attr.is_dir
+        return not self.is_dir
 
     def __iter__(self):
         yield self
@@ -90,41 +112,256 @@ class FSEntry(object):
     def __str__(self):
         return self.full_path
 
+def _copy_entry(entry):
+    attributes = entry._attr
+    if not isinstance(attributes, int):
+        attributes = attributes[0]
+    return FSEntry(entry.name, attributes, entry.size, entry.timestamp)
+
+def _copy_tree(entry):
+    """Copy ``entry`` and everything below it.
+
+    The parents of the copy are copied without their other children, just
+    so its :attr:`FSEntry.full_path` stays the same.
+
+    """
+    root = _copy_entry(entry)
+    new, parent = root, entry.parent
+    while parent is not None:
+        new.parent = _copy_entry(parent)
+        new, parent = new.parent, parent.parent
+    queue = [(entry, root)]
+    while queue:
+        entry, new = queue.pop()
+        for child in entry.children:
+            new_child = _copy_entry(child)
+            new_child.parent = new
+            new.children.append(new_child)
+            if child.children:
+                queue.append((child, new_child))
+    return root
+
+_DIR_ATTRIBUTES = (FSAttributes.RECURSE_DIR, FSAttributes.NONRECURSE_DIR)
+
+class StorageIndex(object):
+    """A directory listing packed into a few flat arrays.
+
+    Entries are numbered in listing order, 0 is the listed directory,
+    and a directory is followed by everything below it. ``end(i)`` is one
+    past the last entry below ``i``, so subtrees are ranges and the
+    queries below don't need a tree of objects.
+
+    Names live in one string, full paths are built and interned for all
+    entries on the first call to :meth:`path`.
+
+    """
+    def __init__(self):
+        self._names = ''
+        self._name_offsets = array('I', [0])
+        self._sizes = array('I')
+        self._timestamps = array('I')
+        self._attributes = array('B')
+        self._parents = array('i')
+        self._ends = array('I')
+        self._paths = None
+        self._by_path = None
+
+    @classmethod
+    def from_listing(cls, data):
+        """Build an index from a raw :class:`ListDirectoryCmd` response.
+        """
+        index = cls()
+        raw = data.tostring()
+        find = raw.find
+        unpack_from = _ENTRY_HEADER.unpack_from
+        names = []
+        name_offsets = index._name_offsets
+        sizes = index._sizes
+        timestamps = index._timestamps
+        attributes = index._attributes
+        parents = index._parents
+        ends = index._ends
+        stack = []
+        offset = 0
+        pos = 0
+        while True:
+            start = pos + 10
+            end = find('\x00', start)
+            if end <= start:
+                break
+            name = raw[start:end]
+            if name == '..':
+                if stack:
+                    ends[stack.pop()] = len(sizes)
+                pos = end + 1
+                continue
+            attr, size, timestamp = unpack_from(raw, pos)
+            pos = end + 1
+            i = len(sizes)
+            parents.append(stack[-1] if stack else -1)
+            if not i:
+                stack.append(i)
+            elif name.startswith('.\\'):
+                name = name[2:]
+                stack.append(i)
+            names.append(name)
+            offset += len(name)
+            name_offsets.append(offset)
+            sizes.append(size)
+            timestamps.append(timestamp)
+            attributes.append(attr)
+            ends.append(i + 1)
+        count = len(sizes)
+        for i in stack:
+            ends[i] = count
+        index._names = ''.join(names)
+        return index
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __iter__(self):
+        return iter(xrange(len(self._sizes)))
+
+    def name(self, i):
+        return self._names[self._name_offsets[i]:self._name_offsets[i+1]]
+
+    def path(self, i):
+        if self._paths is None:
+            paths = []
+            for j in xrange(len(self._sizes)):
+                parent = self._parents[j]
+                if parent < 0:
+                    paths.append(intern(self.name(j)))
+                else:
+                    paths.append(intern(paths[parent] + '\\' + self.name(j)))
+            self._paths = paths
+        return self._paths[i]
+
+    def find(self, path):
+        """Return the index of ``path`` or ``None``."""
+        if self._by_path is None:
+            self.path(0)
+            self._by_path = dict((p, i) for i, p in enumerate(self._paths))
+        return self._by_path.get(path)
+
+    def size(self, i):
+        return self._sizes[i]
+
+    def timestamp(self, i):
+        return self._timestamps[i]
+
+    def attributes(self, i):
+        return FSAttributes([self._attributes[i]])
+
+    def parent(self, i):
+        parent = self._parents[i]
+        return None if parent < 0 else parent
+
+    def end(self, i):
+        return self._ends[i]
+
+    def is_dir(self, i):
+        return self._attributes[i] in _DIR_ATTRIBUTES
+
+    def children(self, i=0):
+        """Yield the entries right below ``i``."""
+        j = i + 1
+        end = self._ends[i]
+        while j < end:
+            yield j
+            j = self._ends[j]
+
+    def files(self, i=0):
+        """Return the files anywhere below ``i``."""
+        attributes = self._attributes
+        return [j for j in xrange(i + 1, self._ends[i])
+                if attributes[j] not in _DIR_ATTRIBUTES]
+
+    def total_size(self, i=0):
+        """Return the bytes in files anywhere below ``i``."""
+        sizes = self._sizes
+        return sum(sizes[j] for j in self.files(i))
+
+    def directory_sizes(self):
+        """Return ``{path: bytes in files below it}`` for all directories.
+        """
+        totals = [0] * len(self._sizes)
+        attributes = self._attributes
+        parents = self._parents
+        # children come after their parents, so one backwards pass adds up
+        for j in xrange(len(totals) - 1, 0, -1):
+            if attributes[j] not in _DIR_ATTRIBUTES:
+                totals[j] = self._sizes[j]
+            totals[parents[j]] += totals[j]
+        return dict((self.path(j), totals[j]) for j in xrange(len(totals))
+                    if attributes[j] in _DIR_ATTRIBUTES or not j)
+
+    def newer_than(self, timestamp, i=0):
+        """Return the files below ``i`` with a later timestamp."""
+        timestamps = self._timestamps
+        return [j for j in self.files(i) if timestamps[j] > timestamp]
+
+    def not_downloaded(self, i=0):
+        """Return the files below ``i`` not marked as downloaded."""
+        attributes = self._attributes
+        return [j for j in self.files(i)
+                if not attributes[j] & FSAttributes.DOWNLOADED]
+
+    def entry(self, i):
+        """Return a detached :class:`FSEntry` for ``i``, named by path."""
+        return FSEntry(self.path(i), self._attributes[i], self._sizes[i],
+                       self._timestamps[i])
+
 class ListDirectoryCmd(commands.VariableResponseCommand):
     cmd1 = 0x0b
     cmd2 = 0x11
-    def __init__(self, path=None, recurse=12):
+    def __init__(self, path=None, recurse=12, index=False):
+        self._index = index
         payload = array('B', [recurse])
         payload.extend(array('B', path))
         payload.extend(array('B', [0x00] * 3))
         super(ListDirectoryCmd, self).__init__(payload)
 
-    def _entry_generator(self, data):
+    def _parse_response(self, data):
+        """Build the :class:`FSEntry` tree in one pass over the listing.
+
+        Each entry is a 10-byte header followed by a NUL-terminated name,
+        ``.\\NAME`` enters directory ``NAME`` and ``..`` leaves it.
+
+        """
+        if self._index:
+            return StorageIndex.from_listing(data)
+        raw = data.tostring()
+        find = raw.find
+        unpack_from = _ENTRY_HEADER.unpack_from
+        log_entries = _log.isEnabledFor(logging.INFO)
+        root = current = None
         idx = 0
         while True:
-            name = extract_string(data, idx+10)
-            if not name:
-                raise StopIteration()
-            entry = FSEntry(name, attributes=data[idx:idx+1],
-                            size=le32toi(data[idx+2:idx+6]),
-                            timestamp=le32toi(data[idx+6:idx+10]))
-            idx += entry.entry_size
-            yield entry
-
-    def _parse_response(self, data):
-        entry_generator = self._entry_generator(data)
-        root = entry_generator.next()
-        current = root
-        for entry in entry_generator:
-            if entry.name == '..':
+            start = idx + 10
+            end = find('\x00', start)
+            if end <= start:
+                # no more names, or an empty one
+                break
+            name = raw[start:end]
+            if name == '..':
                 current = current.parent
+                idx = end + 1
+                continue
+            attr, size, timestamp = unpack_from(raw, idx)
+            entry = FSEntry(name, attr, size, timestamp)
+            idx = end + 1
+            if root is None:
+                root = current = entry
                 continue
             current.children.append(entry)
             entry.parent = current
-            if entry.name.startswith('.\\'):
-                entry.name = entry.name[2:]
+            if name.startswith('.\\'):
+                entry.name = name[2:]
                 current = entry
-            _log.info(entry)
+            if log_entries:
+                _log.info(entry)
 
         return root
 
@@ -132,24 +369,191 @@ class ListDirectoryCmd(commands.VariableResponseCommand):
 class GetFileCmd(commands.VariableResponseCommand):
     cmd1 = 0x01
     cmd2 = 0x11
-    def __init__(self, path, target, thumbnail=False):
+    def __init__(self, path, target, thumbnail=False, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = protocol.MAX_CHUNK_SIZE
         payload = array('B', [0x00]*8)
         payload[0] = 0x01 if thumbnail else 0x00
-        payload[4:8] = itole32a(protocol.MAX_CHUNK_SIZE)
+        payload[4:8] = itole32a(chunk_size)
         payload.extend(array('B', path))
         payload.append(0x00)
         self._target = target
+        self.transfer_chunk_size = chunk_size
         super(GetFileCmd, self).__init__(payload)
     def execute(self, usb):
-        reader = self._send(usb)
-        for chunk in reader:
-            self._target.write(chunk)
+        with usb.command_ctx(self.name):
+            reader = self._send(usb)
+            out = CoalescingWriter(self._target)
+            for chunk in reader:
+                out.write(chunk)
+            out.flush()
+
+class CameraFile(io.RawIOBase):
+    """A camera file read as it comes down the USB pipe.
+
+    Other commands are refused with a :class:`CanonError` until the file
+    is closed, from any thread. Closing early still has to read the rest
+    of it, a file can be closed from any thread.
+
+    Iterating yields ``buffer`` objects over the chunks as they arrive,
+    each one is only valid until the next one is requested.
+
+    """
+    def __init__(self, usb, path, thumbnail=False, chunk_size=None):
+        super(CameraFile, self).__init__()
+        self.name = path
+        self._usb = None
+        cmd = GetFileCmd(path, None, thumbnail, chunk_size)
+        with usb.lock:
+            usb.begin_stream(self, cmd.name)
+            self._measurement = usb.metrics.measure(cmd.name)
+            try:
+                self._chunks = cmd._send(usb)
+            except Exception, e:
+                self._measurement.finish(e)
+                usb.end_stream(self)
+                raise
+        self._usb = usb
+        self.size = cmd.response_length
+        self._chunk = None
+        self._chunk_pos = 0
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._offset
+
+    def _next_chunk(self):
+        try:
+            self._chunk = next(self._chunks)
+        except StopIteration:
+            self._chunk = None
+        self._chunk_pos = 0
+        return self._chunk
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        chunk = self._chunk
+        while chunk is None or self._chunk_pos >= len(chunk):
+            chunk = self._next_chunk()
+            if chunk is None:
+                return 0
+        n = min(len(b), len(chunk) - self._chunk_pos)
+        b[:n] = buffer(chunk, self._chunk_pos, n)
+        self._chunk_pos += n
+        self._offset += n
+        return n
+
+    def __iter__(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self._chunk is not None and self._chunk_pos < len(self._chunk):
+            # what's left of a chunk partly read
+            rest = buffer(self._chunk, self._chunk_pos)
+            self._chunk_pos = len(self._chunk)
+            self._offset += len(rest)
+            yield rest
+        while self._next_chunk() is not None:
+            self._chunk_pos = len(self._chunk)
+            self._offset += len(self._chunk)
+            yield buffer(self._chunk)
+
+    def close(self):
+        usb, self._usb = self._usb, None
+        if usb is not None:
+            try:
+                # the camera sends the whole file no matter what
+                for _ in self._chunks:
+                    pass
+                self._chunk = None
+            except Exception, e:
+                self._measurement.finish(e)
+                raise
+            finally:
+                self._measurement.finish()
+                usb.end_stream(self)
+        super(CameraFile, self).close()
 
+    def __repr__(self):
+        return "<CameraFile '{}'>".format(self.name)
+
+class SetFileAttributesCmd(commands.FixedResponseCommand):
+    """Set the attribute byte of a file, e.g. to mark it downloaded.
+    """
+    cmd1 = commands.SET_ATTR['cmd1']
+    cmd2 = commands.SET_ATTR['cmd2']
+    resplen = commands.SET_ATTR['return_length'] - 0x40
+    def __init__(self, path, attributes):
+        dirname, _, name = path.rpartition('\\')
+        payload = itole32a(int(attributes))
+        # the directory and the file name, like gphoto2 sends them
+        payload.extend(array('B', dirname + '\x00' + name + '\x00\x00'))
+        super(SetFileAttributesCmd, self).__init__(payload)
+
+    def _parse_response(self, data):
+        return self.status
+
+class SyncReport(object):
+    """What :meth:`CanonStorage.sync` did."""
+    def __init__(self):
+        self.downloaded = []
+        self.skipped = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        """Download speed in bytes per second."""
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return ("<SyncReport {} downloaded ({} b, {:.0f} b/s), {} skipped>"
+                .format(len(self.downloaded), self.bytes, self.throughput,
+                        self.skipped))
+
+SYNC_MANIFEST = '.canon-sync.json'
+
+# what ls() lists by default, deep enough for the whole card
+FULL_DEPTH = 12
+
+# Canon cameras start a new DCIM folder every 100 images
+FOLDER_CAPACITY = 100
+
+# seconds a cached listing of the card is trusted for
+CACHE_TTL = 10.0
 
 class CanonStorage(object):
-    def __init__(self, usb):
+    """Filesystem operations on the camera's storage.
+
+    Full-depth listings and lookups are served from a tree of the whole
+    card kept in memory. The tree is re-read after ``cache_ttl`` seconds
+    or on :meth:`refresh`. A capture-complete interrupt only marks the
+    DCIM folder the picture went to, which is re-listed on its own when
+    next needed. Anything else changing the card, another client or a
+    card swap, goes unnoticed until the tree expires, so the default TTL
+    is short; call :meth:`refresh` after such changes. A ``cache_ttl`` of
+    0 or ``None`` turns caching off.
+
+    Entries handed out are copies, the cached tree stays as it is.
+
+    """
+    def __init__(self, usb, cache_ttl=CACHE_TTL, thumbnail_cache=None):
         self._usb = usb
         self._drive = None
+        self.cache_ttl = cache_ttl
+        self.thumbnail_cache = thumbnail_cache
+        self._prefetcher = None
+        self._cache_lock = threading.RLock()
+        self._tree = None
+        self._tree_time = 0
+        self._by_path = {}
+        self._stale = set()
+        # set from the interrupt listener, handled on the next lookup
+        self._capture_pending = False
+        usb.add_interrupt_listener(self._interrupt_received)
 
     def initialize(self, force=False):
         self.get_drive()
@@ -170,14 +574,166 @@ class CanonStorage(object):
             self.get_drive()
         return self._drive
 
-    def ls(self, path=None, recurse=12):
+    def ls(self, path=None, recurse=FULL_DEPTH, index=False):
         """Return a class:`FSEntry` for the path or storage root.
 
         By default this will return the tree starting at ``path`` with large
         enough recursion depth to cover every file on the camera storage.
+        With ``index`` a :class:`StorageIndex` is returned instead, which is
+        much lighter for cards with many files.
         """
         path = self._normalize_path(path)
-        return ListDirectoryCmd(path, recurse).execute(self._usb)
+        if self.cache_ttl and not index and recurse >= FULL_DEPTH:
+            with self._cache_lock:
+                entry = self._lookup(path)
+                if entry is not None and entry.is_dir:
+                    return _copy_tree(entry)
+        return ListDirectoryCmd(path, recurse, index).execute(self._usb)
+
+    def lookup(self, path):
+        """Return the :class:`FSEntry` for ``path`` or ``None``.
+
+        The whole card is listed for it unless the tree is cached.
+
+        """
+        with self._cache_lock:
+            entry = self._lookup(self._normalize_path(path))
+            return _copy_tree(entry) if entry is not None else None
+
+    def _lookup(self, path):
+        """The cached entry of a normalized path, hold the cache lock."""
+        self._update_cache()
+        return self._by_path.get(path)
+
+    def latest_capture(self):
+        """Return the :class:`FSEntry` of the newest picture in DCIM.
+
+        Only the folder the last picture went to is re-listed for it, the
+        whole card just when there's no tree cached yet.
+
+        """
+        if not self.cache_ttl:
+            return self._list_latest_capture()
+        with self._cache_lock:
+            if self._tree is None:
+                self._reload()
+            else:
+                # whether or not the interrupt was seen, a picture only
+                # changes the folder it went to
+                self._capture_pending = False
+                self._stale.add(self._capture_folder())
+                while self._stale:
+                    self._relist(self._stale.pop())
+            dcim = self._by_path.get(self.drive + '\\DCIM')
+            if dcim is None:
+                return None
+            folders = [e for e in dcim.children if e.is_dir]
+            for folder in sorted(folders, key=lambda e: e.name,
+                                 reverse=True):
+                files = [e for e in folder.children if e.is_file]
+                if files:
+                    return _copy_tree(max(files, key=lambda e: e.name))
+        return None
+
+    def _list_latest_capture(self):
+        """:meth:`latest_capture` without a cache, a level at a time."""
+        dcim = ListDirectoryCmd(self.drive + '\\DCIM', 1).execute(self._usb)
+        if dcim is None:
+            return None
+        folders = [e for e in dcim.children if e.is_dir]
+        for folder in sorted(folders, key=lambda e: e.name, reverse=True):
+            folder = ListDirectoryCmd(folder.full_path, 1).execute(self._usb)
+            files = [e for e in folder.children if e.is_file]
+            if files:
+                return max(files, key=lambda e: e.name)
+        return None
+
+    def refresh(self, path=None):
+        """Re-read the cached tree, or just the directory at ``path``.
+        """
+        with self._cache_lock:
+            if path is None:
+                self._reload()
+            else:
+                self._relist(self._normalize_path(path))
+
+    def invalidate(self, path=None):
+        """Have the cached tree or the directory ``path`` re-read when
+        next needed."""
+        with self._cache_lock:
+            if path is None:
+                self._tree = None
+                self._by_path = {}
+                self._stale.clear()
+            else:
+                self._stale.add(self._normalize_path(path))
+
+    def _interrupt_received(self, data):
+        if len(data) > 4 and data[4] == INT_CAPTURE_COMPLETE:
+            self._capture_pending = True
+
+    def _update_cache(self):
+        if (self._tree is None or not self.cache_ttl
+                or time.time() - self._tree_time > self.cache_ttl):
+            self._reload()
+            return
+        if self._capture_pending:
+            self._capture_pending = False
+            self._stale.add(self._capture_folder())
+        while self._stale:
+            self._relist(self._stale.pop())
+
+    def _capture_folder(self):
+        """Where the last picture most likely went."""
+        dcim = self._by_path.get(self.drive + '\\DCIM')
+        if dcim is None:
+            return self.drive
+        folders = [e for e in dcim.children if e.is_dir]
+        if not folders:
+            return dcim.full_path
+        newest = max(folders, key=lambda e: e.name)
+        if len(newest.children) >= FOLDER_CAPACITY:
+            # a new folder was probably started
+            return dcim.full_path
+        return newest.full_path
+
+    def _reload(self):
+        self._tree = ListDirectoryCmd(self.drive, FULL_DEPTH).execute(
+                                                                self._usb)
+        self._tree_time = time.time()
+        self._stale.clear()
+        self._capture_pending = False
+        self._by_path = {}
+        self._add_paths(self._tree, self._tree.name)
+
+    def _relist(self, path):
+        old = self._by_path.get(path)
+        if old is None or old.parent is None or not old.is_dir:
+            parent = path.rpartition('\\')[0]
+            if old is None and parent and parent != path:
+                # a new directory, list it with its parent
+                return self._relist(parent)
+            return self._reload()
+        new = ListDirectoryCmd(path, FULL_DEPTH).execute(self._usb)
+        new.name = old.name
+        new.parent = old.parent
+        siblings = old.parent.children
+        siblings[siblings.index(old)] = new
+        for stale in old:
+            self._by_path.pop(stale.full_path, None)
+        self._add_paths(new, path)
+
+    def _add_paths(self, entry, path):
+        by_path = self._by_path
+        by_path[path] = entry
+        queue = [(entry, path)]
+        while queue:
+            entry, path = queue.pop()
+            for child in entry.children:
+                child_path = path + '\\' + child.name
+                by_path[child_path] = child
+                if child.children:
+                    queue.append((child, child_path))
 
     def walk(self, path=None):
         """Iterate over camera storage contents, like ``os.walk()``.
@@ -197,7 +753,7 @@ class CanonStorage(object):
                     filenames.append(child.name)
             yield (dirpath, dirnames, filenames)
 
-    def get_file(self, path, target, thumbnail=False):
+    def get_file(self, path, target, thumbnail=False, pipeline=None):
         """Download a file from the camera.
 
         ``target`` is either a file-like object or the file name to open
@@ -205,11 +761,197 @@ class CanonStorage(object):
 
         ``thumbnail`` says wheter to get the thumbnail or the whole file.
 
+        With a :class:`canon.pipeline.DownloadPipeline` the data is written
+        by the pipeline's writer thread, a file opened here is closed when
+        done. The :class:`canon.pipeline.DownloadJob` is returned as soon
+        as everything was read from the camera.
+
+        """
+        path = self._normalize_path(path)
+        if pipeline is None:
+            if not hasattr(target, 'write'):
+                target = open(target, 'wb+')
+            GetFileCmd(path, target, thumbnail,
+                       self._usb.max_chunk_size).execute(self._usb)
+            return
+        if hasattr(target, 'write'):
+            job = pipeline.open(target)
+        else:
+            job = pipeline.open(open(target, 'wb+'), close_target=True)
+        try:
+            GetFileCmd(path, job, thumbnail,
+                       self._usb.max_chunk_size).execute(self._usb)
+        finally:
+            job.close()
+        return job
+
+    def get_thumbnail(self, path):
+        """Return the thumbnail of a file as a string.
+
+        With a :attr:`thumbnail_cache` it's only fetched from the camera
+        if not cached for this path, size and timestamp yet.
+
+        """
+        cache = self.thumbnail_cache
+        entry = path if isinstance(path, FSEntry) else None
+        if cache is not None and entry is None:
+            with self._cache_lock:
+                entry = self._lookup(self._normalize_path(path))
+        if cache is not None and entry is not None:
+            data = cache.get(entry)
+            if data is not None:
+                return data
+        out = StringIO()
+        self.get_file(entry or path, out, thumbnail=True)
+        data = out.getvalue()
+        if data and cache is not None and entry is not None:
+            cache.put(entry, data)
+        return data
+
+    def prefetch_thumbnails(self, path=None):
+        """Fill the thumbnail cache for a directory in the background.
+
+        Thumbnails are fetched while the camera is otherwise idle, calling
+        this again for another directory drops what's left to do.
+
+        """
+        if self.thumbnail_cache is None:
+            raise CanonError("there's no thumbnail cache to prefetch into")
+        from canon.thumbnails import ThumbnailPrefetcher, THUMBNAIL_EXTENSIONS
+        entries = [e for e in self.ls(path).children
+                   if e.is_file and e.name.upper().endswith(
+                                                    THUMBNAIL_EXTENSIONS)]
+        if self._prefetcher is None:
+            self._prefetcher = ThumbnailPrefetcher(self)
+            self._prefetcher.start()
+        self._prefetcher.prefetch(entries)
+
+    def stop_prefetch(self):
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+
+    def open(self, path, thumbnail=False):
+        """Return a read-only :class:`CameraFile` streaming ``path``.
         """
-        if not hasattr(target, 'write'):
-            target = open(target, 'wb+')
         path = self._normalize_path(path)
-        GetFileCmd(path, target, thumbnail).execute(self._usb)
+        return CameraFile(self._usb, path, thumbnail,
+                          self._usb.max_chunk_size)
+
+    def set_attributes(self, path, attributes):
+        """Write the attribute byte of the file at ``path``."""
+        path = self._normalize_path(path)
+        status = SetFileAttributesCmd(path, attributes).execute(self._usb)
+        if status:
+            raise CanonError("setting attributes of {} failed: 0x{:x}"
+                             .format(path, status))
+        with self._cache_lock:
+            entry = self._by_path.get(path)
+            if entry is not None:
+                entry.attr[0] = int(attributes) & 0xff
+
+    def sync(self, local_dir, path=None, mark_downloaded=False,
+             skip_downloaded=False, pipeline=None):
+        """Download what's new or changed on the card to ``local_dir``.
+
+        Camera paths are mirrored below ``local_dir`` without the drive.
+        A manifest of what was downloaded, by name, size and timestamp, is
+        kept in ``local_dir``, files matching their manifest entry are
+        skipped. With ``skip_downloaded`` files the camera has marked
+        DOWNLOADED are skipped too, with ``mark_downloaded`` the camera
+        marks what was downloaded. Files are written through ``pipeline``
+        if given, the manifest then also gets their digests.
+
+        Returns a :class:`SyncReport`.
+
+        """
+        local_dir = os.path.expanduser(local_dir)
+        manifest_path = os.path.join(local_dir, SYNC_MANIFEST)
+        manifest = self._load_manifest(manifest_path)
+        report = SyncReport()
+        started = time.time()
+        pending = []
+
+        def done(entry, tmp, local_path, digest=None):
+            os.rename(tmp, local_path)
+            camera_path = entry.full_path
+            manifest[camera_path] = [entry.size, entry.timestamp]
+            if digest is not None:
+                manifest[camera_path].append(digest)
+            report.downloaded.append(camera_path)
+            report.bytes += entry.size
+            _log.info("sync: {} ({} b)".format(camera_path, entry.size))
+            attributes = entry.attr[0]
+            if mark_downloaded and not attributes & FSAttributes.DOWNLOADED:
+                self.set_attributes(entry,
+                                    attributes | FSAttributes.DOWNLOADED)
+
+        try:
+            for entry in self.ls(path):
+                if entry.is_dir:
+                    continue
+                camera_path = entry.full_path
+                local_path = os.path.join(local_dir,
+                                *camera_path.split('\\')[1:])
+                if self._is_synced(entry, manifest.get(camera_path),
+                                   local_path, skip_downloaded):
+                    report.skipped += 1
+                    continue
+                dirname = os.path.dirname(local_path)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                tmp = local_path + '.part'
+                if pipeline is None:
+                    with open(tmp, 'wb') as f:
+                        self.get_file(camera_path, f)
+                    done(entry, tmp, local_path)
+                    continue
+                job = self.get_file(camera_path, tmp, pipeline=pipeline)
+                pending.append((job, entry, tmp, local_path))
+                # what's on disk already can be taken care of
+                while pending and pending[0][0].done():
+                    job, entry, tmp, local_path = pending.pop(0)
+                    done(entry, tmp, local_path, job.wait().hexdigest)
+            while pending:
+                job, entry, tmp, local_path = pending.pop(0)
+                done(entry, tmp, local_path, job.wait().hexdigest)
+        finally:
+            report.elapsed = time.time() - started
+            self._save_manifest(manifest_path, manifest)
+        _log.info("sync: {}".format(report))
+        return report
+
+    @staticmethod
+    def _is_synced(entry, known, local_path, skip_downloaded):
+        if skip_downloaded and entry.attr[0] & FSAttributes.DOWNLOADED:
+            return True
+        if known is None or known[:2] != [entry.size, entry.timestamp]:
+            return False
+        try:
+            return os.path.getsize(local_path) == entry.size
+        except OSError:
+            return False
+
+    @staticmethod
+    def _load_manifest(path):
+        try:
+            with open(path, 'rb') as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError, e:
+            _log.warn("ignoring broken sync manifest {}: {}".format(path, e))
+            return {}
+
+    @staticmethod
+    def _save_manifest(path, manifest):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.rename(tmp, path)
 
     def mkdir(self):
         raise NotImplementedError()
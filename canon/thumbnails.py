@@ -0,0 +1,204 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Keep thumbnails on disk instead of asking the camera every time.
+
+A :class:`ThumbnailCache` stores thumbnails by full path, size and
+timestamp of the file on the card, so a changed file gets a new thumbnail.
+The least recently used ones go when the cache outgrows ``max_bytes``::
+
+    cam = Camera(dev, thumbnail_cache=ThumbnailCache())
+    jpeg = cam.storage.get_thumbnail('D:\\\\DCIM\\\\100CANON\\\\IMG_0001.JPG')
+    cam.storage.prefetch_thumbnails('D:\\\\DCIM\\\\100CANON')
+
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from usb.core import USBError
+
+from canon import CanonError
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join('~', '.canon-remote', 'thumbnails')
+
+# files the camera has thumbnails for
+THUMBNAIL_EXTENSIONS = ('.JPG', '.CRW', '.AVI')
+
+class ThumbnailCache(object):
+    """Thumbnails in a directory, evicted least recently used first.
+    """
+    def __init__(self, directory=None, max_bytes=0x4000000):
+        if directory is None:
+            directory = DEFAULT_CACHE_DIR
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        # file name -> size, least recently used first
+        self._files = OrderedDict()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.jpg'):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            found.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(found):
+            self._files[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def _name(entry):
+        key = '{}|{}|{}'.format(entry.full_path, entry.size, entry.timestamp)
+        return hashlib.sha1(key).hexdigest() + '.jpg'
+
+    def __contains__(self, entry):
+        with self._lock:
+            return self._name(entry) in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def get(self, entry):
+        """Return the thumbnail of an :class:`FSEntry` or ``None``."""
+        name = self._name(entry)
+        with self._lock:
+            size = self._files.pop(name, None)
+            if size is None:
+                return None
+            self._files[name] = size
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # the mtime is the last use for the next run
+            os.utime(path, None)
+        except (IOError, OSError), e:
+            _log.warn("lost cached thumbnail {}: {}".format(path, e))
+            with self._lock:
+                if self._files.pop(name, None) is not None:
+                    self.total_bytes -= size
+            return None
+        return data
+
+    def put(self, entry, data):
+        name = self._name(entry)
+        path = os.path.join(self.directory, name)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        with self._lock:
+            self.total_bytes -= self._files.pop(name, 0)
+            self._files[name] = len(data)
+            self.total_bytes += len(data)
+            self._evict()
+
+    def _evict(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        while self.total_bytes > max_bytes and self._files:
+            name, size = self._files.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._evict(0)
+
+class ThumbnailPrefetcher(threading.Thread):
+    """Fetch thumbnails into the cache while nobody else uses the camera.
+
+    A thumbnail is only fetched after the link has been left alone for
+    ``idle_time`` seconds by everyone else. :meth:`prefetch` replaces
+    what's left to do, e.g. when the user browses somewhere else.
+
+    """
+    def __init__(self, storage, idle_time=0.5):
+        threading.Thread.__init__(self, name='canon-prefetch')
+        self.setDaemon(True)
+        self.idle_time = idle_time
+        self._storage = storage
+        self._cond = threading.Condition()
+        self._todo = []
+        self._stopped = False
+        # last_used of the link after our own last fetch
+        self._own_use = 0.0
+
+    def prefetch(self, entries):
+        with self._cond:
+            self._todo = list(entries)
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self.isAlive():
+            self.join()
+
+    def _pause(self, seconds):
+        with self._cond:
+            if not self._stopped:
+                self._cond.wait(seconds)
+
+    def run(self):
+        storage = self._storage
+        usb = storage._usb
+        cache = storage.thumbnail_cache
+        while True:
+            with self._cond:
+                while not self._todo and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                entry = self._todo[0]
+            if entry not in cache:
+                last_used = usb.last_used
+                idle = time.time() - last_used
+                if last_used > self._own_use and idle < self.idle_time:
+                    self._pause(self.idle_time - idle)
+                    continue
+                if not usb.lock.acquire(False):
+                    self._pause(self.idle_time)
+                    continue
+                if usb.streaming:
+                    # someone's reading a file, wait till it's closed
+                    usb.lock.release()
+                    self._pause(self.idle_time)
+                    continue
+                try:
+                    storage.get_thumbnail(entry)
+                except (USBError, CanonError), e:
+                    _log.warn("prefetching {} failed: {}".format(entry, e))
+                finally:
+                    self._own_use = usb.last_used
+                    usb.lock.release()
+            with self._cond:
+                if self._todo and self._todo[0] is entry:
+                    self._todo.pop(0)
@@ -0,0 +1,309 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Interval shooting on a fixed schedule.
+
+Shots are due at ``start + n * interval`` on the monotonic clock, so
+neither the time a capture takes nor the downloads move the schedule.
+Pictures go to the card and are downloaded in the gaps between shots,
+as long as the next one isn't due before a download would be done::
+
+    cam.capture.start()
+    stats = cam.capture.timelapse(30, duration=8 * 3600,
+                                  target_dir='timelapse')
+    print stats
+
+"""
+
+import os
+import math
+import logging
+import threading
+
+from usb.core import USBError
+
+from canon import CanonError
+from canon.util import monotonic
+from canon.pipeline import DownloadPipeline
+
+_log = logging.getLogger(__name__)
+
+# what to do when a shot is late by a whole interval or more
+MISSED_SKIP = 'skip'            # drop the missed slots, keep the schedule
+MISSED_LATE = 'late'            # take every missed shot as soon as possible
+MISSED_SHIFT = 'shift'          # shoot now and move the schedule with it
+
+MISSED_POLICIES = (MISSED_SKIP, MISSED_LATE, MISSED_SHIFT)
+
+class RunningStats(object):
+    """Count, mean, deviation and range of a series without keeping it.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def stdev(self):
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self._m2 / (self.count - 1))
+
+    def __repr__(self):
+        if not self.count:
+            return '<RunningStats empty>'
+        return ('<RunningStats n={0.count} mean={0.mean:.4f} '
+                'sd={0.stdev:.4f} min={0.min:.4f} max={0.max:.4f}>'
+                .format(self))
+
+class TimelapseStats(object):
+    """How a timelapse went, times in seconds.
+
+    ``jitter`` is how late each shot was fired, ``shot`` the time from
+    firing to the capture being complete, ``download`` the time to read
+    each picture from the camera and ``latency`` from a shot being due to
+    its picture being on disk. ``downloaded`` counts the pictures written,
+    ``download_failed`` those which couldn't be read or written.
+
+    """
+    def __init__(self):
+        self.frames = 0
+        self.failed = 0
+        self.missed = 0
+        self.downloaded = 0
+        self.download_failed = 0
+        self.jitter = RunningStats()
+        self.shot = RunningStats()
+        self.download = RunningStats()
+        self.latency = RunningStats()
+
+    def __repr__(self):
+        return ('<TimelapseStats {0.frames} frames, {0.failed} failed, '
+                '{0.missed} missed, {0.downloaded} downloaded, '
+                '{0.download_failed} not written; jitter '
+                '{0.jitter}, latency {0.latency}>'.format(self))
+
+class Frame(object):
+    """One shot of a timelapse, ``due``, ``fired``, ``captured`` and
+    ``written`` are monotonic times; ``entry`` is the picture on the card
+    and ``error`` what writing it to ``local_path`` failed with.
+    """
+    def __init__(self, index, due):
+        self.index = index
+        self.due = due
+        self.fired = None
+        self.captured = None
+        self.entry = None
+        self.local_path = None
+        self.written = None
+        self.error = None
+
+    def __repr__(self):
+        return '<Frame #{} {}>'.format(self.index, self.entry)
+
+class Timelapse(object):
+    """Take ``frames`` pictures or keep going for ``duration`` seconds.
+
+    ``capture`` is an active :class:`canon.capture.CanonCapture`. With a
+    ``storage`` and ``target_dir`` each picture is downloaded there in a
+    gap between shots, a :class:`canon.pipeline.DownloadPipeline` writes
+    it. Pictures which couldn't be read or written are counted in the
+    stats and keep their ``error``, they don't stop the timelapse.
+    ``missed`` is one of ``MISSED_*`` and ``on_frame(frame)`` is called
+    after each shot. :meth:`stop` ends it from another thread.
+
+    """
+    # leave this much before a shot is due
+    margin = 0.05
+
+    def __init__(self, capture, interval, frames=None, duration=None,
+                 storage=None, target_dir=None, missed=MISSED_SKIP,
+                 on_frame=None):
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        if missed not in MISSED_POLICIES:
+            raise ValueError("missed must be one of {}"
+                             .format(MISSED_POLICIES))
+        if target_dir is not None and storage is None:
+            raise CanonError("downloading needs the camera storage")
+        self.capture = capture
+        self.interval = interval
+        self.frames = frames
+        self.duration = duration
+        self.storage = storage
+        self.target_dir = target_dir
+        self.missed = missed
+        self.on_frame = on_frame
+        self.stats = TimelapseStats()
+        self._stop = threading.Event()
+        self._pending = []
+        # (frame, job) still with the pipeline
+        self._writing = []
+        # bytes per second of the downloads so far
+        self._throughput = None
+
+    def stop(self):
+        self._stop.set()
+
+    def _done(self, due, start):
+        if self._stop.is_set():
+            return True
+        if self.frames is not None and self.stats.frames >= self.frames:
+            return True
+        return self.duration is not None and due - start > self.duration
+
+    def run(self):
+        """Shoot until done, download what's left and return the stats.
+        """
+        if self.target_dir is not None:
+            if not os.path.isdir(self.target_dir):
+                os.makedirs(self.target_dir)
+            self._pipeline = DownloadPipeline()
+        else:
+            self._pipeline = None
+        start = monotonic()
+        index = 0
+        try:
+            while True:
+                due = start + index * self.interval
+                if self._done(due, start):
+                    break
+                self._download_until(due)
+                late = monotonic() - due
+                if late < 0:
+                    if self._stop.wait(-late):
+                        break
+                elif late >= self.interval:
+                    slots = int(late // self.interval)
+                    if self.missed == MISSED_SKIP:
+                        _log.warn("timelapse: skipping {} shots".format(slots))
+                        self.stats.missed += slots
+                        index += slots
+                        continue
+                    if self.missed == MISSED_SHIFT:
+                        self.stats.missed += slots
+                        start += late
+                        due += late
+                self._shoot(Frame(index, due))
+                index += 1
+            self._download_until(None)
+            self._collect(wait=True)
+        finally:
+            if self._pipeline is not None:
+                self._pipeline.close()
+        _log.info("timelapse done: {}".format(self.stats))
+        return self.stats
+
+    def _shoot(self, frame):
+        stats = self.stats
+        frame.fired = monotonic()
+        stats.jitter.add(frame.fired - frame.due)
+        event = self.capture()
+        frame.captured = monotonic()
+        stats.frames += 1
+        if event is None:
+            stats.failed += 1
+        else:
+            stats.shot.add(frame.captured - frame.fired)
+            if self.storage is not None:
+                frame.entry = self.storage.latest_capture()
+            if self.target_dir is not None and frame.entry is not None:
+                self._pending.append(frame)
+        if self.on_frame is not None:
+            self.on_frame(frame)
+
+    def _download_until(self, deadline):
+        """Download pending pictures which are done before ``deadline``,
+        all of them without one."""
+        self._collect()
+        while self._pending:
+            frame = self._pending[0]
+            if deadline is not None:
+                left = deadline - monotonic() - self.margin
+                if self._throughput is None:
+                    needed = 0.0
+                else:
+                    needed = frame.entry.size / self._throughput
+                if needed > left:
+                    return
+            self._pending.pop(0)
+            self._download(frame)
+
+    def _download(self, frame):
+        frame.local_path = os.path.join(self.target_dir, frame.entry.name)
+        def written(job, error):
+            # on the writer thread, the stats are left to _collect()
+            if frame.error is None:
+                frame.written = monotonic()
+                frame.error = error
+        started = monotonic()
+        try:
+            target = open(frame.local_path, 'wb+')
+        except (IOError, OSError), e:
+            return self._failed(frame, e)
+        job = self._pipeline.open(target, close_target=True,
+                                  on_done=written)
+        try:
+            self.storage.get_file(frame.entry, job)
+        except (USBError, CanonError), e:
+            # before the job is closed, so written() leaves it be
+            return self._failed(frame, e)
+        finally:
+            job.close()
+        self._writing.append((frame, job))
+        finished = monotonic()
+        took = max(finished - started, 1e-6)
+        throughput = frame.entry.size / took
+        if self._throughput is None:
+            self._throughput = throughput
+        else:
+            self._throughput = 0.7 * self._throughput + 0.3 * throughput
+        self.stats.download.add(took)
+
+    def _failed(self, frame, error):
+        _log.error("timelapse: downloading {} failed: {}"
+                   .format(frame.entry.full_path, error))
+        frame.error = error
+        self.stats.download_failed += 1
+
+    def _collect(self, wait=False):
+        """Count the pictures the pipeline is done with, ``wait`` for all
+        of them."""
+        writing = []
+        for frame, job in self._writing:
+            if not wait and not job.done():
+                writing.append((frame, job))
+                continue
+            try:
+                job.wait()
+            except Exception, e:
+                _log.error("timelapse: writing {} failed: {}"
+                           .format(frame.local_path, e))
+                self.stats.download_failed += 1
+            else:
+                self.stats.downloaded += 1
+                self.stats.latency.add(frame.written - frame.due)
+        self._writing = writing
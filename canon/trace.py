@@ -0,0 +1,196 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Record raw USB traffic into a binary ring buffer.
+
+Logging every transfer with :func:`canon.util.hexdump` is far too slow for
+whole-card downloads. A :class:`WireTracer` instead copies the raw bytes of
+each transfer into a preallocated buffer, so tracing costs a ``pack_into``
+and a slice assignment per transfer. The buffer can be dumped to a file and
+rendered later with :func:`format_trace`, or from the command line::
+
+    python -m canon.trace session.trace
+
+"""
+
+import sys
+import time
+import struct
+import threading
+from collections import namedtuple
+
+from canon import CanonError
+from canon.util import hexdump
+
+TRACE_OUT = 0x00
+TRACE_IN = 0x80
+
+# direction, endpoint, wValue, length, captured length
+_RECORD = struct.Struct('<dBBHII')
+# magic, format version, snaplen, record count
+_FILE_HEADER = struct.Struct('<4sBII')
+_MAGIC = 'CNTR'
+_VERSION = 1
+
+TraceRecord = namedtuple('TraceRecord', 'timestamp direction endpoint '
+                                        'value length data')
+
+class WireTracer(object):
+    """A fixed-size ring of transfer records.
+
+    ``slots`` is the number of transfers kept before the oldest ones are
+    overwritten, ``snaplen`` is the maximum number of payload bytes stored
+    per transfer -- longer transfers are truncated, but their real length
+    is still recorded.
+
+    Transfers are recorded from the poller thread as well as the one
+    running commands, so the ring is only touched with :attr:`_lock` held.
+
+    """
+    def __init__(self, slots=4096, snaplen=0x200):
+        if slots < 1 or snaplen < 0:
+            raise ValueError("need at least one slot and a sane snaplen")
+        self.slots = int(slots)
+        self.snaplen = int(snaplen)
+        self._slot_size = _RECORD.size + self.snaplen
+        self._buffer = bytearray(self.slots * self._slot_size)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Number of records currently held."""
+        return min(self._count, self.slots)
+
+    @property
+    def dropped(self):
+        """Number of records overwritten since the last :meth:`clear`."""
+        return max(0, self._count - self.slots)
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def record(self, direction, endpoint, value, data):
+        """Store one transfer, ``data`` being anything with a buffer.
+        """
+        length = len(data)
+        caplen = min(length, self.snaplen)
+        with self._lock:
+            offset = (self._count % self.slots) * self._slot_size
+            _RECORD.pack_into(self._buffer, offset, time.time(), direction,
+                              endpoint, value, length, caplen)
+            if caplen:
+                start = offset + _RECORD.size
+                self._buffer[start:start+caplen] = buffer(data, 0, caplen)
+            self._count += 1
+
+    def records(self):
+        """Return an iterator over the held :class:`TraceRecord` tuples,
+        oldest first; a snapshot, recording goes on meanwhile.
+        """
+        with self._lock:
+            first = self._count - len(self)
+            records = [self._unpack(self._buffer, (n % self.slots)
+                                                  * self._slot_size)
+                       for n in xrange(first, self._count)]
+        return iter(records)
+
+    def dump(self, target):
+        """Write the held records to ``target``, a file-like or file name.
+
+        Only the captured bytes of every record are written, so a trace of
+        mostly short control transfers stays small.
+
+        """
+        if not hasattr(target, 'write'):
+            with open(target, 'wb') as f:
+                return self.dump(f)
+        with self._lock:
+            held = len(self)
+            target.write(_FILE_HEADER.pack(_MAGIC, _VERSION, self.snaplen,
+                                           held))
+            first = self._count - held
+            for n in xrange(first, self._count):
+                offset = (n % self.slots) * self._slot_size
+                caplen = _RECORD.unpack_from(self._buffer, offset)[-1]
+                end = offset + _RECORD.size + caplen
+                target.write(buffer(self._buffer, offset, end - offset))
+        return held
+
+    @staticmethod
+    def _unpack(buf, offset):
+        (timestamp, direction, endpoint, value,
+                length, caplen) = _RECORD.unpack_from(buf, offset)
+        start = offset + _RECORD.size
+        data = str(buf[start:start+caplen])
+        return TraceRecord(timestamp, direction, endpoint, value,
+                           length, data)
+
+def read_trace(source):
+    """Yield the :class:`TraceRecord` tuples stored in a dumped trace.
+    """
+    if not hasattr(source, 'read'):
+        with open(source, 'rb') as f:
+            for rec in read_trace(f):
+                yield rec
+            return
+    header = source.read(_FILE_HEADER.size)
+    if len(header) != _FILE_HEADER.size:
+        raise CanonError("truncated trace file")
+    magic, version, _, count = _FILE_HEADER.unpack(header)
+    if magic != _MAGIC or version != _VERSION:
+        raise CanonError("not a canon-remote trace file")
+    for _ in xrange(count):
+        raw = source.read(_RECORD.size)
+        if len(raw) != _RECORD.size:
+            raise CanonError("truncated trace file")
+        caplen = _RECORD.unpack(raw)[-1]
+        yield WireTracer._unpack(raw + source.read(caplen), 0)
+
+def format_record(rec, start=None):
+    """Return a human-readable rendering of one :class:`TraceRecord`.
+    """
+    when = rec.timestamp - start if start is not None else rec.timestamp
+    arrow = '<--' if rec.direction == TRACE_IN else '-->'
+    line = ("{:12.6f} {} ep 0x{:02x} wValue 0x{:04x} 0x{:x} bytes"
+            .format(when, arrow, rec.endpoint, rec.value, rec.length))
+    if len(rec.data) < rec.length:
+        line += " (0x{:x} captured)".format(len(rec.data))
+    if rec.data:
+        line += '\n' + hexdump(rec.data)
+    return line
+
+def format_trace(records):
+    """Render an iterable of records with timestamps relative to the first.
+    """
+    out = []
+    start = None
+    for rec in records:
+        if start is None:
+            start = rec.timestamp
+        out.append(format_record(rec, start))
+    return '\n'.join(out)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print >>sys.stderr, "usage: python -m canon.trace <trace file>"
+        return 2
+    print format_trace(read_trace(argv[0]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
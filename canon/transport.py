@@ -0,0 +1,231 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Alternative USB transports.
+
+:class:`AsyncCanonUSB` keeps several bulk-in transfers queued with libusb's
+asynchronous API while the caller works on the chunk it already has, so the
+bus doesn't sit idle between chunks of a large download. It goes through
+the internals of pyusb's libusb 1.0 backend and only works with that one::
+
+    cam = camera.Camera(dev, transport=AsyncCanonUSB)
+
+"""
+
+import time
+import errno
+import logging
+from collections import deque
+from ctypes import Structure, POINTER, c_int, c_long, c_void_p, byref
+
+from usb.core import USBError
+from usb.backend import libusb1
+
+from canon import CanonError
+from canon.protocol import CanonUSB
+from canon.trace import TRACE_IN
+from canon.util import hexdump
+
+_log = logging.getLogger(__name__)
+
+_LIBUSB_TRANSFER_TYPE_BULK = 2
+
+class _timeval(Structure):
+    _fields_ = [('tv_sec', c_long),
+                ('tv_usec', c_long)]
+
+_prototypes_ready = False
+
+def _setup_async_prototypes(lib):
+    """Declare what pyusb's backend leaves out."""
+    global _prototypes_ready
+    if _prototypes_ready:
+        return
+    # int libusb_cancel_transfer(struct libusb_transfer *transfer)
+    lib.libusb_cancel_transfer.argtypes = [POINTER(libusb1._libusb_transfer)]
+    lib.libusb_cancel_transfer.restype = c_int
+    # int libusb_handle_events_timeout(libusb_context *, struct timeval *)
+    lib.libusb_handle_events_timeout.argtypes = [c_void_p, POINTER(_timeval)]
+    lib.libusb_handle_events_timeout.restype = c_int
+    _prototypes_ready = True
+
+class _BulkInTransfer(object):
+    """A reusable libusb_transfer reading into pooled buffers."""
+    def __init__(self, lib, handle, endpoint):
+        self._lib = lib
+        self._transfer = lib.libusb_alloc_transfer(0)
+        if not self._transfer:
+            raise CanonError("libusb_alloc_transfer failed")
+        # the ctypes callback object must outlive the transfer
+        self._callback = libusb1._libusb_transfer_cb_fn_p(self._completed)
+        t = self._transfer.contents
+        t.dev_handle = handle
+        t.endpoint = endpoint
+        t.type = _LIBUSB_TRANSFER_TYPE_BULK
+        t.flags = 0
+        t.num_iso_packets = 0
+        t.callback = self._callback
+        self.buffer = None
+        self.done = True
+
+    def _completed(self, transfer):
+        self.done = True
+
+    def submit(self, buf, timeout):
+        address, length = buf.buffer_info()
+        t = self._transfer.contents
+        t.buffer = address
+        t.length = length
+        t.timeout = timeout
+        t.actual_length = 0
+        self.buffer = buf
+        self.done = False
+        try:
+            libusb1._check(self._lib.libusb_submit_transfer(self._transfer))
+        except:
+            self.done = True
+            self.buffer = None
+            raise
+
+    def cancel(self):
+        if not self.done:
+            self._lib.libusb_cancel_transfer(self._transfer)
+
+    @property
+    def status(self):
+        return self._transfer.contents.status
+
+    @property
+    def actual_length(self):
+        return self._transfer.contents.actual_length
+
+    def free(self):
+        if self._transfer:
+            self._lib.libusb_free_transfer(self._transfer)
+            self._transfer = None
+
+class AsyncCanonUSB(CanonUSB):
+    """A :class:`CanonUSB` with up to ``depth`` bulk-in transfers in flight.
+
+    Only :meth:`read_chunks` differs, i.e. the data phase of variable and
+    fixed length responses after the first chunk.
+
+    """
+    def __init__(self, device, depth=4):
+        super(AsyncCanonUSB, self).__init__(device)
+        backend = device._ctx.backend
+        if not isinstance(backend, libusb1._LibUSB):
+            raise CanonError("AsyncCanonUSB needs pyusb's libusb1 backend, "
+                             "not {}".format(backend))
+        if depth < 1:
+            raise ValueError("depth must be at least 1")
+        self.depth = depth
+        self._lib = backend.lib
+        self._ctx = backend.ctx
+        _setup_async_prototypes(self._lib)
+        self._transfers = []
+
+    def _handle(self):
+        self.device._ctx.managed_claim_interface(self.device, self.iface)
+        return self.device._ctx.handle.handle
+
+    def _idle_transfer(self):
+        for t in self._transfers:
+            if t.done and t.buffer is None:
+                return t
+        t = _BulkInTransfer(self._lib, self._handle(),
+                            self.ep_in.bEndpointAddress)
+        self._transfers.append(t)
+        return t
+
+    def _wait(self, transfer):
+        tv = _timeval(0, 100000)
+        while not transfer.done:
+            libusb1._check(self._lib.libusb_handle_events_timeout(
+                                self._ctx, byref(tv)))
+
+    def _finish(self, transfer, size, started):
+        """Check a completed transfer, return its buffer."""
+        buf = transfer.buffer
+        status, length = transfer.status, transfer.actual_length
+        if self.tracer is not None:
+            self.tracer.record(TRACE_IN, 0x81, 0x00, buffer(buf, 0, length))
+        self.metrics.link.received(length, time.time() - started)
+        if status == libusb1.LIBUSB_TRANSFER_TIMED_OUT:
+            raise USBError(libusb1._str_transfer_error[status], status,
+                           errno.ETIMEDOUT)
+        if status != libusb1.LIBUSB_TRANSFER_COMPLETED:
+            raise USBError(libusb1._str_transfer_error[status], status,
+                           libusb1._transfer_errno[status])
+        if length != size:
+            _log.warn("read_chunks: WRONG SIZE: 0x{:x} bytes instead of "
+                      "0x{:x}".format(length, size))
+            raise CanonError("unexpected data length ({} instead of {})"
+                             .format(length, size))
+        if _log.isEnabledFor(logging.INFO):
+            _log.info("read_chunks got {} (0x{:x}) b in {:.6f} sec"
+                      .format(size, size, time.time() - started))
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("\n" + hexdump(buf))
+        return buf
+
+    def read_chunks(self, sizes, timeout=None):
+        """Like :meth:`CanonUSB.read_chunks`, with transfers queued ahead.
+        """
+        if timeout is None:
+            timeout = self.device.default_timeout
+        pool = self.buffer_pool
+        sizes = iter(sizes)
+        queued = deque()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(queued) < self.depth:
+                    try:
+                        size = next(sizes)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    transfer = self._idle_transfer()
+                    buf = pool.acquire(size)
+                    try:
+                        transfer.submit(buf, timeout)
+                    except:
+                        pool.release(buf)
+                        raise
+                    queued.append((transfer, size, time.time()))
+                if not queued:
+                    return
+                transfer, size, started = queued[0]
+                self._wait(transfer)
+                queued.popleft()
+                try:
+                    yield self._finish(transfer, size, started)
+                finally:
+                    pool.release(transfer.buffer)
+                    transfer.buffer = None
+        finally:
+            # abandoned or failed half way, don't leave transfers behind
+            for transfer, _, _ in queued:
+                transfer.cancel()
+            for transfer, _, _ in queued:
+                self._wait(transfer)
+                pool.release(transfer.buffer)
+                transfer.buffer = None
+
+    def __del__(self):
+        for t in self._transfers:
+            t.free()
@@ -0,0 +1,130 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Find and remember the fastest transfer chunk size for a camera.
+
+Every chunk of a download costs a round trip through Python and pyusb, so
+bigger chunks are usually faster -- up to whatever the camera firmware is
+happy with. :func:`measure_chunk_sizes` downloads the same file with each
+candidate size -- one of at most ``TRIAL_BYTES``, the camera can't stop
+sending a file half-way -- and :class:`ChunkSizeStore` keeps the winner
+per model and firmware version.
+
+"""
+
+import os
+import json
+import time
+import logging
+
+from usb.core import USBError
+
+from canon import CanonError
+from canon.storage import FSEntry
+
+_log = logging.getLogger(__name__)
+
+CANDIDATE_CHUNK_SIZES = (0x1400, 0x2800, 0x5000, 0xa000, 0x14000)
+
+# largest file read per trial
+TRIAL_BYTES = 0x400000
+
+DEFAULT_STORE_PATH = os.path.join('~', '.canon-remote', 'chunk_sizes.json')
+
+class _NullTarget(object):
+    def __init__(self):
+        self.written = 0
+    def write(self, data):
+        self.written += len(data)
+
+def measure_chunk_sizes(usb, storage, path, candidates=CANDIDATE_CHUNK_SIZES,
+                        rounds=1, max_bytes=TRIAL_BYTES):
+    """Download ``path`` with every chunk size in ``candidates``.
+
+    ``usb`` is the :class:`canon.protocol.CanonUSB` of ``storage``, the
+    file must be no larger than ``max_bytes``. Returns a
+    ``{chunk_size: bytes_per_second}`` dict, sizes the camera choked on
+    are left out. The chunk size of the link is restored when done.
+
+    """
+    entry = path if isinstance(path, FSEntry) else storage.lookup(path)
+    if entry is None or not entry.is_file:
+        raise CanonError("no file {} to tune with".format(path))
+    if entry.size > max_bytes:
+        raise CanonError("{} is 0x{:x} bytes, more than 0x{:x} per trial"
+                         .format(entry.full_path, entry.size, max_bytes))
+    original = usb.max_chunk_size
+    results = {}
+    try:
+        for size in candidates:
+            usb.max_chunk_size = size
+            try:
+                elapsed = 0.0
+                total = 0
+                for _ in xrange(rounds):
+                    target = _NullTarget()
+                    started = time.time()
+                    storage.get_file(entry, target)
+                    elapsed += time.time() - started
+                    total += target.written
+            except (USBError, CanonError), e:
+                _log.warn("chunk size 0x{:x} failed: {}".format(size, e))
+                continue
+            results[size] = total / elapsed if elapsed else float('inf')
+            _log.info("chunk size 0x{:x}: {:.0f} b/s"
+                      .format(size, results[size]))
+    finally:
+        usb.max_chunk_size = original
+    return results
+
+class ChunkSizeStore(object):
+    """Best chunk sizes per camera model and firmware, kept in a JSON file.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = DEFAULT_STORE_PATH
+        self.path = os.path.expanduser(path)
+
+    @staticmethod
+    def _key(model, firmware_version):
+        return u'{} {}'.format(model, firmware_version)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError, e:
+            _log.warn("ignoring broken chunk size store {}: {}"
+                      .format(self.path, e))
+            return {}
+
+    def get(self, model, firmware_version):
+        """Return the stored chunk size or ``None``.
+        """
+        return self._load().get(self._key(model, firmware_version))
+
+    def set(self, model, firmware_version, chunk_size):
+        sizes = self._load()
+        sizes[self._key(model, firmware_version)] = int(chunk_size)
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            json.dump(sizes, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
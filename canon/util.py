@@ -16,9 +16,16 @@
 # along with canon-remote.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
+import sys
+import time
 import struct
 import string
+import ctypes
+import ctypes.util
+import threading
 from array import array
+from collections import OrderedDict
 import math
 
 ARRAY_FORMAT = [None, 'B', '<H', '<I', '<I', '<Q', '<Q', '<Q', '<Q']
@@ -30,20 +37,22 @@ def extract_string(data, start=0):
         return None
     return data[start:start+end].tostring()
 
+LE16 = struct.Struct('<H')
+LE32 = struct.Struct('<I')
+
 def le16toi(raw, start=None):
-    raw = _normalize_to_string(raw)
-    if start is not None:
-        raw = raw[start:start+2]
-    return struct.unpack('<H', raw)[0]
+    if start is None:
+        return LE16.unpack(_normalize_to_string(raw))[0]
+    # straight from the buffer, no copies
+    return LE16.unpack_from(raw, start)[0]
 
 def le32toi(raw, start=None):
-    raw = _normalize_to_string(raw)
-    if start is not None:
-        raw = raw[start:start+4]
-    return struct.unpack('<I', raw)[0]
+    if start is None:
+        return LE32.unpack(_normalize_to_string(raw))[0]
+    return LE32.unpack_from(raw, start)[0]
 
 def itole32a(i):
-    return array('B', struct.pack('<I', i))
+    return array('B', LE32.pack(i))
 
 def _normalize_to_string(raw):
     if isinstance(raw, array):
@@ -55,12 +64,106 @@ def _normalize_to_string(raw):
         raw = array(ARRAY_FORMAT[length], [raw]).tostring()
     return raw
 
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+CLOCK_MONOTONIC = 1 # linux
+
+def _monotonic_clock():
+    if not sys.platform.startswith('linux'):
+        return time.time
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        ts = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+# seconds from an arbitrary start, never going back with the wall clock;
+# falls back to time.time() where there's no CLOCK_MONOTONIC
+monotonic = _monotonic_clock()
+
 def chunks(l, n):
     """ Yield successive n-sized chunks from l.
     """
     for i in xrange(0, len(l), n):
         yield l[i:i+n]
 
+class BufferPool(object):
+    """Recycle ``array('B')`` buffers of exact sizes.
+
+    USB reads need a buffer of exactly the requested size, so free buffers
+    are kept per size. Only the ``max_sizes`` most recently used sizes are
+    kept, each with at most ``max_free`` spare buffers.
+
+    """
+    def __init__(self, max_free=4, max_sizes=8):
+        self.max_free = max_free
+        self.max_sizes = max_sizes
+        self._free = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        """Return a buffer of ``size`` bytes, contents undefined.
+        """
+        with self._lock:
+            free = self._free.get(size)
+            if free:
+                return free.pop()
+        return array('B', '\x00') * size
+
+    def release(self, buf):
+        """Return ``buf`` to the pool, it must not be used afterwards.
+        """
+        size = len(buf)
+        with self._lock:
+            free = self._free.pop(size, [])
+            if len(free) < self.max_free:
+                free.append(buf)
+            self._free[size] = free
+            while len(self._free) > self.max_sizes:
+                self._free.popitem(last=False)
+
+class CoalescingWriter(object):
+    """Gather small writes into one preallocated buffer.
+
+    Everything written is copied into a ``size``-long ``bytearray`` which
+    is handed to ``target.write()`` in one go once full. Writes larger
+    than the buffer go straight through.
+
+    """
+    def __init__(self, target, size=0x40000):
+        self.target = target
+        self._buf = bytearray(size)
+        self._pos = 0
+
+    def write(self, data):
+        n = len(data)
+        if self._pos + n > len(self._buf):
+            self.flush()
+        if n >= len(self._buf):
+            self.target.write(data)
+            return
+        self._buf[self._pos:self._pos+n] = buffer(data)
+        self._pos += n
+
+    def flush(self):
+        if self._pos:
+            self.target.write(buffer(self._buf, 0, self._pos))
+            self._pos = 0
+
+    def close(self):
+        self.flush()
+
 def hexdump(data, with_ascii=True, with_offset=True):
     """Return the binary data as nicely printed hexadecimal text.
     """
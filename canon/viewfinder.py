@@ -0,0 +1,183 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Live preview from the viewfinder.
+
+A :class:`Viewfinder` fetches frames on its own thread, so the next frame
+is already coming down the pipe while the caller looks at the current
+one. Only the newest frame is kept, a consumer which falls behind skips
+the stale ones::
+
+    cam.capture.start()
+    with cam.capture.viewfinder() as vf:
+        for frame in vf:
+            show(frame.data)
+            if done():
+                break
+    print vf.fps, vf.dropped
+
+"""
+
+import sys
+import logging
+import threading
+
+from canon.util import monotonic
+from canon.capture import (ViewfinderStartCmd, ViewfinderStopCmd,
+                           RetrievePreviewCmd)
+
+_log = logging.getLogger(__name__)
+
+class PreviewFrame(object):
+    """A JPEG from the viewfinder, ``timestamp`` is the monotonic time it
+    was read, ``index`` counts every frame read, delivered or not.
+    """
+    def __init__(self, data, timestamp, index):
+        self.data = data
+        self.timestamp = timestamp
+        self.index = index
+
+    def __repr__(self):
+        return '<PreviewFrame #{} 0x{:x} b at {:.3f}>'.format(
+                    self.index, len(self.data), self.timestamp)
+
+class Viewfinder(object):
+    """Viewfinder frames from a camera in remote capture mode.
+
+    Starting it turns the camera's viewfinder on and the fetching thread
+    loose, with ``max_fps`` it doesn't ask for frames faster than that.
+    Iterating starts it if needed and stops it at the end.
+
+    """
+    def __init__(self, usb, max_fps=None):
+        self._usb = usb
+        self.max_fps = max_fps
+        self._cond = threading.Condition()
+        self._frame = None
+        self._exc_info = None
+        self._running = False
+        self._thread = None
+        self.fetched = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.started = None
+        self.stopped = None
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._thread is not None:
+            return
+        ViewfinderStartCmd().execute(self._usb)
+        self._running = True
+        self.started = monotonic()
+        self.stopped = None
+        self._thread = threading.Thread(target=self._fetch,
+                                        name='canon-viewfinder')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        with self._cond:
+            # the thread may have stopped on an error already
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+        self.stopped = monotonic()
+        ViewfinderStopCmd().execute(self._usb)
+        _log.info("viewfinder: {} frames, {} dropped, {:.1f} fps"
+                  .format(self.delivered, self.dropped, self.fps))
+
+    @property
+    def fps(self):
+        """Frames delivered per second."""
+        if self.started is None:
+            return 0.0
+        end = self.stopped if self.stopped is not None else monotonic()
+        return self.delivered / max(end - self.started, 1e-6)
+
+    def _fetch(self):
+        interval = 1.0 / self.max_fps if self.max_fps else 0.0
+        while self._running:
+            started = monotonic()
+            try:
+                data = RetrievePreviewCmd(
+                    chunk_size=self._usb.max_chunk_size).execute(self._usb)
+            except:
+                with self._cond:
+                    self._exc_info = sys.exc_info()
+                    self._running = False
+                    self._cond.notify_all()
+                return
+            now = monotonic()
+            with self._cond:
+                if data:
+                    if self._frame is not None:
+                        # nobody wanted that one
+                        self.dropped += 1
+                    self._frame = PreviewFrame(data, now, self.fetched)
+                    self.fetched += 1
+                    self._cond.notify_all()
+                left = interval - (now - started)
+                if left > 0 and self._running:
+                    self._cond.wait(left)
+
+    def next_frame(self, timeout=None):
+        """Return the newest frame not seen yet, ``None`` after
+        ``timeout`` seconds or once stopped."""
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._cond:
+            while self._frame is None:
+                if self._exc_info is not None:
+                    exc_info, self._exc_info = self._exc_info, None
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if not self._running:
+                    return None
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                left = deadline - monotonic()
+                if left <= 0:
+                    return None
+                self._cond.wait(left)
+            frame, self._frame = self._frame, None
+            self.delivered += 1
+            return frame
+
+    def __iter__(self):
+        started_here = self._thread is None
+        self.start()
+        try:
+            while True:
+                frame = self.next_frame()
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            if started_here:
+                self.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,199 @@
+#  This file is part of canon-remote.
+#  Copyright (C) 2011-2012 Kiril Zyapkov <kiril.zyapkov@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Drive a camera without blocking the caller.
+
+Everything in :mod:`canon.camera` blocks until the camera answers. An
+:class:`AsyncCamera` runs those calls on a worker thread of its own, one
+at a time as the camera needs it, and hands back a :class:`Future` right
+away::
+
+    acam = AsyncCamera(camera.find())
+    acam.initialize().result()
+    listing = acam.ls()
+    listing.add_done_callback(lambda f: show(f.result()))
+
+"""
+
+import sys
+import logging
+import threading
+from Queue import Queue, Empty
+
+from canon import CanonError
+
+_log = logging.getLogger(__name__)
+
+class Future(object):
+    """The eventual result of a call running on a :class:`CameraWorker`.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish and return what it returned.
+
+        Exceptions raised by the call are raised here.
+
+        """
+        if not self._done.wait(timeout):
+            raise CanonError("no result after {} s".format(timeout))
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise CanonError("no result after {} s".format(timeout))
+        return self._exc_info[1] if self._exc_info else None
+
+    def add_done_callback(self, fn):
+        """Call ``fn(future)`` when done, right away if already done.
+
+        Callbacks run on the worker thread.
+
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception, e:
+                _log.warn("future callback {} failed: {}".format(fn, e))
+
+class CameraWorker(threading.Thread):
+    """A thread running submitted calls one after the other.
+    """
+    def __init__(self, name=None):
+        threading.Thread.__init__(self, name=name)
+        self._queue = Queue()
+        self.setDaemon(True)
+
+    def submit(self, fn, *args, **kw):
+        """Queue ``fn(*args, **kw)``, return a :class:`Future` for it.
+        """
+        if not self.isAlive():
+            raise CanonError("worker {} is not running".format(self.name))
+        future = Future()
+        self._queue.put((future, fn, args, kw))
+        return future
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kw = item
+            try:
+                result = fn(*args, **kw)
+            except:
+                future._finish(exc_info=sys.exc_info())
+            else:
+                future._finish(result)
+
+    def stop(self):
+        """Finish what's queued, then exit."""
+        if self.isAlive():
+            self._queue.put(None)
+            self.join()
+
+class InterruptEvents(object):
+    """Iterate over data arriving on the interrupt pipe.
+
+    Data shows up whenever the pipe is polled, i.e. during
+    :meth:`Camera.initialize` and while capturing. Iteration ends after
+    ``timeout`` seconds without data, or never if ``timeout`` is ``None``.
+
+    """
+    def __init__(self, usb, timeout=None):
+        self._usb = usb
+        self._queue = Queue()
+        self.timeout = timeout
+        usb.add_interrupt_listener(self._queue.put)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._usb is None:
+            raise StopIteration()
+        try:
+            return self._queue.get(timeout=self.timeout)
+        except Empty:
+            self.close()
+            raise StopIteration()
+
+    def close(self):
+        if self._usb is not None:
+            self._usb.remove_interrupt_listener(self._queue.put)
+            self._usb = None
+
+class AsyncCamera(object):
+    """Non-blocking front end to a :class:`canon.camera.Camera`.
+
+    Every method queues the blocking call on this camera's worker and
+    returns a :class:`Future`.
+
+    """
+    def __init__(self, camera):
+        self.camera = camera
+        self._worker = CameraWorker(name='canon-{:x}'.format(id(camera)))
+        self._worker.start()
+
+    def submit(self, fn, *args, **kw):
+        """Run any callable on the worker, e.g. to batch a few calls."""
+        return self._worker.submit(fn, *args, **kw)
+
+    def initialize(self):
+        return self.submit(self.camera.initialize)
+
+    def identify(self):
+        return self.submit(self.camera.identify)
+
+    def ls(self, path=None, recurse=12):
+        return self.submit(self.camera.storage.ls, path, recurse)
+
+    def get_file(self, path, target, thumbnail=False):
+        return self.submit(self.camera.storage.get_file, path, target,
+                           thumbnail)
+
+    def capture(self):
+        return self.submit(self.camera.capture)
+
+    def events(self, timeout=None):
+        """Return an :class:`InterruptEvents` iterator for this camera."""
+        return InterruptEvents(self.camera._usb, timeout)
+
+    def close(self):
+        """Let queued calls finish and stop the worker."""
+        self._worker.stop()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python2
+"""Time ListDirectoryCmd parsing a synthetic whole-card listing.
+
+    python sandbox/bench_listing.py [entries [folders]]
+
+"""
+import sys
+import time
+import struct
+from array import array
+
+from canon.storage import ListDirectoryCmd
+
+def entry(attr, name, size=0, timestamp=0):
+    return struct.pack('<BBII', attr, 0, size, timestamp) + name + '\x00'
+
+def listing(files=10000, folders=10):
+    """A D:\\DCIM\\1xxCANON\\IMG_xxxx.JPG tree like the camera returns."""
+    parts = [entry(0x10, 'D:'), entry(0x10, '.\\DCIM')]
+    per_folder = files // folders
+    n = 0
+    for f in xrange(folders):
+        parts.append(entry(0x10, '.\\{}CANON'.format(100 + f)))
+        for i in xrange(per_folder):
+            n += 1
+            parts.append(entry(0x20, 'IMG_{:04d}.JPG'.format(n % 10000),
+                               0x100000 + n, 1300000000 + n))
+        parts.append(entry(0x10, '..'))
+    parts.append(entry(0x10, '..'))
+    return array('B', ''.join(parts))
+
+if __name__ == '__main__':
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    folders = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    data = listing(files, folders)
+    cmd = ListDirectoryCmd('D:')
+    best = None
+    for _ in xrange(5):
+        started = time.time()
+        root = cmd._parse_response(data)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    count = sum(1 for e in root if e.is_file)
+    print "{} files, {} b listing: {:.1f} ms".format(count, len(data),
+                                                     best * 1000)
+    cmd = ListDirectoryCmd('D:', index=True)
+    best = None
+    for _ in xrange(5):
+        started = time.time()
+        index = cmd._parse_response(data)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print "as a StorageIndex: {:.1f} ms".format(best * 1000)
@@ -2,12 +2,38 @@ import unittest
 
 from . import test_util
 from . import test_protocol
+from . import test_trace
+from . import test_worker
+from . import test_simulator
+from . import test_storage
+from . import test_thumbnails
+from . import test_capture
+from . import test_timelapse
+from . import test_viewfinder
+from . import test_replay
+from . import test_pipeline
+from . import test_metrics
+from . import test_pool
+from . import test_transport
 from . import camera
 
 def offline():
     suite = unittest.TestSuite()
     suite.addTest(unittest.TestLoader().loadTestsFromModule(test_util))
     suite.addTest(unittest.TestLoader().loadTestsFromModule(test_protocol))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_trace))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_worker))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_simulator))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_storage))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_thumbnails))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_capture))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_timelapse))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_viewfinder))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_replay))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_pipeline))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_metrics))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_pool))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(test_transport))
     return suite
 
 def all():
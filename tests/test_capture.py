@@ -0,0 +1,127 @@
+import unittest
+from StringIO import StringIO
+
+from canon.simulator import TRANSFER_FULL_TO_DRIVE
+
+from .test_simulator import SimulatedCameraTestCase
+
+class CaptureEventsTest(SimulatedCameraTestCase):
+
+    def test_capture_events(self):
+        capture = self.cam.capture
+        seen = []
+        capture.add_event_listener(seen.append)
+        capture.start()
+        capture()
+        capture.stop()
+        self.assertEqual([e.kind for e in seen], [0x0a, 0x0e])
+        self.assertEqual(seen[-1].name, 'capture complete')
+        self.assertEqual(seen[-1].key, 0x1001)
+        capture.remove_event_listener(seen.append)
+        # sizes come with the ready messages
+        events = capture.events(timeout=2)
+        with self.cam._usb.poller_ctx():
+            self.sim._interrupt(self.sim._int_message(0x0c, 0x1002,
+                                                      size=0x20000))
+            event = next(events)
+        events.close()
+        self.assertEqual((event.name, event.key, event.size),
+                         ('full image ready', 0x1002, 0x20000))
+
+    def test_failing_listeners_do_not_stop_events(self):
+        capture = self.cam.capture
+        seen = []
+        def broken(event):
+            raise ValueError("listener bug")
+        capture.add_event_listener(broken)
+        capture.add_event_listener(seen.append)
+        capture.start()
+        self.assertTrue(capture() is not None)
+        self.assertTrue(capture() is not None)
+        capture.stop()
+        self.assertEqual([e.kind for e in seen], [0x0a, 0x0e] * 2)
+
+    def test_capture_with_a_running_poller(self):
+        capture = self.cam.capture
+        usb = self.cam._usb
+        usb.start_poller()
+        try:
+            capture.start()
+            first = capture()
+            second = capture()
+            capture.stop()
+        finally:
+            usb.stop_poller()
+        self.assertEqual((first.key, second.key), (0x1001, 0x1002))
+
+class CaptureToHostTest(SimulatedCameraTestCase):
+
+    def test_capture_to_host(self):
+        capture = self.cam.capture
+        capture.start()
+        data = capture.capture_to_host()
+        self.assertEqual(data, self.sim.last_capture)
+        out = StringIO()
+        self.assertEqual(capture.capture_to_host(out, thumbnail=True), 0x1000)
+        self.assertEqual(len(out.getvalue()), 0x1000)
+        # nothing went to the card
+        self.assertFalse(self.sim.get('D:\\DCIM\\100CANON\\IMG_0005.JPG'))
+        self.assertEqual(self.sim.commands.count((0x17, 0x12, 0x202)), 2)
+        # and the next picture goes to the card again
+        self.assertEqual(self.sim.transfer_mode, TRANSFER_FULL_TO_DRIVE)
+        capture()
+        path = 'D:\\DCIM\\100CANON\\IMG_0005.JPG'
+        self.assertTrue(self.sim.get(path))
+        self.assertEqual(self.cam.storage.latest_capture().full_path, path)
+        capture.stop()
+
+    def test_capture_to_host_with_a_running_poller(self):
+        capture = self.cam.capture
+        usb = self.cam._usb
+        usb.start_poller()
+        try:
+            capture.start()
+            first = capture.capture_to_host()
+            self.assertEqual(first, self.sim.last_capture)
+            second = capture.capture_to_host()
+            capture.stop()
+        finally:
+            usb.stop_poller()
+        # the new picture, not the one before again
+        self.assertEqual(second, self.sim.last_capture)
+        self.assertNotEqual(second, first)
+
+class CaptureSettingsTest(SimulatedCameraTestCase):
+
+    def test_settings_batch(self):
+        rc_commands = lambda: self.sim.commands.count((0x13, 0x12, 0x201))
+        capture = self.cam.capture
+        capture.start()
+        capture.get_capture_settings()
+        before = rc_commands()
+        capture.macro = True
+        # set and read back
+        self.assertEqual(rc_commands(), before + 2)
+        with capture.settings_batch() as settings:
+            capture.macro = False
+            settings.aperture = 0x38
+            with capture.settings_batch():
+                settings.iso = 0x48
+            self.assertEqual(rc_commands(), before + 2)
+        self.assertEqual(rc_commands(), before + 4)
+        # read back from the camera
+        self.assertFalse(capture.settings is settings)
+        self.assertEqual(capture.settings.tostring(), settings.tostring())
+        self.assertFalse(capture.settings.macro)
+        # nothing changed, nothing sent
+        with capture.settings_batch():
+            pass
+        capture.macro = False
+        self.assertEqual(rc_commands(), before + 4)
+        stats = capture.settings_stats
+        self.assertEqual((stats.writes, stats.skipped), (2, 2))
+        self.assertEqual(stats.round_trips_avoided, 4)
+        capture.stop()
+
+if __name__ == '__main__':
+    unittest.main()
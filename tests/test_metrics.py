@@ -0,0 +1,48 @@
+import json
+import errno
+import unittest
+
+from usb.core import USBError
+
+from canon.metrics import MetricsRegistry, Histogram
+
+class MetricsTest(unittest.TestCase):
+
+    def test_histogram_buckets(self):
+        h = Histogram((0.01, 0.1, 1.0))
+        for value in (0.005, 0.01, 0.05, 2.0):
+            h.observe(value)
+        self.assertEqual(list(h.cumulative()),
+                         [(0.01, 2), (0.1, 3), (1.0, 3), (float('inf'), 4)])
+        self.assertEqual(h.count, 4)
+
+    def test_measure_takes_link_deltas(self):
+        registry = MetricsRegistry()
+        registry.link.received(0x40, 0.001)
+        with registry.measure('FooCmd'):
+            registry.link.sent(0x50)
+            registry.link.received(0x40, 0.001)
+            registry.link.received(0x1000, 0.002)
+        with self.assertRaises(USBError):
+            with registry.measure('FooCmd'):
+                raise USBError('timed out', errno=errno.ETIMEDOUT)
+        m = registry.command('FooCmd')
+        self.assertEqual((m.calls, m.errors, m.timeouts), (2, 1, 1))
+        self.assertEqual((m.bytes_out, m.bytes_in, m.chunks),
+                         (0x50, 0x1040, 2))
+        self.assertEqual(registry.link.bulk_reads, 3)
+
+    def test_exports(self):
+        registry = MetricsRegistry(bounds=(0.5,))
+        registry.observe('FooCmd', 0.25, bytes_in=10)
+        data = json.loads(registry.to_json())
+        self.assertEqual(data['commands']['FooCmd']['bytes_in'], 10)
+        text = registry.to_prometheus()
+        self.assertTrue('canon_command_seconds_bucket{command="FooCmd",'
+                        'le="0.5"} 1\n' in text)
+        self.assertTrue('canon_command_seconds_count{command="FooCmd"} 1\n'
+                        in text)
+        self.assertTrue('# TYPE canon_usb_bytes_in_total counter\n' in text)
+
+if __name__ == '__main__':
+    unittest.main()
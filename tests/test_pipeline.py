@@ -0,0 +1,66 @@
+import time
+import hashlib
+import unittest
+from StringIO import StringIO
+
+from canon.pipeline import DownloadPipeline
+
+class SlowTarget(StringIO):
+    def write(self, data):
+        time.sleep(0.01)
+        StringIO.write(self, data)
+
+class BrokenTarget(object):
+    def write(self, data):
+        raise IOError("disk full")
+
+class PipelineTest(unittest.TestCase):
+
+    def test_writes_and_hashes_in_order(self):
+        chunks = [chr(i) * 0x1000 for i in xrange(20)]
+        target = SlowTarget()
+        with DownloadPipeline(max_queued=2, hash_name='md5') as pipeline:
+            job = pipeline.open(target)
+            for chunk in chunks:
+                job.write(buffer(chunk))
+            job.close()
+            self.assertEqual(job.wait().hexdigest,
+                             hashlib.md5(''.join(chunks)).hexdigest())
+        self.assertEqual(target.getvalue(), ''.join(chunks))
+        stats = pipeline.stats
+        self.assertEqual((stats.bytes, stats.chunks), (0x14000, 20))
+        # the writer is slower than the producer, so it had to wait
+        self.assertTrue(stats.stalled > 0)
+        self.assertTrue(stats.write >= 0.2)
+
+    def test_writer_errors_surface_in_wait(self):
+        done = []
+        on_done = lambda job, error: done.append((job, error))
+        with DownloadPipeline() as pipeline:
+            job = pipeline.open(BrokenTarget(), on_done=on_done)
+            job.write('data')
+            job.write('more')
+            job.close()
+            self.assertRaises(IOError, job.wait)
+            ok = pipeline.open(StringIO(), on_done=on_done)
+            ok.write('data')
+            ok.close()
+            ok.wait()
+        self.assertEqual(len(done), 2)
+        self.assertTrue(done[0][0] is job)
+        self.assertTrue(isinstance(done[0][1], IOError))
+        self.assertTrue(job.error is done[0][1])
+        self.assertEqual(done[1], (ok, None))
+        self.assertEqual(ok.error, None)
+
+    def test_on_done_errors_fail_the_job(self):
+        def on_done(job, error):
+            raise ValueError("bad callback")
+        with DownloadPipeline() as pipeline:
+            job = pipeline.open(StringIO(), on_done=on_done)
+            job.write('data')
+            job.close()
+            self.assertRaises(ValueError, job.wait)
+
+if __name__ == '__main__':
+    unittest.main()
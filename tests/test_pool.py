@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from canon import camera, tuning
+from canon.pool import CameraPool
+from canon.simulator import SimulatedG3
+
+class CameraPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        store = tuning.ChunkSizeStore(os.path.join(self.tmpdir, 'sizes.json'))
+        self.sims = [SimulatedG3(owner='cam{}'.format(i), address=i + 2)
+                     for i in range(3)]
+        self.pool = CameraPool(camera.Camera(sim, chunk_size_store=store)
+                               for sim in self.sims)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_bulk_operations(self):
+        pool = self.pool
+        self.assertEqual(pool.keys(), ['1-2', '1-3', '1-4'])
+        self.assertEqual(pool.initialize().wait().errors(), {})
+        owners = pool.identify().wait().results()
+        self.assertEqual([info[1] for info in owners.values()],
+                         ['cam0', 'cam1', 'cam2'])
+        pool.start_capture().wait()
+        shots = pool.capture_all().wait()
+        self.assertEqual(len(shots.results()), 3)
+        self.assertTrue(all(event.name == 'capture complete'
+                            for event in shots.results().values()))
+        pool.stop_capture().wait()
+        reports = pool.sync_all(self.tmpdir).wait().results()
+        self.assertEqual([len(r.downloaded) for r in reports.values()],
+                         [5, 5, 5])
+        self.assertTrue(os.path.isdir(os.path.join(self.tmpdir, '1-3')))
+        # routed to one camera only
+        self.assertEqual(len(pool['1-3'].ls().result(2).children), 1)
+        self.assertTrue(pool.camera('1-4')._usb is not
+                        pool.camera('1-3')._usb)
+
+    def test_failures_are_per_camera(self):
+        self.pool.initialize().wait()
+        def fail_on_second(cam):
+            if cam.address == 3:
+                raise ValueError('broken')
+            return cam.address
+        results = self.pool.each(fail_on_second).wait()
+        self.assertEqual(results.results().items(), [('1-2', 2), ('1-4', 4)])
+        self.assertEqual(results.errors().keys(), ['1-3'])
+
+if __name__ == '__main__':
+    unittest.main()
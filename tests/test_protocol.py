@@ -1,6 +1,22 @@
+import struct
 import unittest
 from array import array
 
+from canon.util import le32toi, le16toi
+
+def listing_entry(attr, name, size=0, timestamp=0):
+    return struct.pack('<BBII', attr, 0, size, timestamp) + name + '\x00'
+
+# D:\DCIM\100CANON\IMG_0001.JPG, D:\DCIM\README.TXT, D:\TOP.JPG
+LISTING = ''.join([listing_entry(0x10, 'D:'),
+                   listing_entry(0x10, '.\\DCIM'),
+                   listing_entry(0x10, '.\\100CANON'),
+                   listing_entry(0x20, 'IMG_0001.JPG', 1234, 99),
+                   listing_entry(0x10, '..'),
+                   listing_entry(0x00, 'README.TXT', 5, 10),
+                   listing_entry(0x10, '..'),
+                   listing_entry(0x01, 'TOP.JPG', 7, 200)])
+
 class TestProtocolStructures(unittest.TestCase):
 
     def test_capture_params_can_be_extracted(self):
@@ -12,5 +28,74 @@ class TestProtocolStructures(unittest.TestCase):
         foo = CaptureSettings(data)
         self.assertEqual(data.tostring(), foo.tostring())
 
+    def test_chunk_sizes_honour_max_chunk(self):
+        from canon.protocol import Command
+        self.assertEqual(list(Command.chunk_sizes(0x3000)),
+                         [0x1400, 0x1400, 0x800])
+        self.assertEqual(list(Command.chunk_sizes(0x5023, 0x2800)),
+                         [0x2800, 0x2800, 0x23])
+
+    def test_command_header_from_template(self):
+        from canon.commands import SetOwnerCmd
+        from canon.protocol import GenericCommand
+        cmd = SetOwnerCmd('abc')
+        header = cmd.command_header
+        self.assertEqual(len(header), 0x50)
+        self.assertEqual(header[:8].tostring(),
+                         '\x14\x00\x00\x00\x01\x02\x00\x00')
+        self.assertEqual((header[0x40], header[0x44], header[0x47]),
+                         (0x02, 0x05, 0x12))
+        self.assertEqual(header[0x48:0x4c].tostring(), '\x14\x00\x00\x00')
+        self.assertEqual(le32toi(header, 0x4c), cmd.serial)
+        # the template itself stays clean
+        self.assertFalse(any(SetOwnerCmd._header_template[0x48:]))
+        generic = GenericCommand(0x05, 0x12, 0x201, array('B', 'abc\x00'),
+                                 serial=cmd.serial)
+        self.assertEqual(generic.command_header, header)
+
+    def test_directory_listing_is_parsed_into_a_tree(self):
+        from canon.storage import ListDirectoryCmd
+        root = ListDirectoryCmd('D:')._parse_response(array('B', LISTING))
+        self.assertEqual([(e.full_path, e.is_dir) for e in root],
+                         [('D:', True), ('D:\\DCIM', True),
+                          ('D:\\DCIM\\100CANON', True),
+                          ('D:\\DCIM\\100CANON\\IMG_0001.JPG', False),
+                          ('D:\\DCIM\\README.TXT', False),
+                          ('D:\\TOP.JPG', False)])
+        img = root.children[0].children[0].children[0]
+        self.assertEqual((img.size, img.timestamp), (1234, 99))
+        self.assertTrue(img.attr.downloaded)
+        self.assertTrue(root.children[1].attr.protected)
+
+    def test_storage_index_queries(self):
+        from canon.storage import ListDirectoryCmd
+        cmd = ListDirectoryCmd('D:', index=True)
+        index = cmd._parse_response(array('B', LISTING))
+        self.assertEqual(len(index), 6)
+        self.assertEqual([index.path(i) for i in index],
+                         ['D:', 'D:\\DCIM', 'D:\\DCIM\\100CANON',
+                          'D:\\DCIM\\100CANON\\IMG_0001.JPG',
+                          'D:\\DCIM\\README.TXT', 'D:\\TOP.JPG'])
+        dcim = index.find('D:\\DCIM')
+        self.assertEqual(list(index.children(dcim)), [2, 4])
+        self.assertEqual(list(index.children()), [1, 5])
+        self.assertEqual(index.files(dcim), [3, 4])
+        self.assertEqual(index.total_size(), 1234 + 5 + 7)
+        self.assertEqual(index.directory_sizes(),
+                         {'D:': 1246, 'D:\\DCIM': 1239,
+                          'D:\\DCIM\\100CANON': 1234})
+        self.assertEqual(index.newer_than(50), [3, 5])
+        self.assertEqual(index.not_downloaded(), [4, 5])
+        self.assertTrue(index.attributes(5).protected)
+        entry = index.entry(3)
+        self.assertEqual((entry.full_path, entry.size, entry.is_file),
+                         (index.path(3), 1234, True))
+
+    def test_le_fields_from_buffers(self):
+        data = array('B', '\x00\x01\x02\x03\x04\x05')
+        self.assertEqual(le32toi(data, 2), 0x05040302)
+        self.assertEqual(le16toi(data, 1), 0x0201)
+        self.assertEqual(le32toi('\x01\x00\x00\x00'), 1)
+
 if __name__ == '__main__':
     unittest.main()
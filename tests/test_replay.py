@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from canon import camera, tuning, CanonError
+from canon.simulator import SimulatedG3
+from canon.trace import read_trace
+from canon.replay import ReplayDevice, read_pcap, write_pcap
+
+PATH = 'D:\\DCIM\\100CANON\\IMG_0002.JPG'
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = tuning.ChunkSizeStore(
+                                os.path.join(self.tmpdir, 'sizes.json'))
+        # record a session with the simulator
+        self.sim = SimulatedG3()
+        cam = camera.Camera(self.sim, chunk_size_store=self.store)
+        cam._usb.start_trace(slots=512, snaplen=0x2000)
+        cam.initialize()
+        self.listing = [e.full_path for e in cam.storage.ls()]
+        out = StringIO()
+        cam.storage.get_file(PATH, out)
+        self.data = out.getvalue()
+        self.trace = StringIO()
+        cam._usb.dump_trace(self.trace)
+        cam._usb.stop_trace()
+        cam.cleanup()
+        self.trace.seek(0)
+        self.records = list(read_trace(self.trace))
+        self.trace.seek(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def replay(self, device):
+        cam = camera.Camera(device, chunk_size_store=self.store)
+        try:
+            cam.initialize()
+            self.assertEqual([e.full_path for e in cam.storage.ls()],
+                             self.listing)
+            for _ in xrange(2):
+                out = StringIO()
+                cam.storage.get_file(PATH, out)
+                self.assertEqual(out.getvalue(), self.data)
+            # nothing was recorded for this one
+            self.assertRaises(CanonError, setattr, cam, 'owner', 'nobody')
+        finally:
+            cam.cleanup()
+
+    def test_replay_trace(self):
+        self.replay(ReplayDevice.from_trace(self.trace))
+
+    def test_replay_pcap(self):
+        pcap = os.path.join(self.tmpdir, 'session.pcap')
+        with open(pcap, 'wb') as f:
+            write_pcap(read_trace(self.trace), f)
+        self.assertEqual(len(read_pcap(pcap)), len(self.records))
+        self.replay(ReplayDevice.from_pcap(pcap))
+
+if __name__ == '__main__':
+    unittest.main()
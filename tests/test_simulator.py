@@ -0,0 +1,105 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from canon import camera, tuning, CanonError
+from canon.simulator import SimulatedG3
+from canon.worker import InterruptEvents
+
+class SimulatedCameraTestCase(unittest.TestCase):
+    """Talk to a :class:`SimulatedG3` through a real :class:`Camera`."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sim = SimulatedG3()
+        store = tuning.ChunkSizeStore(os.path.join(self.tmpdir, 'sizes.json'))
+        self.cam = camera.Camera(self.sim, chunk_size_store=store)
+        self.cam.initialize()
+
+    def tearDown(self):
+        self.cam.cleanup()
+        shutil.rmtree(self.tmpdir)
+
+class SimulatorTest(SimulatedCameraTestCase):
+
+    def test_identify(self):
+        self.assertEqual(self.cam.identify(),
+                         ('Canon PowerShot G3', '', '1.0.2.0'))
+        self.cam.owner = 'someone'
+        self.assertEqual(self.cam.owner, 'someone')
+
+    def test_listing_and_download(self):
+        files = [e for e in self.cam.storage.ls() if e.is_file]
+        self.assertEqual(len(files), 4)
+        path = 'D:\\DCIM\\100CANON\\IMG_0003.JPG'
+        self.assertEqual(files[2].full_path, path)
+        self.assertEqual(files[2].size, len(self.sim.get(path).data))
+        out = StringIO()
+        self.cam.storage.get_file(files[2], out)
+        self.assertEqual(out.getvalue(), self.sim.get(path).data)
+        m = self.cam.metrics.command('GetFileCmd')
+        self.assertEqual(m.calls, 1)
+        self.assertEqual(m.bytes_in, 0x40 + files[2].size)
+        self.assertTrue(m.chunks > 1)
+
+    def test_capture_to_drive(self):
+        self.cam.capture.start()
+        self.cam.capture()
+        self.assertTrue(self.sim.get('D:\\DCIM\\100CANON\\IMG_0005.JPG'))
+        self.cam.capture.stop()
+        self.assertFalse(self.sim.in_rc)
+
+    def test_commands_cannot_start_inside_a_response(self):
+        storage = self.cam.storage
+        listings = lambda: self.sim.commands.count((0x0b, 0x11, 0x202))
+        class Target(object):
+            def write(self, data):
+                storage.ls(index=True)
+        before = listings()
+        self.assertRaisesRegexp(CanonError, 'GetFileCmd is being read',
+                                storage.get_file,
+                                'D:\\DCIM\\100CANON\\IMG_0001.JPG', Target())
+        self.assertEqual(listings(), before)
+
+    def test_poller_wakes_on_messages(self):
+        usb = self.cam._usb
+        with usb.poller_ctx() as p:
+            self.assertEqual(p.wait_for(message_type=0x0e, timeout=0.05),
+                             None)
+            started = time.time()
+            mark = p.mark()
+            self.sim._interrupt(self.sim._int_message(0x0e, 0x1001))
+            message = p.wait_for(message_type=0x0e, timeout=2, since=mark)
+            self.assertTrue(time.time() - started < 0.5)
+            self.assertEqual(message[4], 0x0e)
+            self.assertEqual(len(p.wait_for(size=0x10, timeout=0,
+                                            since=mark)), 0x10)
+            # what came in before doesn't count
+            self.assertEqual(p.wait_for(message_type=0x0e, timeout=0.05),
+                             None)
+            self.assertEqual(p.wait_for(size=0x10, timeout=0.05), None)
+            mark = p.mark()
+            self.sim._interrupt(self.sim._int_message(0x0e, 0x1002))
+            message = p.wait_for(message_type=0x0e, timeout=2, since=mark)
+            self.assertEqual(message[0x0c], 0x02)
+
+    def test_failing_interrupt_listeners_are_survived(self):
+        usb = self.cam._usb
+        def broken(data):
+            raise ValueError("listener bug")
+        usb.add_interrupt_listener(broken)
+        events = InterruptEvents(usb, timeout=2)
+        with usb.poller_ctx() as p:
+            for key in (0x1001, 0x1002):
+                self.sim._interrupt(self.sim._int_message(0x0e, key))
+            self.assertEqual(next(events)[4], 0x0e)
+            self.assertEqual(next(events)[4], 0x0e)
+            self.assertTrue(p.isAlive())
+        events.close()
+        usb.remove_interrupt_listener(broken)
+
+if __name__ == '__main__':
+    unittest.main()
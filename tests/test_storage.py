@@ -0,0 +1,219 @@
+import os
+import gc
+import json
+import hashlib
+import threading
+import unittest
+from StringIO import StringIO
+
+from canon import tuning, CanonError
+from canon.pipeline import DownloadPipeline
+from canon.storage import SYNC_MANIFEST, CACHE_TTL
+
+from .test_simulator import SimulatedCameraTestCase
+
+class StorageCacheTest(SimulatedCameraTestCase):
+
+    def test_other_changes_need_a_refresh(self):
+        listings = lambda: self.sim.commands.count((0x0b, 0x11, 0x202))
+        storage = self.cam.storage
+        self.assertEqual(storage.cache_ttl, CACHE_TTL)
+        self.assertEqual(len(list(storage.ls())), 7)
+        # changed behind our back, e.g. by another client
+        self.sim.add_file('D:\\MISC\\NOTES.TXT', data='notes')
+        self.assertEqual(storage.lookup('D:\\MISC\\NOTES.TXT'), None)
+        self.assertEqual(listings(), 1)
+        storage.refresh()
+        self.assertTrue(storage.lookup('D:\\MISC\\NOTES.TXT'))
+        self.assertEqual(len(list(storage.ls())), 9)
+        self.assertEqual(listings(), 2)
+        # or without a cache, every time
+        storage.cache_ttl = None
+        self.sim.add_file('D:\\MISC\\TODO.TXT', data='todo')
+        self.assertTrue(storage.lookup('D:\\MISC\\TODO.TXT'))
+        self.assertEqual(len(list(storage.ls())), 10)
+        self.assertEqual(listings(), 4)
+
+    def test_listings_are_cached(self):
+        listings = lambda: self.sim.commands.count((0x0b, 0x11, 0x202))
+        self.sim.add_file('D:\\MISC\\NOTES.TXT', data='notes')
+        storage = self.cam.storage
+        root = storage.ls()
+        self.assertEqual(len(list(storage.walk())), 4)
+        self.assertEqual(listings(), 1)
+        # callers get copies they can't break the cache with
+        self.assertFalse(storage.ls() is root)
+        root.children[:] = []
+        misc = storage.lookup('D:\\MISC')
+        misc.name = 'OTHER'
+        self.assertEqual(storage.lookup('D:\\MISC').full_path, 'D:\\MISC')
+        self.assertEqual(len(list(storage.ls())), 9)
+        self.assertEqual(listings(), 1)
+        # a capture only gets its folder re-listed
+        self.cam.capture.start()
+        self.cam.capture()
+        self.cam.capture.stop()
+        names = [e.name for e in storage.ls('D:\\DCIM\\100CANON').children]
+        self.assertEqual(names[-1], 'IMG_0005.JPG')
+        self.assertEqual(listings(), 2)
+        self.assertTrue(storage.lookup('D:\\DCIM\\100CANON\\IMG_0005.JPG'))
+        self.assertEqual(storage.latest_capture().full_path,
+                         'D:\\DCIM\\100CANON\\IMG_0005.JPG')
+        self.assertEqual(self.sim.listings[-1], ('D:\\DCIM\\100CANON', 12))
+        storage.refresh()
+        self.assertEqual(listings(), 4)
+        storage.cache_ttl = None
+        storage.ls()
+        self.assertEqual(listings(), 5)
+
+    def test_latest_capture_lists_only_its_folder(self):
+        storage = self.cam.storage
+        storage.ls()
+        # long expired, still only the capture folder is listed
+        storage.cache_ttl = 1e-6
+        del self.sim.listings[:]
+        self.assertEqual(storage.latest_capture().full_path,
+                         'D:\\DCIM\\100CANON\\IMG_0004.JPG')
+        self.assertEqual(self.sim.listings, [('D:\\DCIM\\100CANON', 12)])
+        # and a level at a time without a cache
+        storage.cache_ttl = None
+        del self.sim.listings[:]
+        self.assertEqual(storage.latest_capture().full_path,
+                         'D:\\DCIM\\100CANON\\IMG_0004.JPG')
+        self.assertEqual(self.sim.listings, [('D:\\DCIM', 1),
+                                             ('D:\\DCIM\\100CANON', 1)])
+
+class CameraFileTest(SimulatedCameraTestCase):
+
+    def test_open_streams_files(self):
+        path = 'D:\\DCIM\\100CANON\\IMG_0004.JPG'
+        data = self.sim.get(path).data
+        f = self.cam.storage.open(path)
+        self.assertEqual(f.size, len(data))
+        head = f.read(10)
+        buf = bytearray(0x3000)
+        n = f.readinto(buf)
+        self.assertTrue(0 < n <= len(buf))
+        rest = ''.join(str(chunk) for chunk in f)
+        self.assertEqual(head + str(buf[:n]) + rest, data)
+        self.assertEqual(f.tell(), len(data))
+        f.close()
+        # closing half way drains the pipe for the next command
+        with self.cam.storage.open(path) as f:
+            self.assertEqual(f.read(4), data[:4])
+        with self.cam.storage.open(path) as f:
+            self.assertEqual(f.read(), data)
+
+    def test_commands_are_refused_while_a_file_is_open(self):
+        path = 'D:\\DCIM\\100CANON\\IMG_0004.JPG'
+        data = self.sim.get(path).data
+        storage = self.cam.storage
+        f = storage.open(path)
+        head = f.read(10)
+        self.assertRaisesRegexp(CanonError, 'CameraFile', storage.get_file,
+                                'D:\\DCIM\\100CANON\\IMG_0001.JPG',
+                                StringIO())
+        errors = []
+        def other():
+            try:
+                storage.ls(index=True)
+            except CanonError, e:
+                errors.append(e)
+        t = threading.Thread(target=other)
+        t.start()
+        t.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(head + f.read(), data)
+        f.close()
+        out = StringIO()
+        storage.get_file(path, out)
+        self.assertEqual(out.getvalue(), data)
+
+    def test_files_can_be_closed_from_any_thread(self):
+        path = 'D:\\DCIM\\100CANON\\IMG_0004.JPG'
+        data = self.sim.get(path).data
+        storage = self.cam.storage
+        f = storage.open(path)
+        f.read(10)
+        t = threading.Thread(target=f.close)
+        t.start()
+        t.join()
+        self.assertTrue(f.closed)
+        self.assertFalse(self.cam._usb.streaming)
+        # dropped half read on another thread
+        def drop():
+            storage.open(path).read(10)
+            gc.collect()
+        t = threading.Thread(target=drop)
+        t.start()
+        t.join()
+        self.assertFalse(self.cam._usb.streaming)
+        out = StringIO()
+        storage.get_file(path, out)
+        self.assertEqual(out.getvalue(), data)
+
+class SyncTest(SimulatedCameraTestCase):
+
+    def test_sync(self):
+        local = os.path.join(self.tmpdir, 'photos')
+        report = self.cam.storage.sync(local, mark_downloaded=True)
+        self.assertEqual(len(report.downloaded), 4)
+        self.assertEqual(report.skipped, 0)
+        path = 'D:\\DCIM\\100CANON\\IMG_0002.JPG'
+        with open(os.path.join(local, 'DCIM', '100CANON',
+                               'IMG_0002.JPG'), 'rb') as f:
+            self.assertEqual(f.read(), self.sim.get(path).data)
+        self.assertEqual(self.sim.get(path).attributes, 0x20)
+        self.assertTrue(self.cam.storage.lookup(path).attr.downloaded)
+
+        self.sim.add_file('D:\\DCIM\\100CANON\\IMG_0005.JPG')
+        self.cam.storage.refresh()
+        report = self.cam.storage.sync(local)
+        self.assertEqual(report.downloaded,
+                         ['D:\\DCIM\\100CANON\\IMG_0005.JPG'])
+        self.assertEqual(report.skipped, 4)
+        self.assertTrue(report.throughput > 0)
+
+    def test_sync_through_pipeline(self):
+        local = os.path.join(self.tmpdir, 'photos')
+        with DownloadPipeline(hash_name='md5', fsync_bytes=0x8000) as pipe:
+            report = self.cam.storage.sync(local, pipeline=pipe)
+        self.assertEqual(len(report.downloaded), 4)
+        self.assertTrue(pipe.stats.fsync > 0)
+        with open(os.path.join(local, SYNC_MANIFEST)) as f:
+            manifest = json.load(f)
+        path = 'D:\\DCIM\\100CANON\\IMG_0003.JPG'
+        self.assertEqual(manifest[path][2],
+                         hashlib.md5(self.sim.get(path).data).hexdigest())
+        self.assertEqual(self.cam.storage.sync(local).skipped, 4)
+
+class ChunkSizeTest(SimulatedCameraTestCase):
+
+    def test_chunk_size_only_applies_to_file_transfers(self):
+        storage = self.cam.storage
+        chunks = lambda name: self.cam.metrics.command(name).chunks
+        path = 'D:\\DCIM\\100CANON\\IMG_0001.JPG'
+        storage.ls(index=True)
+        storage.get_file(path, StringIO())
+        listing, download = chunks('ListDirectoryCmd'), chunks('GetFileCmd')
+        self.cam.chunk_size = 0x40
+        storage.ls(index=True)
+        storage.get_file(path, StringIO())
+        self.assertEqual(chunks('ListDirectoryCmd'), 2 * listing)
+        self.assertTrue(chunks('GetFileCmd') - download > download)
+
+    def test_tune_chunk_size(self):
+        self.sim.add_file('D:\\DCIM\\100CANON\\BIG.JPG', size=0x40000)
+        results = self.cam.tune_chunk_size(candidates=(0x1400, 0x2800),
+                                           rounds=2, max_bytes=0x20000)
+        self.assertEqual(sorted(results), [0x1400, 0x2800])
+        self.assertEqual(self.cam.chunk_size, max(results, key=results.get))
+        # the largest file below the cap, not the big one
+        self.assertEqual(self.cam.metrics.command('GetFileCmd').bytes_in,
+                         4 * (0x40 + 0x148d0))
+        self.assertRaises(CanonError, tuning.measure_chunk_sizes,
+                          self.cam._usb, self.cam.storage,
+                          'D:\\DCIM\\100CANON\\BIG.JPG', max_bytes=0x20000)
+
+if __name__ == '__main__':
+    unittest.main()
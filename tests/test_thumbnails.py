@@ -0,0 +1,46 @@
+import os
+import time
+import unittest
+
+from canon.thumbnails import ThumbnailCache
+
+from .test_simulator import SimulatedCameraTestCase
+
+class ThumbnailCacheTest(SimulatedCameraTestCase):
+
+    def test_thumbnail_cache(self):
+        downloads = lambda: self.sim.commands.count((0x01, 0x11, 0x202))
+        storage = self.cam.storage
+        storage.thumbnail_cache = cache = ThumbnailCache(
+                        os.path.join(self.tmpdir, 'thumbs'), max_bytes=0x2800)
+        path = 'D:\\DCIM\\100CANON\\IMG_0001.JPG'
+        thumb = self.sim.get(path).thumbnail
+        self.assertEqual(storage.get_thumbnail(path), thumb)
+        self.assertEqual(storage.get_thumbnail(path), thumb)
+        self.assertEqual(downloads(), 1)
+        # a new cache finds it on disk
+        cache = ThumbnailCache(cache.directory, max_bytes=0x2800)
+        self.assertEqual(cache.get(storage.lookup(path)), thumb)
+        # 0x1000 each, the least recently used goes first
+        for name in ('IMG_0002.JPG', 'IMG_0003.JPG'):
+            storage.get_thumbnail('D:\\DCIM\\100CANON\\' + name)
+        self.assertEqual(len(storage.thumbnail_cache), 2)
+        self.assertFalse(storage.lookup(path) in storage.thumbnail_cache)
+
+    def test_prefetch_thumbnails(self):
+        storage = self.cam.storage
+        storage.thumbnail_cache = ThumbnailCache(
+                                        os.path.join(self.tmpdir, 'thumbs'))
+        storage.prefetch_thumbnails('D:\\DCIM\\100CANON')
+        deadline = time.time() + 5
+        while len(storage.thumbnail_cache) < 4 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(storage.thumbnail_cache), 4)
+        storage.stop_prefetch()
+        downloads = self.sim.commands.count((0x01, 0x11, 0x202))
+        storage.get_thumbnail('D:\\DCIM\\100CANON\\IMG_0004.JPG')
+        self.assertEqual(self.sim.commands.count((0x01, 0x11, 0x202)),
+                         downloads)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import time
+import unittest
+
+from canon import CanonError
+
+from .test_simulator import SimulatedCameraTestCase
+
+class TimelapseTest(SimulatedCameraTestCase):
+
+    def test_timelapse(self):
+        local = os.path.join(self.tmpdir, 'timelapse')
+        frames = []
+        def on_frame(frame):
+            frames.append(frame)
+            if frame.index == 0:
+                # long enough to miss the second shot
+                time.sleep(0.9)
+        self.cam.capture.start()
+        stats = self.cam.capture.timelapse(0.5, frames=3, target_dir=local,
+                                           on_frame=on_frame)
+        self.cam.capture.stop()
+        self.assertEqual(stats.frames, 3)
+        self.assertEqual(stats.missed, 1)
+        self.assertEqual([f.index for f in frames], [0, 2, 3])
+        # back on schedule after that
+        self.assertTrue(frames[-1].fired - frames[-1].due < 0.1)
+        self.assertEqual(stats.downloaded, 3)
+        for frame in frames:
+            with open(frame.local_path, 'rb') as f:
+                self.assertEqual(f.read(),
+                                 self.sim.get(frame.entry.full_path).data)
+        self.assertEqual(stats.download_failed, 0)
+        self.assertEqual(stats.latency.count, 3)
+        for frame in frames:
+            self.assertTrue(frame.written >= frame.captured)
+
+    def test_frames_do_not_list_the_card(self):
+        self.cam.storage.ls()
+        # however long it runs, the tree is never read again
+        self.cam.storage.cache_ttl = 1e-6
+        del self.sim.listings[:]
+        self.cam.capture.start()
+        stats = self.cam.capture.timelapse(0.1, frames=3)
+        self.cam.capture.stop()
+        self.assertEqual(stats.frames, 3)
+        self.assertEqual(self.sim.listings,
+                         [('D:\\DCIM\\100CANON', 12)] * 3)
+
+    def test_download_errors_are_counted(self):
+        local = os.path.join(self.tmpdir, 'timelapse')
+        # the first picture can't be opened locally
+        os.makedirs(os.path.join(local, 'IMG_0005.JPG'))
+        storage = self.cam.storage
+        get_file = storage.get_file
+        def failing_get_file(path, target, *args, **kwargs):
+            if path.name == 'IMG_0006.JPG':
+                raise CanonError("the camera went away")
+            return get_file(path, target, *args, **kwargs)
+        storage.get_file = failing_get_file
+        frames = []
+        self.cam.capture.start()
+        stats = self.cam.capture.timelapse(0.2, frames=3, target_dir=local,
+                                           on_frame=frames.append)
+        self.cam.capture.stop()
+        self.assertEqual(stats.frames, 3)
+        self.assertEqual(stats.downloaded, 1)
+        self.assertEqual(stats.download_failed, 2)
+        self.assertTrue(isinstance(frames[0].error, IOError))
+        self.assertTrue(isinstance(frames[1].error, CanonError))
+        self.assertEqual(frames[1].written, None)
+        self.assertEqual(frames[2].error, None)
+        with open(frames[2].local_path, 'rb') as f:
+            self.assertEqual(f.read(),
+                             self.sim.get(frames[2].entry.full_path).data)
+
+    @unittest.skipUnless(os.path.exists('/dev/full'), "needs /dev/full")
+    def test_write_errors_are_counted(self):
+        local = os.path.join(self.tmpdir, 'timelapse')
+        os.makedirs(local)
+        # the first shot can't be written, there's no room for it
+        os.symlink('/dev/full', os.path.join(local, 'IMG_0005.JPG'))
+        frames = []
+        self.cam.capture.start()
+        stats = self.cam.capture.timelapse(0.2, frames=2, target_dir=local,
+                                           on_frame=frames.append)
+        self.cam.capture.stop()
+        self.assertEqual(stats.frames, 2)
+        self.assertEqual(stats.downloaded, 1)
+        self.assertEqual(stats.download_failed, 1)
+        self.assertEqual(stats.latency.count, 1)
+        self.assertTrue(isinstance(frames[0].error, IOError))
+        self.assertEqual(frames[1].error, None)
+        with open(frames[1].local_path, 'rb') as f:
+            self.assertEqual(f.read(),
+                             self.sim.get(frames[1].entry.full_path).data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+from array import array
+from StringIO import StringIO
+import threading
+import unittest
+
+from canon import trace
+
+class WireTracerTest(unittest.TestCase):
+
+    def test_ring_keeps_the_newest_records(self):
+        tracer = trace.WireTracer(slots=4, snaplen=8)
+        for i in xrange(6):
+            tracer.record(trace.TRACE_IN, 0x81, i, array('B', [i] * 0x10))
+        self.assertEqual(len(tracer), 4)
+        self.assertEqual(tracer.dropped, 2)
+        records = list(tracer.records())
+        self.assertEqual([r.value for r in records], [2, 3, 4, 5])
+        self.assertEqual(records[0].length, 0x10)
+        self.assertEqual(records[0].data, '\x02' * 8)
+
+    def test_dump_can_be_read_back_and_formatted(self):
+        tracer = trace.WireTracer(slots=8, snaplen=0x40)
+        tracer.record(trace.TRACE_OUT, 0x00, 0x10, array('B', range(0x50)))
+        tracer.record(trace.TRACE_IN, 0x81, 0x00, 'abc')
+        out = StringIO()
+        self.assertEqual(tracer.dump(out), 2)
+        out.seek(0)
+        records = list(trace.read_trace(out))
+        self.assertEqual(records, list(tracer.records()))
+        self.assertEqual(records[0].data, array('B', range(0x40)).tostring())
+        text = trace.format_trace(records)
+        self.assertIn('(0x40 captured)', text)
+        self.assertIn('<-- ep 0x81', text)
+
+    def test_records_from_threads_do_not_interleave(self):
+        tracer = trace.WireTracer(slots=4000, snaplen=0x10)
+        def record(value):
+            for i in xrange(1000):
+                tracer.record(trace.TRACE_IN, 0x81, value,
+                              array('B', [value] * 0x10))
+        threads = [threading.Thread(target=record, args=(v,))
+                   for v in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        records = list(tracer.records())
+        self.assertEqual(len(records), 4000)
+        self.assertEqual(tracer.dropped, 0)
+        for rec in records:
+            self.assertEqual(rec.data, chr(rec.value) * 0x10)
+
+if __name__ == '__main__':
+    unittest.main()
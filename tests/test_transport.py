@@ -0,0 +1,167 @@
+import errno
+import ctypes
+import unittest
+
+from usb.core import USBError
+from usb.backend import libusb1
+
+from canon.util import BufferPool
+from canon.simulator import FakeDevice, _Context
+from canon.transport import AsyncCanonUSB
+
+class _Function(object):
+    """A callable which takes ctypes prototypes like a library function."""
+    def __init__(self, fn):
+        self._fn = fn
+
+    def __call__(self, *args):
+        return self._fn(*args)
+
+class FakeLibUSB(object):
+    """libusb's asynchronous API, completing bulk-in transfers from
+    ``data`` as events are handled.
+
+    ``submit_error`` is returned by the next submit, the transfer number
+    ``timeout_at`` completes with a timeout.
+
+    """
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.submitted = []
+        self.completed = 0
+        self.cancelled = 0
+        self.freed = 0
+        self.max_in_flight = 0
+        self.submit_error = None
+        self.timeout_at = None
+        for name in ('alloc_transfer', 'free_transfer', 'submit_transfer',
+                     'cancel_transfer', 'handle_events_timeout'):
+            setattr(self, 'libusb_' + name,
+                    _Function(getattr(self, '_' + name)))
+
+    def _alloc_transfer(self, iso_packets):
+        return ctypes.pointer(libusb1._libusb_transfer())
+
+    def _free_transfer(self, transfer):
+        self.freed += 1
+
+    def _submit_transfer(self, transfer):
+        if self.submit_error is not None:
+            error, self.submit_error = self.submit_error, None
+            return error
+        self.submitted.append(transfer)
+        self.max_in_flight = max(self.max_in_flight, len(self.submitted))
+        return 0
+
+    def _cancel_transfer(self, transfer):
+        self.cancelled += 1
+        transfer.contents.status = libusb1.LIBUSB_TRANSFER_CANCELLED
+        return 0
+
+    def _handle_events_timeout(self, ctx, tv):
+        if not self.submitted:
+            return 0
+        transfer = self.submitted.pop(0)
+        t = transfer.contents
+        if t.status == libusb1.LIBUSB_TRANSFER_CANCELLED:
+            t.actual_length = 0
+        elif self.completed == self.timeout_at:
+            t.status = libusb1.LIBUSB_TRANSFER_TIMED_OUT
+            t.actual_length = 0
+        else:
+            chunk = self.data[self.pos:self.pos+t.length]
+            ctypes.memmove(t.buffer, chunk, len(chunk))
+            self.pos += len(chunk)
+            t.status = libusb1.LIBUSB_TRANSFER_COMPLETED
+            t.actual_length = len(chunk)
+        self.completed += 1
+        t.callback(transfer)
+        return 0
+
+class _Handle(object):
+    handle = None
+
+class _AsyncContext(_Context):
+    def __init__(self, lib):
+        self.backend = libusb1._LibUSB.__new__(libusb1._LibUSB)
+        self.backend.lib = lib
+        self.backend.ctx = None
+        self.handle = _Handle()
+
+    def managed_claim_interface(self, device, interface):
+        pass
+
+class CountingPool(BufferPool):
+    """Keeps track of the buffers handed out and not given back."""
+    def __init__(self):
+        super(CountingPool, self).__init__()
+        self.outstanding = 0
+
+    def acquire(self, size):
+        self.outstanding += 1
+        return super(CountingPool, self).acquire(size)
+
+    def release(self, buf):
+        self.outstanding -= 1
+        super(CountingPool, self).release(buf)
+
+class AsyncCanonUSBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = ''.join(chr(i % 251) for i in xrange(0x1000))
+        self.lib = FakeLibUSB(self.data)
+        device = FakeDevice()
+        device._ctx = _AsyncContext(self.lib)
+        self.usb = AsyncCanonUSB(device, depth=2)
+        self.usb.buffer_pool = self.pool = CountingPool()
+
+    def test_chunks_are_read_with_transfers_queued(self):
+        chunks = [chunk.tostring()
+                  for chunk in self.usb.read_chunks([0x400] * 4)]
+        self.assertEqual(''.join(chunks), self.data)
+        self.assertEqual(self.lib.max_in_flight, 2)
+        self.assertEqual(len(self.usb._transfers), 2)
+        self.assertEqual(self.usb.metrics.link.bulk_reads, 4)
+        self.assertEqual(self.pool.outstanding, 0)
+
+    def test_timeout_raises_and_cancels_the_rest(self):
+        reader = self.usb.read_chunks([0x400] * 4)
+        self.assertEqual(next(reader).tostring(), self.data[:0x400])
+        self.lib.timeout_at = 1
+        try:
+            next(reader)
+        except USBError, e:
+            self.assertEqual(e.errno, errno.ETIMEDOUT)
+        else:
+            self.fail("no timeout")
+        self.assertEqual(self.lib.cancelled, 1)
+        self.assertEqual(self.lib.submitted, [])
+        self.assertEqual(self.pool.outstanding, 0)
+        self.assertTrue(all(t.done for t in self.usb._transfers))
+
+    def test_abandoning_cancels_queued_transfers(self):
+        reader = self.usb.read_chunks([0x400] * 4)
+        # the second one is queued by now
+        next(reader)
+        reader.close()
+        self.assertEqual(self.lib.cancelled, 1)
+        self.assertEqual(self.lib.submitted, [])
+        self.assertEqual(self.pool.outstanding, 0)
+
+    def test_failed_submit_releases_the_buffer(self):
+        self.lib.submit_error = libusb1.LIBUSB_ERROR_IO
+        self.assertRaises(USBError, list, self.usb.read_chunks([0x400] * 4))
+        self.assertEqual(self.pool.outstanding, 0)
+        # and the transfer can be used again
+        reader = self.usb.read_chunks([0x400] * 4)
+        self.assertEqual(''.join(c.tostring() for c in reader), self.data)
+        self.assertEqual(len(self.usb._transfers), 2)
+
+    def test_transfers_are_freed(self):
+        list(self.usb.read_chunks([0x400] * 4))
+        self.usb.__del__()
+        self.assertEqual(self.lib.freed, 2)
+
+if __name__ == '__main__':
+    unittest.main()
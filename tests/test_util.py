@@ -1,7 +1,9 @@
 from array import array
+import struct
 import unittest
 
 from canon import util, bitfield
+from canon.capture import CaptureSettings
 
 class BitfieldTest(unittest.TestCase):
 
@@ -65,9 +67,68 @@ class BitfieldTest(unittest.TestCase):
         self.assertEqual(0x7c4f, int(foo.second))
         self.assertEqual(foo[2:4], array('B', [0x4f, 0x7c]))
 
+    def test_flags_are_collected_per_class(self):
+        class_ = self._get_bitfield_class()
+        self.assertEqual(sorted(class_.flags),
+                         ['first', 'over', 'second', 'third'])
+        foo = self._get_bitfield_instance(class_=class_)
+        self.assertTrue(foo.flags is class_.flags)
+        self.assertEqual(class_.over.name, 'over')
+        # bound flags are made on demand, nothing is kept per instance
+        self.assertFalse(foo.first is foo.first)
+
+    def test_diff_names_changed_flags(self):
+        foo = self._get_bitfield_instance([0x11, 0x02, 0x13, 0x04, 0x15])
+        bar = self._get_bitfield_instance(array('B', foo))
+        self.assertEqual(foo.diff(bar), {})
+        bar.third = 0x16
+        self.assertEqual(bar.diff(foo), {'third': (0x15, 0x16)})
+        bar.first = 0x12
+        self.assertEqual(sorted(bar.diff(foo)), ['first', 'third'])
+
+    def test_diff_against_raw_data(self):
+        foo = self._get_bitfield_instance([0x11, 0x02, 0x13, 0x04, 0x15])
+        self.assertEqual(foo.diff(foo.tostring()), {})
+        self.assertEqual(foo.diff(bytearray(foo.tostring())), {})
+        raw = '\x11\x02\x13\x04\x16'
+        self.assertEqual(foo.diff(raw), {'third': (0x16, 0x15)})
+        settings = CaptureSettings()
+        self.assertEqual(settings.diff(CaptureSettings().tostring()), {})
+
+    def test_big_endian_irregular_flags(self):
+        class BigBit(bitfield.Bitfield):
+            _size = 4
+            body = bitfield.Flag(1, 3, fmt='>I')
+        bar = BigBit([0x00, 0x01, 0x02, 0x03])
+        self.assertEqual(int(bar.body), 0x010203)
+        bar.body = 0xa0b0c0
+        self.assertEqual(bar, array('B', [0x00, 0xa0, 0xb0, 0xc0]))
+        with self.assertRaises(struct.error):
+            bar.body = 0x1000000
+
 class UtilTest(unittest.TestCase):
-    """TODO: this"""
-    pass
+
+    def test_buffer_pool_recycles_buffers_by_size(self):
+        pool = util.BufferPool(max_free=1, max_sizes=2)
+        buf = pool.acquire(0x40)
+        self.assertEqual(len(buf), 0x40)
+        pool.release(buf)
+        self.assertIs(pool.acquire(0x40), buf)
+        self.assertIsNot(pool.acquire(0x40), buf)
+
+    def test_coalescing_writer_batches_small_writes(self):
+        class Target(object):
+            def __init__(self):
+                self.writes = []
+            def write(self, data):
+                self.writes.append(str(data))
+        target = Target()
+        out = util.CoalescingWriter(target, size=8)
+        for c in 'abcdefghij':
+            out.write(array('B', c))
+        out.write('0123456789')
+        out.flush()
+        self.assertEqual(target.writes, ['abcdefgh', 'ij', '0123456789'])
 
 if __name__ == '__main__':
     unittest.main()
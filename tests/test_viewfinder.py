@@ -0,0 +1,35 @@
+import time
+import unittest
+
+from .test_simulator import SimulatedCameraTestCase
+
+class ViewfinderTest(SimulatedCameraTestCase):
+
+    def test_viewfinder(self):
+        self.cam.capture.start()
+        with self.cam.capture.viewfinder() as vf:
+            self.assertTrue(self.sim.viewfinder)
+            first = vf.next_frame(timeout=2)
+            # let two more frames come in, the one in between is dropped
+            deadline = time.time() + 5
+            while vf.fetched < first.index + 3:
+                self.assertTrue(time.time() < deadline)
+                time.sleep(0.01)
+            second = vf.next_frame(timeout=2)
+        self.assertFalse(self.sim.viewfinder)
+        self.assertEqual(first.data[:2], '\xff\xd8')
+        self.assertTrue(second.index > first.index + 1)
+        self.assertTrue(second.timestamp > first.timestamp)
+        self.assertEqual(vf.delivered, 2)
+        self.assertTrue(vf.dropped > 0)
+        frames = []
+        for frame in self.cam.capture.viewfinder(max_fps=50):
+            frames.append(frame)
+            if len(frames) == 3:
+                break
+        self.assertFalse(self.sim.viewfinder)
+        self.assertEqual([f.index for f in frames], [0, 1, 2])
+        self.cam.capture.stop()
+
+if __name__ == '__main__':
+    unittest.main()
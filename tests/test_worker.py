@@ -0,0 +1,34 @@
+import unittest
+
+from canon import worker
+
+class CameraWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = worker.CameraWorker()
+        self.worker.start()
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_calls_run_in_order_and_return_results(self):
+        seen = []
+        futures = [self.worker.submit(seen.append, i) for i in range(5)]
+        last = self.worker.submit(lambda: list(seen))
+        self.assertEqual(last.result(1), range(5))
+        self.assertTrue(all(f.done() for f in futures))
+
+    def test_exceptions_are_raised_from_result(self):
+        future = self.worker.submit(int, 'not a number')
+        self.assertRaises(ValueError, future.result, 1)
+        self.assertIsInstance(future.exception(), ValueError)
+
+    def test_callbacks_fire_when_done(self):
+        got = []
+        future = self.worker.submit(lambda: 42)
+        future.result(1)
+        future.add_done_callback(lambda f: got.append(f.result()))
+        self.assertEqual(got, [42])
+
+if __name__ == '__main__':
+    unittest.main()